@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the search layer replaying the query stream of the experiments of a SHS dataset
+
+The query stream is the sequence of es requests an evaluation method sends for the query songs of a dataset
+with an experiment profile (check evaluations.METHOD_STAGES and templates.profiles), one search per request
+or 'batch_size' searches per _msearch request. The stream is replayed against an es cluster (templates.uri_config)
+or a local stub server (utilities/stub_server.py) at increasing load levels :
+    - closed loop ('concurrency') : each level is a number of clients sending their next request as soon as
+      the previous one is answered
+    - open loop ('qps') : each level is a rate of requests arriving at random (poisson) times whatever the
+      response times, the latency of a request includes the time it waited for a free client
+
+Each level reports its throughput, latency percentiles and error rate. The saturation knee is the healthy level
+(error rate and achieved rate within bounds) with the highest throughput / p99 latency ratio (check find_knee).
+
+Usage:
+    $ python -m benchmarks.load_test -d test -p shs_msd -m title_mxm_lyrics -l 1,2,4,8,16,32,64
+    $ python -m benchmarks.load_test -d test -M qps -l 50,100,200,400,800 -b 10 -n 4
+    $ python -m benchmarks.load_test --stub-latency 0.005 --stub-concurrency 8 -l 1,2,4,8,16,32
+"""
+from joblib import Parallel, delayed
+from es_search import SearchModule
+from evaluations import METHOD_STAGES
+import templates as presets
+import pandas as pd
+import numpy as np
+import threading
+import argparse
+import Queue
+import time
+
+# csv files of the datasets by name
+DATASETS = {
+    "train": './data/train_shs.csv',
+    "test": './data/test_shs.csv'
+}
+
+MODES = ['concurrency', 'qps']
+
+PERCENTILES = [50, 90, 99]
+
+
+def build_query_stream(shs_csv, profile=presets.shs_msd, method='msd_title', size=100, batch_size=None):
+    """
+    List of the es requests of an evaluation method for the query songs of a dataset, in the order of the dataset
+
+    :param shs_csv: path to the csv file of the dataset
+    :param profile: {default : presets.shs_msd} experiment profile (check templates.profiles)
+    :param method: {default : 'msd_title'} evaluation method (check evaluations.METHOD_STAGES)
+    :param size: {default : 100} size of the responses
+    :param batch_size: {default : None} number of searches per _msearch request (one search per request if None)
+    :return: list of requests, a request being a list of search bodies (sent with _search if it has a single one)
+
+    [NOTE]: The lyrics searches reference the stored document of the query song (more_like_this 'like' a document)
+    and the cleaned title searches send the raw title on the cleaned title field, so that the stream is built
+    without fetching any field of the query songs.
+    """
+    if method not in METHOD_STAGES:
+        raise Exception("\nInvalid 'method' parameter %s, available methods are %s"
+                        % (method, sorted(METHOD_STAGES)))
+    es = SearchModule(presets.uri_config)
+    es.set_profile(**profile)
+    dataset = pd.read_csv(shs_csv)
+    searches = list()
+    for msd_id, title in zip(dataset.msd_id.values, dataset.title.values):
+        for stage in METHOD_STAGES[method]:
+            if stage == 'title':
+                searches.append(es._format_query(title, msd_id, size=size))
+            elif stage == 'cleaned_title':
+                searches.append(es._format_query(title, msd_id, field='dzr_msd_title_clean', size=size))
+            else:
+                searches.append(es._lyrics_like_doc_query(presets.more_like_this, msd_id, size=size))
+    batch_size = batch_size or 1
+    return [searches[start:start + batch_size] for start in range(0, len(searches), batch_size)]
+
+
+def _error_name(error):
+    """Short name of a request error, eg. 'TransportError(503)' or 'ConnectionTimeout'"""
+    status = getattr(error, 'status_code', None)
+    if isinstance(status, int):
+        return '%s(%s)' % (type(error).__name__, status)
+    return type(error).__name__
+
+
+def _send(es, request):
+    if len(request) == 1:
+        es.search_es(request[0])
+    else:
+        es.msearch_es(request, batch_size=len(request))
+    return
+
+
+def _generate(uri_config, requests, mode, level, duration, timeout=30, seed=0):
+    """
+    Send the requests (cycled if needed) at a load level for 'duration' seconds from the current process
+
+    :return: dict of arrays with one item per request ('arrival', 'start' and 'end' times in seconds from the
+        start of the run, 'n_searches', 'ok') and the names of the errors
+    """
+    n_clients = int(level) if mode == 'concurrency' else max(1, min(int(np.ceil(level * timeout)), 256))
+    # the retries would hide the errors, a request is sent once
+    es = SearchModule(uri_config, timeout=timeout, maxsize=n_clients, max_retries=0)
+    es.recorder.enabled = False
+    records = list()
+    errors = dict()
+    lock = threading.Lock()
+    counter = iter(xrange(10 ** 12))
+    t0 = time.time()
+
+    def send(index, arrival):
+        request = requests[index % len(requests)]
+        start = time.time() - t0
+        try:
+            _send(es, request)
+            ok = True
+        except Exception as e:
+            ok = False
+            name = _error_name(e)
+            with lock:
+                errors[name] = errors.get(name, 0) + 1
+        with lock:
+            records.append((arrival, start, time.time() - t0, len(request), ok))
+        return
+
+    def closed_client():
+        while time.time() - t0 < duration:
+            with lock:
+                index = next(counter)
+            send(index, time.time() - t0)
+        return
+
+    pending = Queue.Queue()
+
+    def open_client():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            index, arrival = item
+            if time.time() - t0 - arrival > timeout:
+                # the request waited longer than the timeout for a free client
+                with lock:
+                    errors['ClientQueueTimeout'] = errors.get('ClientQueueTimeout', 0) + 1
+                    records.append((arrival, np.nan, time.time() - t0, len(requests[index % len(requests)]), False))
+                continue
+            send(index, arrival)
+
+    clients = [threading.Thread(target=closed_client if mode == 'concurrency' else open_client)
+               for _ in range(n_clients)]
+    for client in clients:
+        client.daemon = True
+        client.start()
+    if mode == 'qps':
+        # poisson arrivals at 'level' requests per second
+        rng = np.random.RandomState(seed)
+        arrival = 0.
+        for index in counter:
+            arrival += rng.exponential(1. / level)
+            if arrival >= duration:
+                break
+            delay = arrival - (time.time() - t0)
+            if delay > 0:
+                time.sleep(delay)
+            pending.put((index, arrival))
+        for _ in clients:
+            pending.put(None)
+    for client in clients:
+        client.join()
+
+    arrival, start, end, n_searches, ok = zip(*records) if records else ([], ) * 5
+    return {'arrival': np.array(arrival, dtype=np.float64), 'start': np.array(start, dtype=np.float64),
+            'end': np.array(end, dtype=np.float64), 'n_searches': np.array(n_searches, dtype=np.int64),
+            'ok': np.array(ok, dtype=bool), 'errors': errors}
+
+
+def summarize(runs, mode, level, duration, warmup=0.):
+    """
+    Metrics of a load level from the records of its generator processes (check _generate),
+    the requests arrived during the first 'warmup' seconds are ignored
+
+    :return: dict of the metrics (latencies in ms, rates per second)
+    """
+    records = dict((key, np.concatenate([run[key] for run in runs])) for key in ['arrival', 'start', 'end',
+                                                                                  'n_searches', 'ok'])
+    measured = records['arrival'] >= warmup
+    window = duration - warmup
+    # the throughput counts the requests completed during the window, the requests still queued at its end
+    # (overloaded levels) are not
+    completed = records['ok'] & (records['end'] >= warmup) & (records['end'] < duration)
+    ok = records['ok'][measured]
+    latency = (records['end'] - records['arrival'])[measured][ok] * 1000
+    service = (records['end'] - records['start'])[measured][ok] * 1000
+    errors = dict()
+    for run in runs:
+        for name, count in run['errors'].iteritems():
+            errors[name] = errors.get(name, 0) + count
+    summary = {'mode': mode, 'level': level, 'n_requests': int(measured.sum()), 'n_errors': int((~ok).sum()),
+               'error_rate': float((~ok).mean()) if len(ok) else np.nan,
+               'offered_rate': level if mode == 'qps' else np.nan,
+               'arrival_rate': measured.sum() / window,
+               'throughput': completed.sum() / window,
+               'search_rate': records['n_searches'][completed].sum() / window,
+               'errors': ','.join('%s:%s' % item for item in sorted(errors.items()))}
+    for percentile in PERCENTILES:
+        summary['latency_p%s' % percentile] = np.percentile(latency, percentile) if len(latency) else np.nan
+    summary['latency_max'] = latency.max() if len(latency) else np.nan
+    summary['service_p50'] = np.median(service) if len(service) else np.nan
+    return summary
+
+
+def find_knee(report, max_error_rate=0.01, min_achieved=0.95):
+    """
+    Saturation knee of a load test report (check run_load_test) : the level maximizing the power
+    (throughput / p99 latency) among the healthy levels, ie. with an error rate <= 'max_error_rate' and,
+    for the 'qps' mode, a throughput >= 'min_achieved' x the offered rate.
+    Beyond the knee, more load mostly adds latency (queueing) instead of throughput.
+
+    :return: the report with the 'power', 'healthy' and 'knee' columns
+    """
+    report = report.copy()
+    report['power'] = report.throughput / report.latency_p99
+    report['healthy'] = report.error_rate <= max_error_rate
+    qps = report['mode'] == 'qps'
+    report.loc[qps, 'healthy'] &= report.throughput[qps] >= min_achieved * report.offered_rate[qps]
+    report['knee'] = False
+    healthy = report[report.healthy & report.power.notnull()]
+    if len(healthy):
+        report.loc[healthy.power.idxmax(), 'knee'] = True
+    return report
+
+
+def run_load_test(uri_config, requests, mode='concurrency', levels=(1, 2, 4, 8, 16, 32), duration=30., warmup=5.,
+                  n_processes=1, timeout=30, max_error_rate=0.01, verbose=True):
+    """
+    Replay a query stream (check build_query_stream) at increasing load levels
+
+    :param uri_config: uri_config of the es cluster (check templates.uri_config or StubServer.uri_config)
+    :param requests: list of requests of the query stream (cycled if the run needs more requests)
+    :param mode: {default : 'concurrency'} 'concurrency' (closed loop, levels are numbers of clients)
+        or 'qps' (open loop, levels are arrival rates in requests per second)
+    :param levels: {default : (1, 2, 4, 8, 16, 32)} load levels
+    :param duration: {default : 30.} duration of each level in seconds
+    :param warmup: {default : 5.} seconds of each level excluded from its metrics
+    :param n_processes: {default : 1} number of generator processes sharing the load of each level,
+        so that the client (json encoding and decoding) is not the bottleneck
+    :param timeout: {default : 30} timeout of the requests in seconds
+    :param max_error_rate: {default : 0.01} maximum error rate of a healthy level (check find_knee)
+    :return: pandas dataframe with a row of metrics per level (check summarize and find_knee)
+    """
+    if mode not in MODES:
+        raise Exception("\nInvalid 'mode' parameter %s, available modes are %s" % (mode, MODES))
+    rows = list()
+    for level in levels:
+        # each process replays its own slice of the stream at its share of the level
+        shares = [level / float(n_processes)] * n_processes
+        if mode == 'concurrency':
+            shares = [level // n_processes + (process < level % n_processes) for process in range(n_processes)]
+        runs = Parallel(n_jobs=n_processes, backend='multiprocessing')(
+            delayed(_generate)(uri_config, requests[process::n_processes], mode, share, duration, timeout=timeout,
+                               seed=process)
+            for process, share in enumerate(shares) if share > 0 and requests[process::n_processes])
+        rows.append(summarize(runs, mode, level, duration, warmup=warmup))
+        if verbose:
+            print ("%s %6s : %8.1f req/s  %9.1f searches/s  p50 %8.1f ms  p99 %8.1f ms  errors %.2f%%"
+                   % (mode, level, rows[-1]['throughput'], rows[-1]['search_rate'], rows[-1]['latency_p50'],
+                      rows[-1]['latency_p99'], 100 * rows[-1]['error_rate']))
+    columns = ['mode', 'level', 'offered_rate', 'arrival_rate', 'throughput', 'search_rate', 'n_requests',
+               'n_errors', 'error_rate'] + ['latency_p%s' % percentile for percentile in PERCENTILES] + \
+              ['latency_max', 'service_p50', 'errors']
+    return find_knee(pd.DataFrame(rows, columns=columns), max_error_rate=max_error_rate)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Load test of the search layer with the query stream of the "
+                                                 "experiments of a SHS dataset",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-d", action="store", default='test',
+                        help="dataset ('train', 'test' or path to a dataset csv file)")
+    parser.add_argument("-p", action="store", default='shs_msd', help="experiment profile (check templates.py)")
+    parser.add_argument("-m", action="store", default='msd_title', help="evaluation method")
+    parser.add_argument("-s", action="store", default=100, help="size of the responses")
+    parser.add_argument("-b", action="store", default=0, help="number of searches per _msearch request "
+                                                              "(0 for one search per request)")
+    parser.add_argument("-M", action="store", default='concurrency', choices=MODES,
+                        help="closed loop (levels are numbers of clients) or open loop (levels are requests/s)")
+    parser.add_argument("-l", action="store", default='1,2,4,8,16,32,64', help="comma separated load levels")
+    parser.add_argument("-t", action="store", default=30, help="duration of each level in seconds")
+    parser.add_argument("-w", action="store", default=5, help="warmup of each level in seconds")
+    parser.add_argument("-n", action="store", default=1, help="number of generator processes")
+    parser.add_argument("-e", action="store", default=0.01, help="maximum error rate of a healthy load level")
+    parser.add_argument("-o", action="store", default=None, help="csv file of the report")
+    parser.add_argument("--stub-latency", action="store", default=None,
+                        help="replay against a local stub server with this service time per search in seconds "
+                             "instead of the es cluster of templates.py")
+    parser.add_argument("--stub-concurrency", action="store", default=0,
+                        help="number of requests served at the same time by the stub server (0 for no limit)")
+    parser.add_argument("--stub-errors", action="store", default=0., help="error rate of the stub server")
+
+    args = parser.parse_args()
+
+    if args.p not in presets.profiles:
+        parser.error("invalid profile %s, available profiles are %s" % (args.p, sorted(presets.profiles)))
+    stream = build_query_stream(DATASETS.get(args.d, args.d), presets.profiles[args.p], method=args.m,
+                                size=int(args.s), batch_size=int(args.b) or None)
+    print "%s requests in the query stream of the '%s' method" % (len(stream), args.m)
+
+    stub = None
+    uri = presets.uri_config
+    if args.stub_latency is not None:
+        from utilities.stub_server import StubServer
+        stub = StubServer(latency=float(args.stub_latency), error_rate=float(args.stub_errors),
+                          max_concurrency=int(args.stub_concurrency) or None).start(process=True)
+        uri = stub.uri_config
+    try:
+        load_report = run_load_test(uri, stream, mode=args.M, levels=[float(level) if args.M == 'qps' else int(level)
+                                                                      for level in args.l.split(',')],
+                                    duration=float(args.t), warmup=float(args.w), n_processes=int(args.n),
+                                    max_error_rate=float(args.e))
+    finally:
+        if stub is not None:
+            stub.stop()
+
+    knee = load_report[load_report.knee]
+    print "\n", load_report.drop('errors', axis=1).to_string(index=False)
+    if len(knee):
+        print "\nSaturation knee at %s %s : %.1f req/s, p99 latency %.1f ms" % (
+            knee['mode'].values[0], knee.level.values[0], knee.throughput.values[0], knee.latency_p99.values[0])
+    else:
+        print "\nNo healthy load level"
+    if args.o:
+        load_report.to_csv(args.o, index=False)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark runner of the hot paths of the experiments on synthetic SHS-like data (check benchmarks/suite.py)
+
+Each benchmark runs in its own process for each scale (10k, 100k and 1M queries), its run is timed 'repeat'
+times and its peak memory is the growth of the maximum resident set size of the process during the runs.
+The results are stored as a json file per commit in the results directory, so that two commits can be compared.
+
+Usage:
+    $ python -m benchmarks.run -s 10k,100k
+    $ python -m benchmarks.run -s 1M -b es_search
+    $ python -m benchmarks.run compare <commit_a> <commit_b>
+"""
+from benchmarks.suite import BENCHMARKS, Scale
+from benchmarks.synthetic import SCALES
+import multiprocessing
+import subprocess
+import traceback
+import platform
+import argparse
+import resource
+import json
+import time
+import os
+
+RESULTS_DIR = './benchmarks/results'
+DATA_DIR = './benchmarks/data'
+
+
+def _max_rss_mb():
+    """Maximum resident set size of the current process in MB (ru_maxrss is in KB on linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _measure(benchmark, scale, repeat, connection):
+    """Run a benchmark in the current (child) process and send its measures through 'connection'"""
+    measures = {'name': benchmark.name, 'scale': scale.name, 'n_items': benchmark.n_items(scale)}
+    try:
+        state = benchmark.setup(scale, measures['n_items'])
+        setup_rss = _max_rss_mb()
+        times = list()
+        for _ in range(repeat):
+            start = time.time()
+            benchmark.run(state)
+            times.append(time.time() - start)
+        times.sort()
+        measures.update({'times': times, 'min': times[0], 'median': times[len(times) // 2],
+                         'per_item_us': times[len(times) // 2] / max(measures['n_items'], 1) * 1e6,
+                         'setup_rss_mb': setup_rss, 'peak_mb': _max_rss_mb() - setup_rss})
+    except Exception:
+        measures['error'] = traceback.format_exc().strip().splitlines()[-1]
+    connection.send(measures)
+    connection.close()
+    return
+
+
+def commit_info():
+    """Current commit (short hash) of the repository and whether the working tree has changes"""
+    def git(*args):
+        return subprocess.check_output(['git'] + list(args)).strip()
+    try:
+        return git('rev-parse', '--short', 'HEAD'), bool(git('status', '--porcelain', '--untracked-files=no'))
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def run_benchmarks(scales=('10k', '100k', '1M'), names=None, repeat=3, size=100, results_dir=RESULTS_DIR,
+                   data_dir=DATA_DIR):
+    """
+    Run the benchmarks and store their measures in '<results_dir>/<commit>.json'
+    (the measures of the same benchmark and scale of a previous run of the commit are replaced)
+
+    :param scales: {default : ('10k', '100k', '1M')} scales of the synthetic data (check synthetic.SCALES)
+    :param names: {default : None} list of substrings of the names of the benchmarks to run (all if None)
+    :param repeat: {default : 3} number of timed runs of each benchmark
+    :param size: {default : 100} number of hits of the synthetic responses
+    :return: list of the measures of the benchmarks
+    """
+    commit, dirty = commit_info()
+    results_file = os.path.join(results_dir, '%s.json' % commit)
+    report = {'commit': commit, 'benchmarks': list()}
+    if os.path.exists(results_file):
+        with open(results_file) as f:
+            report = json.load(f)
+    report.update({'dirty': dirty, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                               'cpu_count': multiprocessing.cpu_count()}})
+
+    benchmarks = [benchmark for benchmark in BENCHMARKS if not names or any(name in benchmark.name for name in names)]
+    measures = list()
+    for scale_name in scales:
+        if scale_name not in SCALES:
+            raise Exception("\nInvalid scale %s, available scales are %s" % (scale_name, sorted(SCALES)))
+        scale = Scale(scale_name, data_dir, size=size).prepare()
+        for benchmark in benchmarks:
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_measure, args=(benchmark, scale, repeat, sender))
+            process.start()
+            result = receiver.recv()
+            process.join()
+            result['size'] = size
+            measures.append(result)
+            if 'error' in result:
+                print "%-50s %5s  error : %s" % (benchmark.name, scale_name, result['error'])
+            else:
+                print "%-50s %5s  %8s items  median %9.4f s  (%8.2f us/item)  peak %8.1f MB" % (
+                    benchmark.name, scale_name, result['n_items'], result['median'], result['per_item_us'],
+                    result['peak_mb'])
+
+    done = set((result['name'], result['scale'], result['size']) for result in measures)
+    report['benchmarks'] = [result for result in report['benchmarks']
+                            if (result['name'], result['scale'], result.get('size')) not in done] + measures
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    with open(results_file, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "\nResults of the commit %s%s saved to %s" % (commit, ' (with local changes)' if dirty else '', results_file)
+    return measures
+
+
+def compare(commit_a, commit_b, results_dir=RESULTS_DIR):
+    """
+    Compare the measures of two commits (ratio b / a of the median times and of the peak memory)
+
+    :return: list of (name, scale, median_a, median_b, time_ratio, peak_a, peak_b) tuples
+    """
+    reports = list()
+    for commit in [commit_a, commit_b]:
+        with open(os.path.join(results_dir, '%s.json' % commit)) as f:
+            reports.append(dict(((result['name'], result['scale'], result.get('size')), result)
+                                for result in json.load(f)['benchmarks'] if 'error' not in result))
+    rows = list()
+    print "%-50s %5s %12s %12s %8s %10s %10s" % ('benchmark', 'scale', commit_a, commit_b, 'ratio', 'peak a', 'peak b')
+    for key in sorted(set(reports[0]) & set(reports[1])):
+        a, b = reports[0][key], reports[1][key]
+        ratio = b['median'] / a['median'] if a['median'] else float('nan')
+        rows.append((key[0], key[1], a['median'], b['median'], ratio, a['peak_mb'], b['peak_mb']))
+        print "%-50s %5s %12.4f %12.4f %8.2f %10.1f %10.1f" % rows[-1]
+    return rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the cover song detection experiments",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("commits", nargs='*',
+                        help="'compare <commit_a> <commit_b>' to compare the stored results of two commits")
+    parser.add_argument("-s", action="store", default='10k,100k,1M', help="comma separated scales")
+    parser.add_argument("-b", action="store", default='', help="comma separated substrings of benchmark names")
+    parser.add_argument("-r", action="store", default=3, help="number of timed runs of each benchmark")
+    parser.add_argument("-n", action="store", default=100, help="number of hits of the synthetic responses")
+    parser.add_argument("-o", action="store", default=RESULTS_DIR, help="directory of the results")
+    args = parser.parse_args()
+
+    if args.commits:
+        if len(args.commits) != 3 or args.commits[0] != 'compare':
+            parser.error("usage : compare <commit_a> <commit_b>")
+        compare(args.commits[1], args.commits[2], results_dir=args.o)
+    else:
+        run_benchmarks(scales=args.s.split(','), names=[name for name in args.b.split(',') if name], repeat=int(args.r),
+                       size=int(args.n), results_dir=args.o)
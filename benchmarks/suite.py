@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths of the experiments (check benchmarks/run.py)
+
+Each benchmark has a setup building its inputs from the synthetic data of a scale (check Scale) and a run timed
+by the runner. The per-query python functions (eg. rerank_title_results_by_lyrics, title_formatter) and the
+search client requests run on the first 'max_items' queries of a scale, the vectorized ones on all the queries.
+"""
+from benchmarks.synthetic import SCALES, make_dataset, make_results, write_dataset
+from utilities.result_store import ResultStore
+from utilities import rerank
+import pandas as pd
+import numpy as np
+import os
+
+
+class Scale(object):
+    """
+    Synthetic dataset and results (title and lyrics) of a scale, generated once and cached in 'data_dir'
+    (the results are memory-mapped from their ResultStore directories)
+    """
+
+    def __init__(self, name, data_dir, size=100):
+        """
+        Init params:
+                    name : name of the scale (check synthetic.SCALES)
+                    data_dir : directory of the cached synthetic data
+                    size : {default : 100} number of hits of the responses
+        """
+        self.name = name
+        self.n_queries = SCALES[name]
+        self.size = size
+        self.path = os.path.join(data_dir, '%s_%s' % (name, size))
+        self.csv_file = os.path.join(self.path, 'dataset.csv')
+        self._experiments = None
+        return
+
+    def prepare(self):
+        """Generate the synthetic data of the scale if it is not cached"""
+        if os.path.exists(os.path.join(self.path, 'lyrics', 'valid.npy')):
+            return self
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        dataset = make_dataset(self.n_queries)
+        write_dataset(dataset, self.csv_file)
+        make_results(dataset, size=self.size, seed=1).save(os.path.join(self.path, 'title'))
+        # same noise pool, so that the title and lyrics results have the same id table
+        make_results(dataset, size=self.size, seed=2).save(os.path.join(self.path, 'lyrics'))
+        return self
+
+    @property
+    def dataset(self):
+        return pd.read_csv(self.csv_file)
+
+    @property
+    def title_results(self):
+        return ResultStore.load(os.path.join(self.path, 'title'))
+
+    @property
+    def lyrics_results(self):
+        return ResultStore.load(os.path.join(self.path, 'lyrics'))
+
+    @property
+    def experiments(self):
+        """Experiments instance of the dataset of the scale (without any search module)"""
+        if self._experiments is None:
+            from experiments import Experiments
+            self._experiments = Experiments(None, self.csv_file)
+        return self._experiments
+
+
+class Benchmark(object):
+    """
+    A timed function : setup(scale, n_items) returns the state passed to run(state)
+    """
+
+    def __init__(self, name, setup, run, max_items=None):
+        """
+        Init params:
+                    name : name of the benchmark
+                    setup : function (scale, n_items) -> state, not timed
+                    run : function (state) timed by the runner
+                    max_items : {default : None} maximum number of queries of the benchmark (all if None)
+        """
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.max_items = max_items
+        return
+
+    def n_items(self, scale):
+        return min(scale.n_queries, self.max_items or scale.n_queries)
+
+
+def _responses_frames(store, n_items):
+    """Per-query response dataframes (msd_id, score) of the first valid queries of a store"""
+    frames = list()
+    for index in range(len(store)):
+        if len(frames) == n_items:
+            break
+        ids, scores = store.response(index)
+        if ids:
+            frames.append(pd.DataFrame({'msd_id': ids, 'score': scores}))
+    return frames
+
+
+def setup_average_precision(scale, n_items):
+    return scale.experiments, scale.title_results
+
+
+def run_average_precision(state):
+    exp, results = state
+    return exp.average_precision(results)
+
+
+def setup_average_precision_dataframe(scale, n_items):
+    return scale.experiments, scale.title_results.take(np.arange(n_items)).to_dataframe()
+
+
+def setup_rerank_by_lyrics(scale, n_items):
+    return scale.experiments, zip(_responses_frames(scale.title_results, n_items),
+                                  _responses_frames(scale.lyrics_results, n_items))
+
+
+def run_rerank_by_lyrics(state):
+    exp, responses = state
+    return [exp.rerank_title_results_by_lyrics(title_res, lyrics_res, mode='eval')
+            for title_res, lyrics_res in responses]
+
+
+def setup_promote_by_lyrics(scale, n_items):
+    title, lyrics = scale.title_results, scale.lyrics_results
+    return (np.asarray(title.ids, dtype=np.int64), np.asarray(title.scores, dtype=np.float64),
+            np.asarray(lyrics.ids, dtype=np.int64), np.asarray(lyrics.scores, dtype=np.float64))
+
+
+def run_promote_by_lyrics(state):
+    return rerank.promote_by_lyrics(*state, proximity=0.5)
+
+
+def setup_title_formatter(scale, n_items):
+    from utilities.text_utils import title_formatter
+    return title_formatter, scale.dataset.title.values[:n_items].tolist()
+
+
+def run_title_formatter(state):
+    title_formatter, titles = state
+    return [title_formatter(title) for title in titles]
+
+
+def setup_view_response(scale, n_items):
+    from es_search import SearchModule
+    import templates as presets
+    store = scale.title_results
+    responses = list()
+    for index in range(n_items):
+        ids, scores = store.response(index)
+        responses.append([{'_id': msd_id, '_score': score, '_source': {'msd_title': 'title %s' % rank}}
+                          for rank, (msd_id, score) in enumerate(zip(ids or [], scores or []))])
+    return SearchModule(presets.uri_config), responses
+
+
+def run_view_response(state):
+    es, responses = state
+    return [es._view_response(response) for response in responses]
+
+
+def _stub_search_module():
+    """SearchModule connected to a local stub server (utilities/stub_server.py) running in a child process"""
+    from utilities.stub_server import StubServer
+    from es_search import SearchModule
+    server = StubServer().start(process=True)
+    return server, SearchModule(server.uri_config)
+
+
+def setup_search_client(scale, n_items):
+    server, es = _stub_search_module()
+    dataset = scale.dataset
+    queries = [(unicode(title), msd_id, scale.size) for title, msd_id in
+               zip(dataset.title.values[:n_items], dataset.msd_id.values[:n_items])]
+    return server, es, queries
+
+
+def run_search_es(state):
+    _, es, queries = state
+    return [es.search_by_exact_title(title, msd_id, out_mode='eval', size=size) for title, msd_id, size in queries]
+
+
+def run_msearch_es(state):
+    _, es, queries = state
+    return es.batch_search_by_exact_title(queries, out_mode='eval', batch_size=100, coalesce=False)
+
+
+def run_prefetch_fields(state):
+    _, es, queries = state
+    es.clear_field_cache()
+    return es.prefetch_fields([msd_id for _, msd_id, _ in queries], fields=['mxm_lyrics', 'dzr_msd_title_clean'])
+
+
+BENCHMARKS = [
+    Benchmark('experiments.average_precision', setup_average_precision, run_average_precision),
+    Benchmark('experiments.average_precision_dataframe', setup_average_precision_dataframe, run_average_precision,
+              max_items=100000),
+    Benchmark('experiments.rerank_title_results_by_lyrics', setup_rerank_by_lyrics, run_rerank_by_lyrics,
+              max_items=2000),
+    Benchmark('rerank.promote_by_lyrics', setup_promote_by_lyrics, run_promote_by_lyrics),
+    Benchmark('text_utils.title_formatter', setup_title_formatter, run_title_formatter, max_items=20000),
+    Benchmark('es_search._view_response', setup_view_response, run_view_response, max_items=2000),
+    Benchmark('es_search.search_es', setup_search_client, run_search_es, max_items=2000),
+    Benchmark('es_search.msearch_es', setup_search_client, run_msearch_es, max_items=10000),
+    Benchmark('es_search.prefetch_fields', setup_search_client, run_prefetch_fields, max_items=20000),
+]
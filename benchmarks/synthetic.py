@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic SHS-like datasets and result lists for the benchmarks (check benchmarks/run.py)
+
+A dataset has the columns of the SHS csv files (msd_id, artist_id, title, work_id) with cliques (works) of 2 or
+more songs, the clique sizes follow a geometric distribution like the SHS cliques. The results of a task are a
+ResultStore (utilities/result_store.py) of 'size' hits per query, mixing the other songs of the clique of the
+query at random ranks with hits drawn from a pool of noise msd_ids, with decreasing scores.
+
+Usage:
+    dataset = make_dataset(10000)
+    results = make_results(dataset, size=100)
+    docs = make_index_docs(dataset)
+"""
+from utilities.result_store import ResultStore
+import pandas as pd
+import numpy as np
+
+
+SCALES = {'10k': 10000, '100k': 100000, '1M': 1000000}
+
+WORDS = ['love', 'heart', 'night', 'day', 'rain', 'sun', 'dream', 'fire', 'road', 'home', 'baby', 'time', 'world',
+         'light', 'soul', 'blue', 'river', 'moon', 'sweet', 'lord', 'girl', 'dance', 'gold', 'star', 'train']
+
+SUFFIXES = ['(Live Version)', '(Remastered)', '(Album Version)', '(Radio Edit)', '(Demo)', '(Acoustic)',
+            '(Remix)', '(Mono)']
+
+
+def make_dataset(n_queries, mean_clique_size=3.5, max_clique_size=20, seed=0):
+    """
+    SHS-like dataset dataframe of 'n_queries' songs with the columns ['msd_id', 'artist_id', 'title', 'work_id']
+
+    :param n_queries: number of songs
+    :param mean_clique_size: {default : 3.5} mean number of songs of a clique
+    :param max_clique_size: {default : 20} maximum number of songs of a clique
+    :param seed: {default : 0} random seed
+    """
+    rng = np.random.RandomState(seed)
+    sizes = np.minimum(rng.geometric(1. / (mean_clique_size - 1), size=n_queries) + 1, max_clique_size)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), n_queries) + 1]
+    sizes[-1] -= sizes.sum() - n_queries
+    if sizes[-1] < 2 and len(sizes) > 1:
+        sizes[-2] += sizes[-1]
+        sizes = sizes[:-1]
+    work_ids = np.repeat(np.arange(len(sizes)), sizes)
+    # the songs of a clique share a title with an optional version suffix and have various artists
+    title_words = rng.randint(len(WORDS), size=(len(sizes), 3))
+    base_titles = np.array([' '.join(WORDS[word] for word in words[:1 + index % 3]).title()
+                            for index, words in enumerate(title_words)], dtype=object)
+    suffixes = np.array([''] + [' ' + suffix for suffix in SUFFIXES], dtype=object)
+    titles = base_titles[work_ids] + suffixes[rng.randint(len(suffixes), size=n_queries) *
+                                              (rng.random_sample(n_queries) < 0.3)]
+    order = rng.permutation(n_queries)
+    return pd.DataFrame({'msd_id': ['TR%016X' % index for index in range(n_queries)],
+                         'artist_id': ['AR%016X' % artist for artist in rng.randint(n_queries // 3 + 1,
+                                                                                   size=n_queries)],
+                         'title': titles[order], 'work_id': work_ids[order]},
+                        columns=['msd_id', 'artist_id', 'title', 'work_id'])
+
+
+def make_results(dataset, size=100, hit_rate=0.6, invalid_rate=0.05, n_noise=None, seed=1):
+    """
+    ResultStore of synthetic responses of the songs of a dataset
+
+    :param dataset: dataset dataframe (check make_dataset)
+    :param size: {default : 100} number of hits of each response
+    :param hit_rate: {default : 0.6} probability of each song of the clique of a query to be in its response
+    :param invalid_rate: {default : 0.05} fraction of the queries without response (eg. songs without lyrics)
+    :param n_noise: {default : None} number of noise msd_ids (2 x the number of songs if None)
+    :param seed: {default : 1} random seed
+    """
+    rng = np.random.RandomState(seed)
+    n_queries = len(dataset)
+    n_noise = n_noise or 2 * n_queries
+    # the noise ids follow the songs of the dataset in the id table
+    ids = (n_queries + rng.randint(n_noise, size=(n_queries, size))).astype(np.int32)
+
+    # rows of the songs of each clique (CSR arrays)
+    works = dataset.work_id.values
+    members = np.argsort(works, kind='mergesort')
+    _, starts, counts = np.unique(works[members], return_index=True, return_counts=True)
+    clique = np.searchsorted(np.unique(works), works)
+    rows = np.arange(n_queries)
+    for position in range(counts.max()):
+        member = members[np.minimum(starts[clique] + position, n_queries - 1)]
+        placed = (position < counts[clique]) & (member != rows) & (rng.random_sample(n_queries) < hit_rate)
+        # the covers are more likely in the head of the responses
+        ranks = (rng.random_sample(n_queries) ** 2 * size).astype(np.int64)
+        ids[rows[placed], ranks[placed]] = member[placed]
+
+    scores = -np.sort(-rng.random_sample((n_queries, size)) * 20., axis=1).astype(np.float32)
+    valid = rng.random_sample(n_queries) >= invalid_rate
+    ids[~valid] = -1
+    scores[~valid] = np.nan
+    id_table = np.concatenate([dataset.msd_id.values.astype(str),
+                               np.array(['TN%016X' % index for index in range(n_noise)])])
+    return ResultStore(dataset.msd_id.values.astype(str), id_table, ids, scores, valid)
+
+
+def make_index_docs(dataset, n_noise=None, lyrics_rate=0.8, n_words=300, seed=2):
+    """
+    Documents of a synthetic index (LocalSearchModule) holding the songs of a dataset and noise songs, with the
+    columns ['msd_id', 'msd_title', 'dzr_msd_title_clean', 'mxm_lyrics']. The lyrics of the songs of a clique
+    share a theme of words, the songs without lyrics (1 - 'lyrics_rate') have a None lyrics and the cleaned title
+    is the title without its version suffix.
+
+    :param dataset: dataset dataframe (check make_dataset)
+    :param n_noise: {default : None} number of noise songs (as many as the songs of the dataset if None)
+    :param lyrics_rate: {default : 0.8} fraction of the songs with lyrics
+    :param n_words: {default : 300} size of the vocabulary of the lyrics
+    :param seed: {default : 2} random seed
+    """
+    rng = np.random.RandomState(seed)
+    n_queries = len(dataset)
+    n_noise = n_queries if n_noise is None else n_noise
+    vocabulary = np.array(['w%03d' % index for index in range(n_words)], dtype=object)
+
+    works = np.concatenate([dataset.work_id.values, -1 - np.arange(n_noise)])
+    _, clique = np.unique(works, return_inverse=True)
+    themes = rng.randint(n_words, size=(clique.max() + 1, 12))
+    lyrics = np.array([' '.join(vocabulary[np.concatenate([themes[index][rng.random_sample(12) < 0.7],
+                                                          rng.randint(n_words, size=8)])])
+                       for index in clique], dtype=object)
+    lyrics[rng.random_sample(len(lyrics)) >= lyrics_rate] = None
+
+    noise_titles = [' '.join(WORDS[word] for word in words).title()
+                    for words in rng.randint(len(WORDS), size=(n_noise, 2))]
+    titles = np.concatenate([dataset.title.values.astype(object), np.array(noise_titles, dtype=object)])
+    return pd.DataFrame({'msd_id': np.concatenate([dataset.msd_id.values.astype(object),
+                                                   ['TN%016X' % index for index in range(n_noise)]]),
+                         'msd_title': titles,
+                         'dzr_msd_title_clean': [title.split(' (')[0].lower() for title in titles],
+                         'mxm_lyrics': lyrics},
+                        columns=['msd_id', 'msd_title', 'dzr_msd_title_clean', 'mxm_lyrics'])
+
+
+def write_dataset(dataset, csv_file):
+    """Save a dataset to a csv file readable by the Experiments class"""
+    dataset.to_csv(csv_file, index=False, encoding='utf-8')
+    return csv_file
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Distributed evaluation of the cover song detection experiments across machines with a durable work queue
+
+A coordinator splits the experiments (dataset x profile x method x prune size) into shards of query songs and
+enqueues them in a SQLite work queue (utilities/work_queue.py) on a storage shared by the nodes.
+Worker processes on any node claim the shards with a lease, run them (check evaluations.py -> _run_task_shard)
+and save their results as compressed ResultStore files in a shared results directory, the lease of a shard
+being extended by a heartbeat while it runs. The shards of a crashed worker are claimed again once their lease
+expired. Once all the shards are done, the results of each experiment are merged in the order of its shards
+and evaluated.
+
+Usage:
+    $ python distributed.py coordinator -q /shared/sweep.db -d test -p shs_msd,shs_msd_no_dup -s 10,100
+    $ python distributed.py worker -q /shared/sweep.db -o /shared/results -n 8      (on each node)
+    $ python distributed.py merge -q /shared/sweep.db -o /shared/results
+"""
+
+from joblib import Parallel, delayed
+from evaluations import TASKS, _run_task_shard, _worker_experiments
+from utilities.result_store import ResultStore
+from utilities.work_queue import WorkQueue
+from utils import log
+import templates as presets
+import pandas as pd
+import numpy as np
+import multiprocessing
+import threading
+import argparse
+import time
+import os
+
+# Logging handlers
+LOG_FILE = './logs/distributed.log'
+LOGGER = log(LOG_FILE)
+
+# csv files of the datasets by name
+DATASETS = {
+    "train": './data/train_shs.csv',
+    "test": './data/test_shs.csv'
+}
+
+
+def build_tasks(datasets, methods, profiles, sizes, shard_size=1000):
+    """
+    List of the (key, payload) tasks of the shards of each experiment (dataset x profile x method x size)
+
+    :param datasets: list of dataset names (check DATASETS) or paths to dataset csv files
+    :param methods: list of evaluation methods (check evaluations.TASKS)
+    :param profiles: list of experiment profile names (check templates.profiles)
+    :param sizes: list of prune sizes
+    :param shard_size: {default : 1000} number of query songs per shard
+    """
+    for method in methods:
+        if method not in TASKS:
+            raise Exception("\nInvalid 'method' parameter %s for the experiment ! " % method)
+    for profile in profiles:
+        if profile not in presets.profiles:
+            raise Exception("\nInvalid 'profile' parameter %s, available profiles are %s"
+                            % (profile, sorted(presets.profiles)))
+    tasks = list()
+    for dataset in datasets:
+        shs_csv = DATASETS.get(dataset, dataset)
+        n_queries = len(pd.read_csv(shs_csv))
+        shards = range(0, n_queries, shard_size)
+        for profile in profiles:
+            for method in methods:
+                for size in sizes:
+                    experiment = '%s|%s|%s|%s' % (dataset, profile, method, size)
+                    for shard, start in enumerate(shards):
+                        payload = {'experiment': experiment, 'dataset': dataset, 'shs_csv': shs_csv,
+                                   'profile': profile, 'method': method, 'size': int(size), 'shard': shard,
+                                   'n_shards': len(shards), 'start': start,
+                                   'stop': min(start + shard_size, n_queries)}
+                        tasks.append(('%s|%05d' % (experiment, shard), payload))
+    return tasks
+
+
+def run_coordinator(queue_path, datasets=("test",), methods=("msd_title",), profiles=("shs_msd",), sizes=(100,),
+                    shard_size=1000):
+    """
+    Enqueue the shards of the experiments in the work queue (check build_tasks),
+    the shards already in the queue are skipped so that the coordinator can be run again
+    """
+    queue = WorkQueue(queue_path)
+    added = queue.enqueue(build_tasks(datasets, methods, profiles, sizes, shard_size=shard_size))
+    counts = queue.counts()
+    LOGGER.info("\n %s shards enqueued in %s, queue status %s" % (added, queue_path, counts))
+    return counts
+
+
+def _run_shard(payload):
+    """Run a shard of an experiment and return its ResultStore"""
+    task, task_params = TASKS[payload['method']]
+    return _run_task_shard(payload['shs_csv'], presets.profiles[payload['profile']], task,
+                           dict(task_params, size=payload['size']), payload['start'], payload['stop'])
+
+
+def _file_name(key):
+    """Name of the result file of a task or an experiment key (the dataset may be a path to a csv file)"""
+    return key.replace('|', '__').replace(os.sep, '_')
+
+
+def _heartbeat(queue, task_id, worker_id, lease, interval, stop):
+    """Extend the lease of a task every 'interval' seconds until 'stop' is set"""
+    while not stop.wait(interval):
+        if not queue.heartbeat(task_id, worker_id, lease=lease):
+            LOGGER.warning("\n Worker %s lost the lease of the task %s" % (worker_id, task_id))
+            return
+    return
+
+
+def run_worker(queue_path, results_dir, lease=300, poll=10, worker_id=None):
+    """
+    Claim, run and commit the shards of the work queue until all of them are done or failed
+
+    :param queue_path: path of the SQLite file of the work queue
+    :param results_dir: directory of the results of the shards (shared by the workers of all the nodes)
+    :param lease: {default : 300} lease of a claimed shard in seconds, extended every lease / 3 seconds
+        while the shard runs
+    :param poll: {default : 10} seconds waited before claiming again when all the remaining shards are running
+        on other workers (their lease may expire)
+    :param worker_id: {default : None} id of the worker (host:pid if None)
+    :return: number of shards committed by the worker
+    """
+    queue = WorkQueue(queue_path)
+    worker_id = worker_id or WorkQueue.default_worker_id()
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    n_done = 0
+    while True:
+        task = queue.claim(worker_id, lease=lease)
+        if task is None:
+            if queue.is_finished():
+                break
+            time.sleep(poll)
+            continue
+
+        LOGGER.info("\n Worker %s running %s (attempt %s)" % (worker_id, task['key'], task['attempts']))
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(queue, task['id'], worker_id, lease, lease / 3., stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            store = _run_shard(task['payload'])
+        except Exception as e:
+            LOGGER.error("\n Worker %s failed to run %s : %r" % (worker_id, task['key'], e))
+            queue.fail(task['id'], worker_id, repr(e))
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        # each attempt writes its own file, the file is only referenced by the queue once committed
+        name = '%s.%s' % (_file_name(task['key']), _file_name(worker_id.replace(':', '_')))
+        result_file = os.path.join(results_dir, name + '.npz')
+        store.save(os.path.join(results_dir, name + '.tmp'), compress=True)
+        os.rename(os.path.join(results_dir, name + '.tmp.npz'), result_file)
+        if queue.complete(task['id'], worker_id, result=result_file):
+            n_done += 1
+        else:
+            LOGGER.warning("\n Worker %s lost the lease of %s, its result is discarded" % (worker_id, task['key']))
+            os.remove(result_file)
+    LOGGER.info("\n Worker %s finished after %s shards" % (worker_id, n_done))
+    return n_done
+
+
+def run_workers(queue_path, results_dir, n_workers=-1, lease=300, poll=10):
+    """Run 'n_workers' worker processes on the current node (-1 for one per cpu core), check run_worker"""
+    if n_workers < 0:
+        n_workers = multiprocessing.cpu_count()
+    n_done = Parallel(n_jobs=n_workers, verbose=1)(delayed(run_worker)(queue_path, results_dir, lease=lease, poll=poll)
+                                                   for _ in range(n_workers))
+    return sum(n_done)
+
+
+def merge_results(queue_path, output_dir=None):
+    """
+    Merge the results of the shards of each experiment of the work queue (in the order of the shards)
+    and compute their evaluation metrics
+
+    :param queue_path: path of the SQLite file of the work queue
+    :param output_dir: {default : None} If set, the merged ResultStore of each experiment is saved to this directory
+    :return: pandas dataframe with the columns ['dataset', 'profile', 'method', 'size', 'n_shards', 'shards_done',
+        'map', 'mper'] (one row per experiment, the metrics of an experiment with failed shards are NaN)
+    """
+    queue = WorkQueue(queue_path)
+    if not queue.is_finished():
+        LOGGER.warning("\n The work queue %s is not finished %s" % (queue_path, queue.counts()))
+    experiments = dict()
+    for task in queue.tasks():
+        experiments.setdefault(task['payload']['experiment'], list()).append(task)
+
+    rows = list()
+    for experiment, tasks in sorted(experiments.items()):
+        payload = tasks[0]['payload']
+        shards = sorted([task for task in tasks if task['status'] == 'done'], key=lambda task: task['payload']['shard'])
+        row = {'dataset': payload['dataset'], 'profile': payload['profile'], 'method': payload['method'],
+               'size': payload['size'], 'n_shards': payload['n_shards'], 'shards_done': len(shards),
+               'map': np.nan, 'mper': np.nan}
+        if len(shards) == payload['n_shards']:
+            results = ResultStore.concat([ResultStore.load(task['result']) for task in shards])
+            exp = _worker_experiments(payload['shs_csv'], presets.profiles[payload['profile']])
+            exp.select_queries()
+            row['map'] = exp.mean_average_precision(results)
+            row['mper'] = exp.mean_percentage_of_covers(results)
+            if output_dir:
+                results.save(os.path.join(output_dir, _file_name(experiment)))
+            LOGGER.info("\n %s : Mean Average Precision (MAP) = %s" % (experiment, row['map']))
+        else:
+            LOGGER.warning("\n %s : only %s/%s shards are done" % (experiment, len(shards), payload['n_shards']))
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['dataset', 'profile', 'method', 'size', 'n_shards', 'shards_done', 'map',
+                                       'mper'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Distributed evaluation of the cover song detection experiments with a shared work queue",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("role", choices=['coordinator', 'worker', 'merge'],
+                        help="enqueue the experiments, run a worker node or merge the results")
+    parser.add_argument("-q", action="store", required=True,
+                        help="path of the SQLite file of the work queue (on a storage shared by the nodes)")
+    parser.add_argument("-o", action="store", default='./results/distributed',
+                        help="directory of the results of the shards (on a storage shared by the nodes)")
+    parser.add_argument("-d", action="store", default='test',
+                        help="comma separated datasets ('train', 'test' or paths to dataset csv files)")
+    parser.add_argument("-p", action="store", default='shs_msd',
+                        help="comma separated experiment profiles (check templates.py)")
+    parser.add_argument("-m", action="store", default=','.join(sorted(TASKS)),
+                        help="comma separated evaluation methods")
+    parser.add_argument("-s", action="store", default='100',
+                        help="comma separated prune sizes")
+    parser.add_argument("-c", action="store", default=1000,
+                        help="number of query songs per shard")
+    parser.add_argument("-n", action="store", default=-1,
+                        help="number of worker processes on this node (-1 for one per cpu core)")
+    parser.add_argument("-l", action="store", default=300,
+                        help="lease of a claimed shard in seconds")
+
+    args = parser.parse_args()
+
+    if args.role == 'coordinator':
+        run_coordinator(args.q, datasets=args.d.split(','), methods=args.m.split(','), profiles=args.p.split(','),
+                        sizes=[int(size) for size in args.s.split(',')], shard_size=int(args.c))
+    elif args.role == 'worker':
+        run_workers(args.q, args.o, n_workers=int(args.n), lease=int(args.l))
+    else:
+        print merge_results(args.q, output_dir=os.path.join(args.o, 'merged'))
+
+    print "\n ...Done..."
@@ -6,9 +6,167 @@ Albin Andrew Correya
 R&D Intern
 @Deezer,2017
 """
-from requests import get
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests import Session
+from elasticsearch.connection import Urllib3HttpConnection
+from utilities.instrumentation import RequestRecorder, query_template_name
+from utilities.snapshot import IndexSnapshot
 from copy import deepcopy
 import templates as presets
+import threading
+import hashlib
+import json
+import time
+import os
+
+
+# http time (ms) and response bytes of the es requests made by the current thread (check MeteredConnection)
+_http_stats = threading.local()
+
+
+class MeteredConnection(Urllib3HttpConnection):
+    """
+    Urllib3HttpConnection measuring the http round trip time and the raw size of the responses,
+    so that the SearchModule can tell the network time from the json decoding time of a request
+    """
+
+    def perform_request(self, *args, **kwargs):
+        start = time.time()
+        status, headers, raw_data = Urllib3HttpConnection.perform_request(self, *args, **kwargs)
+        _http_stats.time = getattr(_http_stats, 'time', 0.) + (time.time() - start) * 1000
+        _http_stats.bytes = getattr(_http_stats, 'bytes', 0) + len(raw_data)
+        return status, headers, raw_data
+
+
+class QueryBuilder(object):
+    """
+    Compiles a query DSL template (eg. templates.simple_query_string or templates.more_like_this) and an
+    experiment profile (shs_mode / filter_duplicates / dzr_map) once into a frozen base query, from which a
+    fresh post json is built for every query.
+
+    The builder is never mutated after its init, so that a single instance can be shared between threads.
+    The non-scoring 'exists' clauses of the profile go to the 'filter' context of the bool query
+    (cached by es) and the query msd_id is excluded with an 'ids' query.
+
+    Usage:
+        builder = QueryBuilder(presets.simple_query_string, **presets.shs_msd_no_dup)
+        body = builder.build('My Sweet Lord', exclude_id='TRPYNNL12903CAF506', size=100)
+    """
+
+    def __init__(self, template=presets.simple_query_string, shs_mode=False, filter_duplicates=False,
+                 dzr_map=False):
+        """
+        Init params:
+                    template : query DSL template with the matching clause as first 'must' clause of a bool query
+                               (check the templates.py file)
+                    shs_mode : {default : False} limit the search to the songs of the SHS dataset
+                    filter_duplicates : {default : False} exclude the MSD official duplicates from the search
+                    dzr_map : {default : False} limit the search to the songs mapped to deezer song ids
+        """
+        self.profile = {'shs_mode': shs_mode, 'filter_duplicates': filter_duplicates, 'dzr_map': dzr_map}
+        self._template = template
+
+        bool_query = template['query']['bool']
+        self._match_type, match_params = bool_query['must'][0].items()[0]
+        self._match_params = tuple(match_params.items())
+        self._text_key = 'like' if self._match_type == 'more_like_this' else 'query'
+        self._extra_must = list()
+
+        filter_fields = list()
+        for clause in bool_query['must'][1:]:
+            if 'exists' in clause:
+                filter_fields.append(clause['exists']['field'])
+            else:
+                self._extra_must.append(clause)
+        for clause in bool_query.get('filter', []):
+            filter_fields.append(clause['exists']['field'])
+        if shs_mode:
+            filter_fields.append('shs_id')
+        if dzr_map:
+            filter_fields.append('dzr_song_title')
+
+        must_not_fields = list()
+        for clause in bool_query.get('must_not', []):
+            if 'exists' in clause:
+                must_not_fields.append(clause['exists']['field'])
+            elif clause.get('query_string', {}).get('default_field') != '_id':
+                self._extra_must.append({'bool': {'must_not': [clause]}})
+        if filter_duplicates:
+            must_not_fields.append('msd_is_duplicate_of')
+
+        # remove duplicated fields while keeping their order
+        self._filter_fields = tuple(sorted(set(filter_fields), key=filter_fields.index))
+        self._must_not_fields = tuple(sorted(set(must_not_fields), key=must_not_fields.index))
+        self._extra_must = tuple(self._extra_must)
+        self._from = template.get('from', 0)
+
+        self.default_field = match_params.get('fields', [match_params.get('default_field')])[0]
+        # ids of the stored search templates of the builder, by 'like_doc' (check template_source)
+        self.template_ids = dict()
+        for like_doc in ([False, True] if self._match_type == 'more_like_this' else [False]):
+            source = self.template_source(like_doc)
+            self.template_ids[like_doc] = 'csd-%s-%s' % (self._match_type, hashlib.sha1(source).hexdigest()[:12])
+        return
+
+    def with_profile(self, **profile):
+        """Returns a new QueryBuilder with the same template and an updated profile"""
+        new_profile = dict(self.profile)
+        new_profile.update(profile)
+        return QueryBuilder(self._template, **new_profile)
+
+    def build(self, query, exclude_id=None, size=100, field=None):
+        """
+        Build a fresh post json for a query
+
+        Inputs :
+                query : query text (song title for the title templates, lyrics for more_like_this)
+        Params :
+                exclude_id : {default : None} msd_id excluded from the response (typically the query msd_id)
+                size : (int) size of the required response from es_db
+                field : {default : None} field to search on, if None the field of the template is used
+        """
+        match_params = dict(self._match_params)
+        match_params[self._text_key] = query
+        if field:
+            if 'fields' in match_params:
+                match_params['fields'] = [field]
+            else:
+                match_params['default_field'] = field
+        elif 'fields' in match_params:
+            match_params['fields'] = list(match_params['fields'])
+
+        bool_query = {'must': [{self._match_type: match_params}] + [deepcopy(c) for c in self._extra_must]}
+
+        must_not = [{'exists': {'field': f}} for f in self._must_not_fields]
+        if exclude_id is not None:
+            # we exclude the query id from the result
+            must_not.insert(0, {'ids': {'values': [exclude_id]}})
+        if must_not:
+            bool_query['must_not'] = must_not
+        if self._filter_fields:
+            bool_query['filter'] = [{'exists': {'field': f}} for f in self._filter_fields]
+
+        return {'query': {'bool': bool_query}, 'from': self._from, 'size': size}
+
+    def template_source(self, like_doc=False):
+        """
+        Mustache source of the stored search template equivalent to the post jsons built by the builder.
+        The template params are 'query', 'exclude_id', 'size' and 'field'
+        (the string params are json escaped by the es mustache engine).
+
+        Params :
+                like_doc : {default : False} for a more_like_this template, like the stored document of
+                    'exclude_id' in the index 'index' with the type 'type' (params) instead of a 'query' text
+        """
+        query = '@@query@@'
+        if like_doc:
+            query = [{'_index': '@@index@@', '_type': '@@type@@', '_id': '@@exclude_id@@'}]
+        body = self.build(query, exclude_id='@@exclude_id@@', size='@@size@@', field='@@field@@')
+        source = json.dumps(body, sort_keys=True).replace('"@@size@@"', '{{size}}')
+        for param in ['query', 'exclude_id', 'field', 'index', 'type']:
+            source = source.replace('@@%s@@' % param, '{{%s}}' % param)
+        return source
 
 
 class SearchModule(object):
@@ -21,26 +179,128 @@ class SearchModule(object):
 
     init_json = deepcopy(presets.simple_query_string)  # save the preset as attribute
 
-    def __init__(self, uri_config, query_json=None, timeout=30):
+    def __init__(self, uri_config, query_json=None, timeout=30, maxsize=10, max_retries=3, cache=None,
+                 recorder=None):
         """
         Init params:
                     uri_config : uri_config dictionary specifying the host and port of es db.
                                 (check 'uri_config' in the templates.py file)
                     query_json : {default : None}
+                    timeout : {default : 30} timeout of the es requests in seconds
+                    maxsize : {default : 10} maximum number of keep-alive connections kept open to the es host
+                    max_retries : {default : 3} number of retries of a request on connection errors and timeouts
+                    cache : {default : None} ResponseCache instance (utilities/response_cache.py)
+                        used to store and replay the es responses
+                    recorder : {default : None} RequestRecorder instance (utilities/instrumentation.py)
+                        recording the per-request metrics, a new one is created if None (check self.recorder)
 
+        [NOTE]: The es handler and the http session used for the direct REST calls are created lazily
+        and re-created in a forked process (eg. joblib workers), so that processes never share sockets.
         """
         self.config = uri_config
-        self.handler = self.Elasticsearch(hosts=[{'host': self.config['host'],
-                                                  'port': self.config['port'],
-                                                  'scheme': self.config['scheme']}], timeout=timeout)
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.max_retries = max_retries
+        self.cache = cache
+        self.recorder = recorder if recorder is not None else RequestRecorder()
+        self._handler = None
+        self._session = None
+        self._pid = None
+
+        # ids of the search templates stored in es (check register_search_templates)
+        self.stored_templates = set()
 
         if query_json:
             self.post_json = query_json
         else:
             self.post_json = presets.simple_query_string
 
+        # query builders compiled for the current experiment profile (check set_profile)
+        self.set_profile()
+
+        # in-memory cache of field values by msd_id filled by prefetch_fields ({field: {msd_id: value}})
+        self.field_cache = dict()
+        # fields of the search hits stored in the field cache (check collect_hit_fields)
+        self.hit_fields = tuple()
+
+        return
+
+    def _check_pid(self):
+        """Drop the connections inherited from a parent process after a fork"""
+        if self._pid != os.getpid():
+            self._handler = None
+            self._session = None
+            self._pid = os.getpid()
         return
 
+    def _check_config(self):
+        """Check that the es db credentials are set before making any request"""
+        for key in ['host', 'port', 'index', 'type']:
+            if not self.config.get(key):
+                raise Exception("\nThe es db '%s' is not set in the uri_config. Fill the MSDES_HOST, MSDES_PORT, "
+                                "MSDES_INDEX and MSDES_TYPE environment variables (check templates.py)" % key)
+        return
+
+    @property
+    def handler(self):
+        """Elasticsearch handler with a pool of keep-alive connections owned by the current process"""
+        self._check_pid()
+        if self._handler is None:
+            self._check_config()
+            self._handler = self.Elasticsearch(hosts=[{'host': self.config['host'],
+                                                       'port': self.config['port'],
+                                                       'scheme': self.config['scheme']}],
+                                               timeout=self.timeout, maxsize=self.maxsize,
+                                               max_retries=self.max_retries, retry_on_timeout=True,
+                                               connection_class=MeteredConnection)
+        return self._handler
+
+    @handler.setter
+    def handler(self, handler):
+        self._check_pid()
+        self._handler = handler
+
+    @property
+    def session(self):
+        """requests.Session with a pool of keep-alive connections for the direct REST calls to es"""
+        self._check_pid()
+        if self._session is None:
+            self._check_config()
+            retries = Retry(total=self.max_retries, backoff_factor=0.1, status_forcelist=(502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.maxsize, max_retries=retries)
+            self._session = Session()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def __getstate__(self):
+        """The connections are not pickled, they are re-created by the process unpickling the module"""
+        state = self.__dict__.copy()
+        state['_handler'] = None
+        state['_session'] = None
+        state['_pid'] = None
+        return state
+
+    @staticmethod
+    def _start_request():
+        """Reset the http metrics of the current thread and returns the start time of a request"""
+        _http_stats.time = 0.
+        _http_stats.bytes = 0
+        return time.time()
+
+    def _record_request(self, method, start, took=None, hits=None, template=None):
+        """Record the metrics of a request started with _start_request (check utilities/instrumentation.py)"""
+        self.recorder.record(method, (time.time() - start) * 1000, http_time=getattr(_http_stats, 'time', None),
+                             took=took, nbytes=getattr(_http_stats, 'bytes', None), hits=hits, template=template)
+        return
+
+    def map_queries(self, func, queries):
+        """
+        Apply 'func' to each item of 'queries' and return the list of outputs in the same order.
+        Requests are made one after the other (check ConcurrentSearchModule for the concurrent version).
+        """
+        return [func(query) for query in queries]
+
     def _load_json(self, jsonfile):
         """Load a json file as python dict"""
         with open(jsonfile) as f:
@@ -53,7 +313,7 @@ class SearchModule(object):
         """
         if verbose:
             print "GET %s -d '%s'" % (target_url, self.json.dumps(query))
-        r = get(target_url, data=self.json.dumps(query))
+        r = self.session.get(target_url, data=self.json.dumps(query), timeout=self.timeout)
         return self.json.loads(r.text)
 
     def _format_url(self, msd_id):
@@ -66,22 +326,90 @@ class SearchModule(object):
             msd_id
         )
 
+    def set_profile(self, shs_mode=False, filter_duplicates=False, dzr_map=False):
+        """
+        Compile the query builders of the module for an experiment profile
+        (check the profiles in the templates.py file).
+            eg. es.set_profile(**presets.shs_msd_no_dup)
+
+        New builders are created, so that the queries built concurrently with the previous profile are not affected.
+        """
+        profile = {'shs_mode': shs_mode, 'filter_duplicates': filter_duplicates, 'dzr_map': dzr_map}
+        self.title_builder = QueryBuilder(self.post_json, **profile)
+        self.query_string_builder = QueryBuilder(presets.query_string, **profile)
+        self.lyrics_builder = QueryBuilder(presets.more_like_this, **profile)
+        self.profile = profile
+        return
+
+    def reset_profile(self):
+        """Remove all the filters of the experiment profile from the queries"""
+        self.set_profile()
+        return
+
+    def _lyrics_builder(self, post_json):
+        """Returns the query builder for a more_like_this post_json template"""
+        if post_json is presets.more_like_this:
+            return self.lyrics_builder
+        return QueryBuilder(post_json, **self.profile)
+
+    def register_search_templates(self, profiles=None):
+        """
+        Register the query presets of the module (title template, query_string and more_like_this with a lyrics
+        text or with a stored document reference) as es stored search templates for each experiment profile.
+        Once registered, the search methods only send the template id and the query params
+        ({query, exclude_id, size, field}) to es instead of the full query DSL.
+            eg. es.register_search_templates()
+
+        Params :
+                profiles : {default : None} list of experiment profiles, if None all the profiles
+                    of templates.py (presets.profiles) and the current profile are registered
+
+        Output : set of the registered template ids
+
+        [NOTE]: The template ids are derived from the template sources, so a modified preset is registered as a
+        new template. The batched searches of stored templates use the _msearch/template endpoint (es >= 5.0).
+        """
+        profiles = list(profiles or presets.profiles.values()) + [self.profile]
+        for profile in profiles:
+            for template in [self.post_json, presets.query_string, presets.more_like_this]:
+                builder = QueryBuilder(template, **profile)
+                for like_doc, template_id in builder.template_ids.iteritems():
+                    if template_id not in self.stored_templates:
+                        self.handler.put_template(id=template_id, body={'template': builder.template_source(like_doc)})
+                        self.stored_templates.add(template_id)
+        return self.stored_templates
+
+    def _build_request(self, builder, query, exclude_id, size=100, field=None, like_doc=False):
+        """
+        Returns the search request of a query built by a QueryBuilder : a stored template request
+        {'id': template_id, 'params': {...}} if the template of the builder is registered in es,
+        a query DSL post json otherwise.
+        For a more_like_this builder with 'like_doc', the stored document of 'exclude_id' is liked instead of 'query'.
+        """
+        template_id = builder.template_ids.get(like_doc)
+        if exclude_id is not None and template_id in self.stored_templates:
+            params = {'exclude_id': exclude_id, 'size': size, 'field': field or builder.default_field}
+            if like_doc:
+                params.update({'index': self.config['index'], 'type': self.config['type']})
+            else:
+                params['query'] = query
+            return {'id': template_id, 'params': params}
+        if like_doc:
+            query = [{'_index': self.config['index'], '_type': self.config['type'], '_id': exclude_id}]
+        return builder.build(query, exclude_id=exclude_id, size=size, field=field)
+
+    @staticmethod
+    def _is_template_request(body):
+        return 'id' in body and 'params' in body
+
     def _format_query(self, query_str, msd_id, mode='simple_query', field='msd_title', size=100):
         """
-        Format POST json dict object with query_str and msd_id
+        Returns a new search request with query_str and msd_id for the current profile
+        (a stored template request if the templates are registered, check register_search_templates)
         """
-        if mode == 'simple_query':
-            self.post_json['query']['bool']['must'][0]['simple_query_string']['query'] = query_str
-            self.post_json['query']['bool']['must'][0]['simple_query_string']['fields'][0] = field
-            # we exclude the query id from the result
-            self.post_json['query']['bool']['must_not'][0]['query_string']['query'] = msd_id
-            self.post_json['size'] = size
         if mode == 'query_string':
-            self.post_json['query']['bool']['must'][0]['query_string']['query'] = query_str
-            # we exclude the query id from the result
-            self.post_json['query']['bool']['must_not'][0]['query_string']['query'] = msd_id
-            self.post_json['size'] = size
-        return self.post_json
+            return self._build_request(self.query_string_builder, query_str, msd_id, size=size)
+        return self._build_request(self.title_builder, query_str, msd_id, size=size, field=field)
 
     @staticmethod
     def _format_init_json(init_json, query_str, msd_id, field='msd_title', size=100):
@@ -106,6 +434,22 @@ class SearchModule(object):
         scores = [d['_score'] for d in response]
         return msd_ids, scores
 
+    def _format_response(self, response, out_mode='view'):
+        """
+        Format a search response as required by the 'out_mode' of the search methods
+
+        Input :
+                response : json response from the elasticsearch
+                out_mode : (string) Available modes (['eval', 'view'])
+        """
+        if out_mode == 'eval':
+            return self._parse_response_for_eval(response)
+
+        if out_mode == 'view':
+            return self._view_response(response)
+
+        return None
+
     def _view_response(self, response):
         """
         Aggregrate response as pandas dataframe to view response as tables in the ipython console
@@ -127,14 +471,10 @@ class SearchModule(object):
 
     def format_lyrics_post_json(self, body, lyrics, track_id, size, field='dzr_lyrics.content'):
         """
-        format post_json template for lyrics search with lyrics and msd_track-id
+        Returns a new post_json from the 'body' template for lyrics search with lyrics and msd_track-id
         """
-        self.post_json = body
-        self.post_json['query']['bool']['must'][0]['more_like_this']['like'] = lyrics
-        self.post_json['query']['bool']['must'][0]['more_like_this']['fields'][0] = field
         # we exclude the query id from the results
-        self.post_json['query']['bool']['must_not'][0]['query_string']['query'] = track_id
-        self.post_json['size'] = size
+        return self._build_request(self._lyrics_builder(body), lyrics, track_id, size=size, field=field)
 
     def limit_post_json_to_shs(self):
         """
@@ -142,23 +482,21 @@ class SearchModule(object):
         ie. limit search to 1 x 12960 from 1 x 1M
 
         """
-        if len(self.post_json['query']['bool']['must']) <= 1:  # mar: why this condition?
-            self.post_json['query']['bool']['must'].append({'exists': {'field': 'shs_id'}})
+        self.set_profile(**dict(self.profile, shs_mode=True))
 
     def limit_to_dzr_mapped_msd(self):
         """
         Limits search only on the songs have a respective mapping to the deezer_song_ids
         ie. limit search to 1 x ~83k
         """
-        self.post_json['query']['bool']['must'].append({'exists': {'field': 'dzr_song_title'}})
+        self.set_profile(**dict(self.profile, dzr_map=True))
 
     def add_remove_duplicates_filter(self):
         """
         Filter songs with field 'msd_is_duplicate_of' from the search
         and response using must_not exist method in the post-request
         """
-        if len(self.post_json['query']['bool']['must_not']) <= 1:  # mar: why this condition?
-            self.post_json['query']['bool']['must_not'].append({'exists': {'field': 'msd_is_duplicate_of'}})
+        self.set_profile(**dict(self.profile, filter_duplicates=True))
 
     @staticmethod
     def add_must_field_to_query_dsl(post_json, role_type='Composer', field='dzr_artists.role_name',
@@ -194,13 +532,101 @@ class SearchModule(object):
         else:
             return response['_source'][field]
 
+    def prefetch_fields(self, msd_ids, fields, chunk_size=1000):
+        """
+        Fetch the values of a list of fields for all the msd_ids using chunked multi-get (_mget) requests
+        and store them in the in-memory field cache which is checked first by get_field_info_from_id.
+        Only the requested fields are returned by es (source filtering).
+            eg. prefetch_fields(exp.query_ids, fields=['mxm_lyrics'])
+
+        Inputs :
+                msd_ids : list of msd track ids
+                fields : list of field names (eg. ['dzr_msd_title_clean', 'mxm_lyrics'])
+        Params :
+                chunk_size : (int) number of documents fetched in a single _mget request
+        """
+        for field in fields:
+            self.field_cache.setdefault(field, dict())
+
+        if self.cache is not None:
+            # only fetch the documents with at least one field missing from the response cache
+            missing_ids = list()
+            for msd_id in msd_ids:
+                found = False
+                for field in fields:
+                    found, value = self.cache.get_field(self.config['index'], msd_id, field)
+                    if not found:
+                        break
+                    self.field_cache[field][msd_id] = value
+                if not found:
+                    missing_ids.append(msd_id)
+            msd_ids = missing_ids
+
+        for start in range(0, len(msd_ids), chunk_size):
+            request_start = self._start_request()
+            res = self.handler.mget(body={'ids': list(msd_ids[start:start + chunk_size])},
+                                    index=self.config['index'], doc_type=self.config['type'], _source=fields)
+            self._record_request('mget', request_start, hits=len(res['docs']), template=','.join(fields))
+            values = list()
+            for doc in res['docs']:
+                for field in fields:
+                    if doc.get('found'):
+                        self.field_cache[field][doc['_id']] = self.parse_field_from_response(doc, field=field)
+                    else:
+                        self.field_cache[field][doc['_id']] = None
+                    values.append((doc['_id'], field, self.field_cache[field][doc['_id']]))
+            if self.cache is not None:
+                self.cache.put_fields(self.config['index'], values)
+        return
+
+    def clear_field_cache(self):
+        """Remove all the prefetched field values from the in-memory cache"""
+        self.field_cache = dict()
+        return
+
+    def collect_hit_fields(self, fields=None):
+        """
+        Store the values of a list of fields of the search hits (from the '_source' of the hits) in the in-memory
+        field cache, so that they can be read without any request to es (eg. the profile filter fields of the hits
+        of a superset run, check Experiments.run_superset_task). Set 'fields' to None to stop collecting them.
+            eg. collect_hit_fields(['shs_id', 'msd_is_duplicate_of', 'dzr_song_title'])
+        """
+        self.hit_fields = tuple(fields or [])
+        for field in self.hit_fields:
+            self.field_cache.setdefault(field, dict())
+        return
+
+    def _collect_hits(self, hits):
+        """Store the 'hit_fields' of the hits of a search response in the field cache and returns the hits"""
+        for field in self.hit_fields:
+            field_values = self.field_cache.setdefault(field, dict())
+            for hit in hits:
+                if '_source' in hit:
+                    field_values[hit['_id']] = self.parse_field_from_response(hit, field=field)
+        return hits
+
     def get_field_info_from_id(self, msd_id, field):
         """
         Retrieve info for a particular field associated to a msd_id in the es db
             eg. get_field_info_from_id(msd_id='TRWFERO128F425FE0D', field='dzr_lyrics.content') 
+
+        [NOTE]: values prefetched with prefetch_fields are returned without any request to es
         """
-        response = get(self._format_url(msd_id))
-        field_info = self.parse_field_from_response(response.json(), field=field)
+        if msd_id in self.field_cache.get(field, {}):
+            return self.field_cache[field][msd_id]
+        if self.cache is not None:
+            found, field_info = self.cache.get_field(self.config['index'], msd_id, field)
+            if found:
+                return field_info
+        start = time.time()
+        response = self.session.get(self._format_url(msd_id), timeout=self.timeout)
+        response_json = response.json()
+        self.recorder.record('get', (time.time() - start) * 1000,
+                             http_time=response.elapsed.total_seconds() * 1000, nbytes=len(response.content),
+                             hits=int(response_json.get('found', False)), template=field)
+        field_info = self.parse_field_from_response(response_json, field=field)
+        if self.cache is not None:
+            self.cache.put_field(self.config['index'], msd_id, field, field_info)
         return field_info
 
     def get_mxm_lyrics_by_id(self, track_id):
@@ -216,8 +642,7 @@ class SearchModule(object):
         Get preprocessed MSD title by MSD track id
         """
         # mar: the field "dzr_msd_title_clean" should not be a parameter (like in get_mxm_lyrics)
-        response = get(self._format_url(msd_id))
-        return self.parse_field_from_response(response.json(), field=field)
+        return self.get_field_info_from_id(msd_id=msd_id, field=field)
 
     def search_es(self, body):
         """
@@ -228,26 +653,223 @@ class SearchModule(object):
                 body : JSON post dict for elastic search 
                 (you can use the template jsons in the templates.py script)
                 eg : body = templates.simple_query_string
+                or a stored template request {'id': template_id, 'params': {...}} (check register_search_templates)
+
+        [NOTE]: If the module has a response cache, the cached response is returned when available
         """
-        res = self.handler.search(index=self.config["index"], body=body)
-        return res['hits']['hits']
+        if self.cache is not None:
+            hits = self.cache.get_search(self.config["index"], body)
+            if hits is not None:
+                return self._collect_hits(hits)
+        start = self._start_request()
+        if self._is_template_request(body):
+            res = self.handler.search_template(index=self.config["index"], body=body)
+        else:
+            res = self.handler.search(index=self.config["index"], body=body)
+        self._record_request('search', start, took=res.get('took'), hits=len(res['hits']['hits']),
+                             template=query_template_name(body))
+        if self.cache is not None:
+            self.cache.put_search(self.config["index"], body, res['hits']['hits'])
+        return self._collect_hits(res['hits']['hits'])
+
+    def msearch_es(self, bodies, batch_size=100):
+        """
+        Make a list of search requests to elasticsearch using the multi-search (_msearch) endpoint,
+        so that 'batch_size' searches are sent in a single round trip.
+
+        Input :
+                bodies : list of JSON post dicts for elastic search (same as the 'body' of search_es)
+                         or stored template requests {'id': template_id, 'params': {...}}
+        Params :
+                batch_size : (int) number of searches packed in a single _msearch request
+
+        Output : list of es response hits in the same order as 'bodies'
+
+        [NOTE]: If the module has a response cache, only the requests missing from the cache are sent to es
+        """
+        hits = [None] * len(bodies)
+        if self.cache is not None:
+            for index, body in enumerate(bodies):
+                hits[index] = self.cache.get_search(self.config["index"], body)
+        missing = [index for index, response in enumerate(hits) if response is None]
+
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            # the stored template requests and the query DSL requests go to different endpoints
+            for templated in [False, True]:
+                indexes = [index for index in batch if self._is_template_request(bodies[index]) == templated]
+                if indexes:
+                    for index, response in zip(indexes, self._msearch([bodies[index] for index in indexes],
+                                                                      templated)):
+                        hits[index] = response['hits']['hits']
+            if self.cache is not None:
+                self.cache.put_searches(self.config["index"], [(bodies[index], hits[index]) for index in batch])
+        for response in hits:
+            self._collect_hits(response)
+        return hits
+
+    def _msearch(self, bodies, templated=False):
+        """
+        Send a list of query DSL requests (_msearch endpoint) or stored template requests
+        (_msearch/template endpoint) in a single round trip and returns the list of responses
+        """
+        request = list()
+        for body in bodies:
+            request.append({'index': self.config["index"]})
+            request.append(body)
+        request_start = self._start_request()
+        if templated:
+            _, res = self.handler.transport.perform_request(
+                'POST', '/_msearch/template', body='\n'.join(json.dumps(line) for line in request) + '\n')
+        else:
+            res = self.handler.msearch(body=request)
+        for response in res['responses']:
+            if 'error' in response:
+                raise Exception("\n_msearch request failed : %s" % response['error'])
+        # es reports the 'took' of each search of the batch, they are run in parallel on the cluster
+        took = [response['took'] for response in res['responses'] if 'took' in response]
+        self._record_request('msearch', request_start, took=max(took) if took else None,
+                             hits=sum(len(response['hits']['hits']) for response in res['responses']),
+                             template=query_template_name(bodies[0]))
+        return res['responses']
+
+    def export_snapshot(self, path, fields, n_slices=4, page_size=1000, scroll='5m', query=None):
+        """
+        Stream all the documents of the index with a sliced scroll (one slice per parallel worker)
+        and write the values of the requested fields to a columnar snapshot (utilities/snapshot.py)
+        which can be memory-mapped back.
+            eg. es.export_snapshot('./snapshots/msd', fields=['msd_title', 'msd_artist_id', 'shs_id'])
+
+        Inputs :
+                path : path to the output snapshot directory
+                fields : list of field names to export
+        Params :
+                n_slices : (int) number of scroll slices fetched in parallel
+                    (sliced scroll requires es >= 5.0, use n_slices=1 with older clusters)
+                page_size : (int) number of documents per scroll page and slice
+                scroll : time to keep the scroll contexts alive between two pages
+                query : {default : None} query DSL clause to export only a subset of the index (match_all if None)
+
+        Output : IndexSnapshot instance
+        """
+        from multiprocessing.pool import ThreadPool
+
+        def scroll_slice(slice_id):
+            body = {'query': query or {'match_all': {}}, 'size': page_size, 'sort': ['_doc'], '_source': fields}
+            if n_slices > 1:
+                body['slice'] = {'id': slice_id, 'max': n_slices}
+            start = self._start_request()
+            res = self.handler.search(index=self.config['index'], doc_type=self.config['type'], body=body,
+                                      scroll=scroll)
+            self._record_request('scroll', start, took=res.get('took'), hits=len(res['hits']['hits']))
+            ids = list()
+            columns = dict((field, list()) for field in fields)
+            while res['hits']['hits']:
+                for doc in res['hits']['hits']:
+                    ids.append(doc['_id'])
+                    doc.setdefault('_source', dict())
+                    for field in fields:
+                        columns[field].append(self.parse_field_from_response(doc, field=field))
+                start = self._start_request()
+                res = self.handler.scroll(scroll_id=res['_scroll_id'], scroll=scroll)
+                self._record_request('scroll', start, took=res.get('took'), hits=len(res['hits']['hits']))
+            self.handler.clear_scroll(scroll_id=res['_scroll_id'])
+            return ids, columns
+
+        pool = ThreadPool(n_slices)
+        slices = pool.map(scroll_slice, range(n_slices), chunksize=1)
+        pool.close()
+
+        ids = [msd_id for slice_ids, _ in slices for msd_id in slice_ids]
+        columns = dict((field, [value for _, slice_columns in slices for value in slice_columns[field]])
+                       for field in fields)
+        return IndexSnapshot.write(path, ids, columns, meta={'index': self.config['index']})
 
     def search_by_exact_title(self, track_title, track_id, mode='simple_query', out_mode='view', size=100):
         """
         Search by track_title using simple_query_string method in the elasticsearch
         """
         res = self.search_es(self._format_query(query_str=track_title, msd_id=track_id, mode=mode, size=size))
+        return self._format_response(res, out_mode=out_mode)
 
-        # mar: because the following code is copy/pasted several times, it should be a function
-        # like return_results(res, out_mode)
-        if out_mode == 'eval':
-            msd_ids, scores = self._parse_response_for_eval(res)
-            return msd_ids, scores
+    def batch_search_by_exact_title(self, queries, mode='simple_query', field='msd_title', out_mode='eval',
+                                    batch_size=100, coalesce=False):
+        """
+        Batched version of search_by_exact_title using the multi-search endpoint of elasticsearch
 
-        if out_mode == 'view':
-            return self._view_response(res)
+        Inputs :
+                queries : list of (track_title, track_id, size) tuples where track_id is the msd_id
+                          excluded from the response of the query
+        Params :
+                mode : ['simple_query', 'query_string']
+                field : field on which the title is matched (eg. 'msd_title', 'dzr_msd_title_clean')
+                out_mode : (string) Available modes (['eval', 'view'])
+                batch_size : (int) number of queries sent in a single _msearch request
+                coalesce : {default : False} If set, the queries with the same title are sent once
+                    (check coalesced_search)
 
-        return None
+        Output : list of formatted responses (check the 'out_mode') in the same order as 'queries'
+        """
+        if coalesce:
+            responses = self.coalesced_search(queries, mode=mode, field=field, batch_size=batch_size)
+        else:
+            bodies = [self._format_query(query_str=title, msd_id=track_id, mode=mode, field=field, size=size)
+                      for title, track_id, size in queries]
+            responses = self.msearch_es(bodies, batch_size)
+        return [self._format_response(res, out_mode=out_mode) for res in responses]
+
+    @staticmethod
+    def _normalize_query(query_str):
+        """
+        Query string with its runs of whitespaces collapsed (same terms for the es analyzers),
+        None for a missing (None, NaN) or blank query string
+        """
+        if query_str is None or query_str != query_str:
+            return None
+        return u' '.join(unicode(query_str).split()) or None
+
+    def coalesced_search(self, queries, mode='simple_query', field='msd_title', batch_size=None):
+        """
+        Search a list of titles sending each distinct (whitespace normalized) title only once.
+        The shared request is made without the exclusion of the query msd_id and with one more hit than the
+        largest size of its queries, then the msd_id of each query is removed from the hits client-side.
+        As the 'must_not' clause of the exclusion doesn't change the scores, the responses are the same
+        as the ones of one request per query (with the query filters of the current profile).
+
+        Inputs :
+                queries : list of (track_title, track_id, size) tuples (check batch_search_by_exact_title)
+        Params :
+                mode : ['simple_query', 'query_string']
+                field : field on which the title is matched
+                batch_size : {default : None} If set, the distinct queries are sent by batches of 'batch_size'
+                    requests using the multi-search endpoint instead of one request per query
+
+        Output : list of es response hits in the same order as 'queries'
+
+        [NOTE]: The queries with a missing or blank title (eg. a song without cleaned title) are not coalesced,
+        each of them is sent as is with the exclusion of its msd_id (same request as without coalescing).
+        """
+        keys = [self._normalize_query(title) for title, _, _ in queries]
+        sizes = dict()
+        unique_keys = list()
+        for key, (_, _, size) in zip(keys, queries):
+            if key is None:
+                continue
+            if key not in sizes:
+                unique_keys.append(key)
+            sizes[key] = max(size, sizes.get(key, 0))
+        bodies = [self._format_query(query_str=key, msd_id=None, mode=mode, field=field, size=sizes[key] + 1)
+                  for key in unique_keys]
+        bodies += [self._format_query(query_str=title, msd_id=track_id, mode=mode, field=field, size=size)
+                   for key, (title, track_id, size) in zip(keys, queries) if key is None]
+        if batch_size:
+            responses = self.msearch_es(bodies, batch_size)
+        else:
+            responses = self.map_queries(self.search_es, bodies)
+        shared = dict(zip(unique_keys, responses[:len(unique_keys)]))
+        single = iter(responses[len(unique_keys):])
+        return [next(single) if key is None else [hit for hit in shared[key] if hit['_id'] != track_id][:size]
+                for key, (_, track_id, size) in zip(keys, queries)]
 
     def search_with_cleaned_title(self, track_id, out_mode='view', field="dzr_msd_title_clean", size=100):
         """
@@ -257,15 +879,25 @@ class SearchModule(object):
         track_title = self.get_cleaned_title_from_id(msd_id=track_id)
         res = self.search_es(self._format_query(query_str=track_title, msd_id=track_id, mode='simple_query',
                                                 field=field, size=size))
-        if out_mode == 'eval':
-            msd_ids, scores = self._parse_response_for_eval(res)
-            return msd_ids, scores
+        return self._format_response(res, out_mode=out_mode)
 
-        if out_mode == 'view':
-            return self._view_response(res)
-
-        return None
+    def batch_search_with_cleaned_title(self, track_ids, size=100, out_mode='eval', field="dzr_msd_title_clean",
+                                        batch_size=100, coalesce=False):
+        """
+        Batched version of search_with_cleaned_title using the multi-search endpoint of elasticsearch
 
+        Inputs :
+                track_ids : list of query msd track ids
+        Params :
+                size : (int) size of the required response from es_db
+                out_mode : (string) Available modes (['eval', 'view'])
+                batch_size : (int) number of queries sent in a single _msearch request
+                coalesce : {default : False} If set, the queries with the same cleaned title are sent once
+                    (check coalesced_search)
+        """
+        queries = [(self.get_cleaned_title_from_id(msd_id=track_id), track_id, size) for track_id in track_ids]
+        return self.batch_search_by_exact_title(queries, field=field, out_mode=out_mode, batch_size=batch_size,
+                                                coalesce=coalesce)
 
     def search_by_mxm_lyrics(self, post_json, msd_track_id, out_mode='eval', size=100):
         """
@@ -289,15 +921,190 @@ class SearchModule(object):
         if not lyrics:
             return None, None
 
-        self.format_lyrics_post_json(body=post_json, track_id=msd_track_id, lyrics=lyrics,
-                                     size=size, field='mxm_lyrics')
-        res = self.search_es(body=self.post_json)
+        res = self.search_es(body=self.format_lyrics_post_json(body=post_json, track_id=msd_track_id, lyrics=lyrics,
+                                                               size=size, field='mxm_lyrics'))
+        return self._format_response(res, out_mode=out_mode)
 
-        if out_mode == 'eval':
-            msd_ids, scores = self._parse_response_for_eval(res)
-            return msd_ids, scores
+    def batch_search_by_mxm_lyrics(self, post_json, msd_track_ids, out_mode='eval', size=100, batch_size=100):
+        """
+        Batched version of search_by_mxm_lyrics using the multi-search endpoint of elasticsearch
 
-        if out_mode == 'view':
-            return self._view_response(res)
+        Inputs:
+                post_json : (dict) Query_DSL json template for the es_query (eg. presets.more_like_lyrics)
+                msd_track_ids : list of MSD track identifiers of the query files
 
-        return None
+            Params :
+                    out_mode : (string) Available modes (['eval', 'view'])
+                    size : (int) size of the required response from es_db
+                    batch_size : (int) number of queries sent in a single _msearch request
+
+        Output : list of formatted responses in the same order as 'msd_track_ids'
+                 (a tuple of (None, None) for the tracks without "mxm_lyrics")
+        """
+        bodies = list()
+        has_lyrics = list()
+        for msd_track_id in msd_track_ids:
+            lyrics = self.get_mxm_lyrics_by_id(msd_track_id)
+            has_lyrics.append(bool(lyrics))
+            if lyrics:
+                bodies.append(self.format_lyrics_post_json(body=post_json, track_id=msd_track_id, lyrics=lyrics,
+                                                           size=size, field='mxm_lyrics'))
+
+        responses = iter(self.msearch_es(bodies, batch_size))
+        return [self._format_response(next(responses), out_mode=out_mode) if found else (None, None)
+                for found in has_lyrics]
+
+    def _lyrics_like_doc_query(self, post_json, msd_track_id, size=100, field='mxm_lyrics'):
+        """
+        Returns a more_like_this post json referencing the lyrics of the stored document of 'msd_track_id'
+        (like : [{_index, _type, _id}]) instead of the lyrics text, so that es reads the lyrics itself
+        and the lyrics never travel over the network.
+        A document without lyrics has no terms to search for and gets an empty response.
+        """
+        return self._build_request(self._lyrics_builder(post_json), None, msd_track_id, size=size, field=field,
+                                   like_doc=True)
+
+    def search_by_dzr_lyrics(self, post_json, msd_track_id, out_mode='eval', size=100):
+        """
+        Search the es_db by the deezer lyrics ('dzr_lyrics.content') of a msd_track_id
+        with a more_like_this query referencing the stored document
+
+        Inputs:
+                post_json : (dict) Query_DSL json template for the es_query (eg. presets.more_like_this)
+                msd_track_id : (string) MSD track identifier of the query file
+
+            Params :
+                    out_mode : (string) Available modes (['eval', 'view'])
+                    size : (int) size of the required response from es_db
+        """
+        return self.search_by_lyrics_doc(post_json, msd_track_id, field='dzr_lyrics.content', out_mode=out_mode,
+                                         size=size)
+
+    def search_by_lyrics_doc(self, post_json, msd_track_id, field='mxm_lyrics', out_mode='eval', size=100):
+        """
+        Search the es_db by the lyrics of a msd_track_id with a more_like_this query referencing the stored
+        document (check _lyrics_like_doc_query), ie. the lyrics search of search_title_and_lyrics
+
+        Inputs:
+                post_json : (dict) Query_DSL json template for the es_query (eg. presets.more_like_this)
+                msd_track_id : (string) MSD track identifier of the query file
+
+            Params :
+                    field : (string) field of the lyrics (eg. 'mxm_lyrics', 'dzr_lyrics.content')
+                    out_mode : (string) Available modes (['eval', 'view'])
+                    size : (int) size of the required response from es_db
+        """
+        res = self.search_es(self._lyrics_like_doc_query(post_json, msd_track_id, size=size, field=field))
+        return self._format_response(res, out_mode=out_mode)
+
+    def batch_search_by_lyrics_doc(self, post_json, msd_track_ids, field='mxm_lyrics', out_mode='eval', size=100,
+                                   batch_size=100):
+        """
+        Batched version of search_by_lyrics_doc using the multi-search endpoint of elasticsearch
+
+        Output : list of formatted responses in the same order as 'msd_track_ids'
+                 (an empty response for the tracks without lyrics)
+        """
+        bodies = [self._lyrics_like_doc_query(post_json, msd_track_id, size=size, field=field)
+                  for msd_track_id in msd_track_ids]
+        return [self._format_response(res, out_mode=out_mode) for res in self.msearch_es(bodies, batch_size)]
+
+    def search_title_and_lyrics(self, track_title, track_id, lyrics_field='mxm_lyrics', title_field='msd_title',
+                                post_json=presets.more_like_this, out_mode='view', size=100):
+        """
+        Fetch the title search response and the lyrics search response of a query song
+        in a single _msearch round trip (check batch_search_title_and_lyrics)
+
+        Output : tuple of formatted responses (title_response, lyrics_response)
+        """
+        return self.batch_search_title_and_lyrics([(track_title, track_id)], lyrics_field=lyrics_field,
+                                                  title_field=title_field, post_json=post_json,
+                                                  out_mode=out_mode, size=size, batch_size=1)[0]
+
+    def batch_search_title_and_lyrics(self, queries, lyrics_field='mxm_lyrics', title_field='msd_title',
+                                      post_json=presets.more_like_this, out_mode='view', size=100, batch_size=100):
+        """
+        Fetch the title and lyrics search responses of a list of query songs using the multi-search endpoint.
+        The title search and the lyrics search of a query are always sent in the same _msearch request and
+        the lyrics search references the stored document of the query song (check _lyrics_like_doc_query),
+        so that there is no request to fetch the lyrics of the query songs beforehand.
+
+        Inputs :
+                queries : list of (track_title, track_id) tuples where track_id is the msd_id of the query song
+        Params :
+                lyrics_field : field of the lyrics (eg. 'mxm_lyrics', 'dzr_lyrics.content')
+                title_field : field on which the title is matched (eg. 'msd_title', 'dzr_msd_title_clean')
+                post_json : (dict) more_like_this Query_DSL template of the lyrics search
+                out_mode : (string) Available modes (['eval', 'view'])
+                size : (int) size of the required responses from es_db
+                batch_size : (int) number of query songs sent in a single _msearch request
+
+        Output : list of (title_response, lyrics_response) tuples in the same order as 'queries'
+                 (the lyrics response is empty for the songs without lyrics)
+        """
+        bodies = list()
+        for track_title, track_id in queries:
+            bodies.append(self._format_query(query_str=track_title, msd_id=track_id, field=title_field, size=size))
+            bodies.append(self._lyrics_like_doc_query(post_json, track_id, size=size, field=lyrics_field))
+        responses = [self._format_response(res, out_mode=out_mode) for res in self.msearch_es(bodies, 2 * batch_size)]
+        return zip(responses[0::2], responses[1::2])
+
+
+class ConcurrentSearchModule(SearchModule):
+    """
+    SearchModule which runs the per-query search chains of the experiments concurrently
+    with a bounded number of requests in flight.
+
+    Every query builds its own post json from the immutable query builders of the module, so that the
+    per-query methods can be called from several threads. The profile (set_profile) has to be set
+    before calling map_queries.
+
+    Usage:
+        es = ConcurrentSearchModule(presets.uri_config, max_in_flight=16)
+        exp = Experiments(es, './data/train_shs.csv', presets.shs_msd)
+        results = exp.run_mxm_lyrics_search_task(size=100)
+    """
+    from multiprocessing.pool import ThreadPool
+
+    def __init__(self, uri_config, query_json=None, timeout=30, max_in_flight=16, max_retries=3, cache=None,
+                 recorder=None):
+        """
+        Init params:
+                    uri_config : uri_config dictionary specifying the host and port of es db.
+                                (check 'uri_config' in the templates.py file)
+                    query_json : {default : None}
+                    timeout : {default : 30} timeout of the es requests in seconds
+                    max_in_flight : {default : 16} maximum number of queries processed concurrently
+                    max_retries : {default : 3} number of retries of a request on connection errors and timeouts
+                    cache : {default : None} ResponseCache instance (utilities/response_cache.py)
+                    recorder : {default : None} RequestRecorder instance (utilities/instrumentation.py)
+        """
+        SearchModule.__init__(self, uri_config, query_json=query_json, timeout=timeout, maxsize=max_in_flight,
+                              max_retries=max_retries, cache=cache, recorder=recorder)
+        self.max_in_flight = max_in_flight
+        self._pool = None
+        return
+
+    def __getstate__(self):
+        state = SearchModule.__getstate__(self)
+        state['_pool'] = None
+        return state
+
+    def map_queries(self, func, queries):
+        """
+        Apply 'func' to each item of 'queries' using at most 'max_in_flight' concurrent workers.
+        The outputs are returned in the same order as 'queries' whatever the order of completion.
+        """
+        if self._pool is None or self._pid != os.getpid():
+            # the worker threads are not inherited by a forked process
+            self._pool = self.ThreadPool(self.max_in_flight)
+            self._check_pid()
+        return self._pool.map(func, list(queries), chunksize=1)
+
+    def close(self):
+        """Terminate the worker threads"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        return
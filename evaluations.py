@@ -12,6 +12,7 @@ R&D Intern
 from joblib import Parallel, delayed
 from es_search import SearchModule
 from experiments import Experiments
+from utilities.result_store import ResultStore
 from utils import log
 import templates as presets
 import argparse
@@ -20,8 +21,190 @@ import argparse
 LOG_FILE = './logs/evaluations.log'
 LOGGER = log(LOG_FILE)
 
+# run_*_task method of the Experiments class and its parameters for each evaluation method
+TASKS = {
+    "msd_title": ('run_song_title_match_task', {}),
+    "pre-msd_title": ('run_cleaned_song_title_task', {}),
+    "mxm_lyrics": ('run_mxm_lyrics_search_task', {'post_json': presets.more_like_this}),
+    "title_mxm_lyrics": ('run_rerank_title_with_mxm_lyrics_task', {'with_cleaned': False}),
+    "pre-title_mxm_lyrics": ('run_rerank_title_with_mxm_lyrics_task', {'with_cleaned': True})
+}
+
+# retrieval stages of the task graph (check run_task_graph) : run_*_task method and its parameters
+RETRIEVALS = {
+    "title": ('run_song_title_match_task', {}),
+    "cleaned_title": ('run_cleaned_song_title_task', {}),
+    "mxm_lyrics": ('run_mxm_lyrics_search_task', {'post_json': presets.more_like_this}),
+    # lyrics searches of run_rerank_title_with_mxm_lyrics_task ('like' the stored document of the query song)
+    "mxm_lyrics_doc": ('run_mxm_lyrics_search_task', {'post_json': presets.more_like_this, 'like_doc': True})
+}
+
+# retrieval stages of each evaluation method, the title response of a method with two stages
+# is reranked by its lyrics response (Experiments.rerank_title_by_lyrics_results)
+METHOD_STAGES = {
+    "msd_title": ['title'],
+    "pre-msd_title": ['cleaned_title'],
+    "mxm_lyrics": ['mxm_lyrics'],
+    "title_mxm_lyrics": ['title', 'mxm_lyrics_doc'],
+    "pre-title_mxm_lyrics": ['cleaned_title', 'mxm_lyrics_doc']
+}
+
+# SearchModule and Experiments instances of a worker process, reused by the shards it processes
+_worker_state = dict()
+
+
+def _worker_experiments(shs_csv, profile):
+    """Experiments instance of a dataset and profile in the current process (results as ResultStore)"""
+    if 'es' not in _worker_state:
+        # each worker process has its own pooled es client
+        _worker_state['es'] = SearchModule(presets.uri_config)
+    key = (shs_csv, tuple(sorted(profile.items())))
+    if key not in _worker_state:
+        _worker_state[key] = Experiments(_worker_state['es'], shs_csv, profile, results_format='store')
+    return _worker_state[key]
+
+
+def _run_task_shard(shs_csv, profile, task, task_params, start, stop):
+    """Run a task on the query songs [start:stop] of a dataset in a worker process and return a ResultStore"""
+    exp = _worker_experiments(shs_csv, profile)
+    exp.select_queries(start, stop)
+    return getattr(exp, task)(verbose=False, **task_params)
+
+
+def run_sharded_task(exp, shs_csv, profile, task, n_workers=-1, shard_size=1000, **task_params):
+    """
+    Run a task of the Experiments class with its query songs split into shards of 'shard_size' songs
+    processed by a pool of 'n_workers' processes (each one with its own SearchModule instance)
+
+    :param exp: Experiments instance of the dataset, the results are returned in its 'results_format'
+    :param shs_csv: path to the csv file of the dataset of 'exp'
+    :param profile: experiment profile of 'exp' (check templates.py)
+    :param task: name of the run_*_task method (eg. 'run_song_title_match_task')
+    :param n_workers: {default : -1} number of worker processes (-1 for one per cpu core)
+    :param shard_size: {default : 1000} number of query songs per shard
+    :param task_params: parameters of the task method (eg. size=100, batch_size=200)
+    :return: results of the task in the order of the query songs of the dataset
+    """
+    n_queries = len(exp.query_ids)
+    shards = [(start, min(start + shard_size, n_queries)) for start in range(0, n_queries, shard_size)]
+    LOGGER.info("\n Running %s on %s query songs split into %s shards with %s workers"
+                % (task, n_queries, len(shards), n_workers))
+    stores = Parallel(n_jobs=n_workers, verbose=1)(
+        delayed(_run_task_shard)(shs_csv, profile, task, task_params, start, stop) for start, stop in shards)
+    # the shards are returned in the order of submission
+    results = ResultStore.concat(stores)
+    if exp.results_format == 'store':
+        return results
+    return results.to_dataframe()
+
+
+def _run_task(exp, shs_csv, profile, method, size, n_workers=None, shard_size=1000):
+    """Run the task of an evaluation method, sharded across 'n_workers' processes if set"""
+    if method not in TASKS:
+        raise Exception("\nInvalid 'method' parameter for the experiment ! ")
+    task, task_params = TASKS[method]
+    if n_workers:
+        return run_sharded_task(exp, shs_csv, profile, task, n_workers=n_workers, shard_size=shard_size,
+                                size=size, **task_params)
+    return getattr(exp, task)(size=size, **task_params)
+
+
+def build_task_graph(methods):
+    """
+    Dependency graph of the evaluation methods {node: [dependencies]} where a node is a tuple (kind, name)
+        ('retrieval', stage) - es searches of a retrieval stage (check RETRIEVALS), shared by all the methods
+                               which need it
+        ('rerank', method) - rerank of the title stage of a method by its lyrics stage (no es request)
+        ('metrics', method) - evaluation of the response of a method
+    """
+    graph = dict()
+    for method in methods:
+        if method not in METHOD_STAGES:
+            raise Exception("\nInvalid 'method' parameter for the experiment ! ")
+        stages = [('retrieval', stage) for stage in METHOD_STAGES[method]]
+        for stage in stages:
+            graph[stage] = []
+        if len(stages) > 1:
+            graph[('rerank', method)] = stages
+            graph[('metrics', method)] = [('rerank', method)]
+        else:
+            graph[('metrics', method)] = stages
+    return graph
+
+
+def _run_node(shs_csv, profile, node, inputs, size, n_workers=None, shard_size=1000, stats_file=None):
+    """Run a node of the task graph on the outputs 'inputs' of its dependencies and return its output"""
+    kind, name = node
+    exp = _worker_experiments(shs_csv, profile)
+    # the process may have run a shard of a sharded task before
+    exp.select_queries()
+    if kind == 'retrieval':
+        task, task_params = RETRIEVALS[name]
+        if n_workers:
+            return run_sharded_task(exp, shs_csv, profile, task, n_workers=n_workers, shard_size=shard_size,
+                                    size=size, **task_params)
+        exp.es.recorder.reset()
+        results = getattr(exp, task)(size=size, verbose=False, **task_params)
+        if stats_file:
+            exp.dump_request_stats(stats_file % name)
+        return results
+    if kind == 'rerank':
+        return exp.rerank_title_by_lyrics_results(*inputs)
+    return exp.mean_average_precision(inputs[0])
+
+
+def run_task_graph(shs_csv, profile, methods, size, n_jobs=-1, n_workers=None, shard_size=1000, stats_file=None):
+    """
+    Run the evaluation methods of a dataset as a graph of tasks (check build_task_graph) where each retrieval stage
+    (title, cleaned title and lyrics searches) is run once and its response is fed to all the methods which need it,
+    eg. the five methods of automate_online_evals run four retrieval stages instead of seven searches per query song.
+    The rerank methods share the lyrics stage of run_rerank_title_with_mxm_lyrics_task ('mxm_lyrics_doc'), which is
+    not the text more_like_this of the mxm_lyrics method, so that each method gets the MAP of its own task.
+    The nodes are run by waves of independent nodes in parallel.
+
+    :param shs_csv: path to the csv file of the dataset
+    :param profile: experiment profile (check templates.py)
+    :param methods: list of evaluation methods (check METHOD_STAGES)
+    :param size: Required prune size of the results
+    :param n_jobs: {default : -1} number of processes running the independent nodes of a wave (-1 for one per cpu core)
+    :param n_workers: {default : None} If set, the nodes are run one after the other and the query songs
+        of each retrieval stage are split into shards of 'shard_size' songs processed by 'n_workers' processes
+    :param stats_file: {default : None} path template (with a '%s' for the stage) of the request stats json
+        of each retrieval stage (not dumped for sharded stages)
+    :return: dict {method: Mean Average Precision}
+    """
+    graph = build_task_graph(methods)
+    outputs = dict()
+    while len(outputs) < len(graph):
+        wave = [node for node in sorted(graph) if node not in outputs and all(dep in outputs for dep in graph[node])]
+        LOGGER.info("\n Running the task graph nodes %s" % wave)
+        args = [(shs_csv, profile, node, [outputs[dep] for dep in graph[node]], size) for node in wave]
+        if n_workers:
+            results = [_run_node(*arg, n_workers=n_workers, shard_size=shard_size) for arg in args]
+        else:
+            results = Parallel(n_jobs=n_jobs, verbose=1)(delayed(_run_node)(*arg, stats_file=stats_file)
+                                                         for arg in args)
+        outputs.update(zip(wave, results))
+        # release the responses which are not needed by the remaining nodes
+        for node in outputs:
+            if node[0] != 'metrics' and all(dependent in outputs for dependent in graph if node in graph[dependent]):
+                outputs[node] = None
+    return dict((method, outputs[('metrics', method)]) for method in methods)
+
+
+def _select_profile(with_duplicates, mode="msd"):
+    """Experiment profile of a mode ('msd' or 'shs') with or without the msd official duplicates"""
+    if mode == "msd":
+        if with_duplicates:
+            return presets.shs_msd
+        return presets.shs_msd_no_dup
+    elif mode == "shs":
+        return presets.shs_shs
+    raise Exception("\nInvalid 'mode' parameter ... ")
+
 
-def shs_train_set_evals(size, method="msd_title", with_duplicates=True, mode="msd"):
+def shs_train_set_evals(size, method="msd_title", with_duplicates=True, mode="msd", n_workers=None,
+                        shard_size=1000):
     """
     :param size: Required prune size of the results
     :param method: (string type) {default:"msd_title"}
@@ -30,55 +213,29 @@ def shs_train_set_evals(size, method="msd_title", with_duplicates=True, mode="ms
     :param with_duplicates: (boolean) {default:True} include
         or exclude MSD official duplicate tracks from the experiments
     :param mode: 'msd' or 'shs'
+    :param n_workers: {default : None} If set, the query songs of the task are split into shards
+        of 'shard_size' songs processed by a pool of 'n_workers' processes (check run_sharded_task)
     """
 
     es = SearchModule(presets.uri_config)
+    shs_csv = './data/train_shs.csv'
 
-    if mode == "msd":
-        if with_duplicates:
-            exp = Experiments(es, './data/train_shs.csv', presets.shs_msd)
-        else:
-            exp = Experiments(es, './data/train_shs.csv', presets.shs_msd_no_dup)
-    elif mode == "shs":
-        exp = Experiments(es, './data/train_shs.csv', presets.shs_shs)
-    else:
-        raise Exception("\nInvalid 'mode' parameter ... ")
-
-    if method == "msd_title":
-        LOGGER.info("\n%s with size %s, duplicates=%s and msd_mode=%s" %
-                    (method, size, with_duplicates, mode))
-        results = exp.run_song_title_match_task(size=size)
-
-    elif method == "pre-msd_title":
-        LOGGER.info("\n%s with size %s, duplicates=%s and msd_mode=%s" %
-                    (method, size, with_duplicates, mode))
-        results = exp.run_cleaned_song_title_task(size=size)
-
-    elif method == "mxm_lyrics":
-        LOGGER.info("\n%s with size %s, duplicates=%s and msd_mode=%s" %
-                    (method, size, with_duplicates, mode))
-        results = exp.run_mxm_lyrics_search_task(presets.more_like_this, size=size)
-
-    elif method == "title_mxm_lyrics":
-        LOGGER.info("\n%s with size %s, duplicates=%s and msd_mode=%s" %
-                    (method, size, with_duplicates, mode))
-        results = exp.run_rerank_title_with_mxm_lyrics_task(size=size, with_cleaned=False)
-
-    elif method == "pre-title_mxm_lyrics":
-        LOGGER.info("\n%s with size %s, duplicates=%s and msd_mode=%s" %
-                    (method, size, with_duplicates, mode))
-        results = exp.run_rerank_title_with_mxm_lyrics_task(size=size, with_cleaned=True)
-
-    else:
-        raise Exception("\nInvalid 'method' parameter....")
+    profile = _select_profile(with_duplicates, mode)
+    exp = Experiments(es, shs_csv, profile)
+
+    LOGGER.info("\n%s with size %s, duplicates=%s and msd_mode=%s" %
+                (method, size, with_duplicates, mode))
+    results = _run_task(exp, shs_csv, profile, method, size, n_workers=n_workers, shard_size=shard_size)
 
     mean_avg_precision = exp.mean_average_precision(results)
     LOGGER.info("\n Mean Average Precision (MAP) = %s" % mean_avg_precision)
+    if not n_workers:
+        exp.dump_request_stats('./logs/request_stats_train_%s_%s_%s.json' % (method, mode, size))
 
     return
 
 
-def shs_test_set_evals(size, method="msd_title", with_duplicates=True):
+def shs_test_set_evals(size, method="msd_title", with_duplicates=True, n_workers=None, shard_size=1000):
     """
     :param size: Required prune size of the results
     :param method: (string type) {default:"msd_title"}
@@ -86,48 +243,32 @@ def shs_test_set_evals(size, method="msd_title", with_duplicates=True):
         ["msd_title", "pre-msd_title", "mxm_lyrics", "title_mxm_lyrics", "pre-title_mxm_lyrics"]
     :param with_duplicates: (boolean) {default:True} include
         or exclude MSD official duplicate tracks from the experiments
+    :param n_workers: {default : None} If set, the query songs of the task are split into shards
+        of 'shard_size' songs processed by a pool of 'n_workers' processes (check run_sharded_task)
     :return:
     """
 
     es = SearchModule(presets.uri_config)
+    shs_csv = './data/test_shs.csv'
 
-    if with_duplicates:
-        exp = Experiments(es, './data/test_shs.csv', presets.shs_msd)
-    else:
-        exp = Experiments(es, './data/test_shs.csv', presets.shs_msd_no_dup)
-
-    if method == "msd_title":
-        LOGGER.info("\n%s with size %s and duplicates=%s " % (method, size, with_duplicates))
-        results = exp.run_song_title_match_task(size=size)
-
-    elif method == "pre-msd_title":
-        LOGGER.info("\n%s with size %s and duplicates=%s" % (method, size, with_duplicates))
-        results = exp.run_cleaned_song_title_task(size=size)
-
-    elif method == "mxm_lyrics":
-        LOGGER.info("\n%s with size %s and duplicates=%s" % (method, size, with_duplicates))
-        results = exp.run_mxm_lyrics_search_task(presets.more_like_this, size=size)
+    profile = _select_profile(with_duplicates)
+    exp = Experiments(es, shs_csv, profile)
 
-    elif method == "title_mxm_lyrics":
-        LOGGER.info("\n%s with size %s and duplicates=%s" % (method, size, with_duplicates))
-        results = exp.run_rerank_title_with_mxm_lyrics_task(size=size, with_cleaned=False)
-
-    elif method == "pre-title_mxm_lyrics":
-        LOGGER.info("\n%s with size %s and duplicates=%s" % (method, size, with_duplicates))
-        results = exp.run_rerank_title_with_mxm_lyrics_task(size=size, with_cleaned=True)
-
-    else:
-        raise Exception("\nInvalid 'method' parameter for the experiment ! ")
+    LOGGER.info("\n%s with size %s and duplicates=%s " % (method, size, with_duplicates))
+    results = _run_task(exp, shs_csv, profile, method, size, n_workers=n_workers, shard_size=shard_size)
 
     mean_avg_precision = exp.mean_average_precision(results)
     LOGGER.info("\n Mean Average Precision (MAP) = %s" %mean_avg_precision)
+    if not n_workers:
+        exp.dump_request_stats('./logs/request_stats_test_%s_%s.json' % (method, size))
 
     return
 
 
 def automate_online_evals(mode, n_threads=-1, exp_mode="msd", is_duplicates=False, size=100,
                           methods=["msd_title", "pre-msd_title", "mxm_lyrics",
-                                   "title_mxm_lyrics", "pre-title_mxm_lyrics"]):
+                                   "title_mxm_lyrics", "pre-title_mxm_lyrics"], n_workers=None, shard_size=1000,
+                          share_retrievals=True):
     """
 
     Run the paralleled automated evaluation tasks as per the chosen requirements from the parameters
@@ -140,23 +281,53 @@ def automate_online_evals(mode, n_threads=-1, exp_mode="msd", is_duplicates=Fals
     :param methods: Choose a list of methods to compute in the automated process
         available methods are ["msd_title", "pre-msd_title",
         "mxm_lyrics", "title_mxm_lyrics", "pre-title_mxm_lyrics"]
+    :param n_workers: {default : None} If set, the methods are run one after the other and the query songs
+        of each method are split into shards of 'shard_size' songs processed by 'n_workers' processes
+        instead of running the methods in parallel
+    :param share_retrievals: {default : True} If set, the methods are run as a task graph where the title,
+        cleaned title and lyrics searches are run once and shared by the methods (check run_task_graph),
+        otherwise each method runs its own searches
 
     """
     LOGGER.info("\n ======== Automated online experiments on shs_ %s "
                 "with exp_mode %s and duplicates %s size %s ======= "
                 % (mode, exp_mode, is_duplicates, size))
 
+    if share_retrievals:
+        if mode == "test":
+            shs_csv, profile = './data/test_shs.csv', _select_profile(is_duplicates)
+            stats_file = './logs/request_stats_test_%%s_%s.json' % size
+        elif mode == "train":
+            shs_csv, profile = './data/train_shs.csv', _select_profile(is_duplicates, exp_mode)
+            stats_file = './logs/request_stats_train_%%s_%s_%s.json' % (exp_mode, size)
+        else:
+            raise Exception("\nInvalid 'mode' parameter ... ")
+        scores = run_task_graph(shs_csv, profile, methods, size, n_jobs=n_threads, n_workers=n_workers,
+                                shard_size=shard_size, stats_file=stats_file)
+        for method in methods:
+            LOGGER.info("\n%s with size %s : Mean Average Precision (MAP) = %s" % (method, size, scores[method]))
+        LOGGER.info("\n ===== Process finished successfully... ===== ")
+        return scores
+
     sizes = [size for i in range(len(methods))]
     duplicates = [is_duplicates for i in range(len(methods))]
 
     if mode == "test":
         args = zip(sizes, methods, duplicates)
-        Parallel(n_jobs=n_threads, verbose=1)(map(delayed(shs_test_set_evals), args))
+        if n_workers:
+            for arg in args:
+                shs_test_set_evals(*arg, n_workers=n_workers, shard_size=shard_size)
+        else:
+            Parallel(n_jobs=n_threads, verbose=1)(delayed(shs_test_set_evals)(*arg) for arg in args)
 
     if mode == "train":
         exp_modes = [exp_mode for i in range(len(methods))]
         args = zip(sizes, methods, duplicates, exp_modes)
-        Parallel(n_jobs=n_threads, verbose=1)(map(delayed(shs_train_set_evals), args))
+        if n_workers:
+            for arg in args:
+                shs_train_set_evals(*arg, n_workers=n_workers, shard_size=shard_size)
+        else:
+            Parallel(n_jobs=n_threads, verbose=1)(delayed(shs_train_set_evals)(*arg) for arg in args)
 
     LOGGER.info("\n ===== Process finished successfully... ===== ")
 
@@ -179,12 +350,20 @@ if __name__ == '__main__':
                         help="choose whether you want to exclude msd official duplicates song from the experiments")
     parser.add_argument("-s", action="store", default=100,
                         help="required prune size for the results")
+    parser.add_argument("-w", action="store", default=0,
+                        help="number of worker processes of each method (0 to run the methods in parallel instead)")
+    parser.add_argument("-c", action="store", default=1000,
+                        help="number of query songs per shard of the worker processes")
+    parser.add_argument("-r", action="store", default=1,
+                        help="share the title and lyrics searches between the methods (0 to run each method alone)")
 
     args = parser.parse_args()
 
     d = bool(args.d)
     methods = ["msd_title", "pre-msd_title", "mxm_lyrics", "title_mxm_lyrics", "pre-title_mxm_lyrics"]
 
-    automate_online_evals(mode=args.m, n_threads=args.t, exp_mode=args.e, is_duplicates=d, size=args.s, methods=methods)
+    automate_online_evals(mode=args.m, n_threads=int(args.t), exp_mode=args.e, is_duplicates=d, size=int(args.s),
+                          methods=methods, n_workers=int(args.w), shard_size=int(args.c),
+                          share_retrievals=bool(int(args.r)))
 
     print "\n ...Done..."
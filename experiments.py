@@ -10,6 +10,12 @@ R&D Intern
 """
 
 from utils import log, timeit
+from utilities.metrics import RankingMetrics
+from utilities.clique_index import CliqueIndex
+from utilities.result_store import ResultStore
+from utilities.checkpoint import ResultCheckpoint
+from utilities.profiles import FLAG_FIELDS, loosest_profile, encode_flags, derive_profile
+from utilities import rerank
 import templates as presets
 import sys
 import os
@@ -44,9 +50,10 @@ class Experiments(object):
 
     import pandas as pd
     import numpy as np
+    import hashlib
     import time
 
-    def __init__(self, search_class, shs_csv, profile=None):
+    def __init__(self, search_class, shs_csv, profile=None, results_format='dataframe'):
         """
         Init parameters
 
@@ -63,11 +70,23 @@ class Experiments(object):
             }
 
             NOTE : a set of profile templates can be found inside the templates.py file.
-        """
+        :param results_format: {default: 'dataframe'} Available formats (['dataframe', 'store'])
+            'dataframe' - the run_*_task methods return a pandas dataframe indexed by query msd_id
+                          with the lists of response 'id' and 'score'
+            'store' - the run_*_task methods return a compact ResultStore (utilities/result_store.py)
+            The evaluation metrics accept both formats.
+        """
+        if results_format not in ['dataframe', 'store']:
+            raise Exception("\nInvalid 'results_format' parameter %s" % results_format)
+        self.results_format = results_format
         self.es = search_class
         self.dataset = self._load_csv_as_df(shs_csv)
         self.query_ids = self.dataset.msd_id.values.tolist()
         self.query_titles = self.dataset.title.values.tolist()
+        # integer encoded msd_ids and cliques of the dataset for the evaluation metrics
+        self.metrics = RankingMetrics(self.dataset.msd_id.values, self.dataset.work_id.values)
+        # compiled msd_id, artist and clique lookups of the dataset (cached next to the csv file)
+        self.cliques = CliqueIndex.cached(shs_csv)
 
         if profile:
             self.filter_duplicates = profile['filter_duplicates']
@@ -79,6 +98,16 @@ class Experiments(object):
             self.shs_mode = presets.shs_msd['shs_mode']
         return
 
+    def select_queries(self, start=None, stop=None):
+        """
+        Restrict the query songs of the run_*_task methods to the rows [start:stop] of the dataset
+        (eg. a shard of the query set processed by a worker). The ground truth of the evaluation metrics
+        is still the whole dataset.
+        """
+        self.query_ids = self.dataset.msd_id.values[start:stop].tolist()
+        self.query_titles = self.dataset.title.values[start:stop].tolist()
+        return
+
     def _load_csv_as_df(self, csvfile):
         """Load csv file as pandas dataframe"""
         return self.pd.read_csv(csvfile)
@@ -99,6 +128,12 @@ class Experiments(object):
     def _groupby_work(self, merged_df):
         return merged_df.groupby('work_id')['msd_id'].agg({'clique_songs': self._tolist})
 
+    def _format_results(self, results):
+        """Format the results dict {query_msd_id: {'id': [...], 'score': [...]}} of a task (check results_format)"""
+        if self.results_format == 'store':
+            return ResultStore.from_dict(results, query_ids=self.query_ids)
+        return self.pd.DataFrame.from_dict(results, orient='index')
+
     def load_result_json_as_df(self, jsonfile):
         """Load results json from the experiments to pandas df"""
         return self.pd.read_json(jsonfile, orient='index')
@@ -110,10 +145,24 @@ class Experiments(object):
         pickle.dump(mydict, doc)
         return
 
+    def dump_request_stats(self, jsonfile=None):
+        """
+        Log the per-request metrics (p50/p95/p99 of the wall time, http time, es 'took', response bytes
+        and hits per request method) recorded by the SearchModule instance and optionally dump them to a json file.
+        (check utilities/instrumentation.py)
+        """
+        summary = self.es.recorder.summary()
+        for method, stats in sorted(summary.items()):
+            LOGGER.info("\n%s requests : %s, wall time (ms) p50=%.1f p95=%.1f p99=%.1f, es took (ms) p50=%s" %
+                        (method, stats['count'], stats['wall_time']['p50'], stats['wall_time']['p95'],
+                         stats['wall_time']['p99'], stats.get('took', {}).get('p50')))
+        if jsonfile:
+            self.es.recorder.dump_json(jsonfile)
+        return summary
+
     def get_clique_id(self, track_id):
         """DEPRECIATED"""
-        # have to recheck if this is same for all the sample
-        return self.dataset[self.dataset.msd_id==track_id].clique_id.values.tolist()
+        return [self.cliques.clique_id(track_id)]
 
     def get_ground_truth(self, query_id, reference_id):
         """DEPRECIATED [To_remove]"""
@@ -123,14 +172,20 @@ class Experiments(object):
             return 0
 
     def reset_preset(self):
-        self.es.post_json = self.es.init_json
+        """Remove the profile filters from the queries of the SearchModule instance"""
+        self.es.reset_profile()
+        return
+
+    def _set_search_profile(self):
+        """Compile the query builders of the SearchModule instance for the profile of the experiment"""
+        self.es.set_profile(shs_mode=self.shs_mode, filter_duplicates=self.filter_duplicates, dzr_map=self.dzr_map)
         return
 
     def get_artist_id(self, track_id):
         """
         Returns artist_id for a specific msd_track_id from the dataset
         """
-        return self.dataset.artist_id[self.dataset.msd_id == track_id].values[0]
+        return self.cliques.artist_id(track_id)
 
     def rerank_by_field(self, field_id, response, proximitiy=1, field='msd_artist_id'):
         """
@@ -212,179 +267,325 @@ class Experiments(object):
     These are methods for running automated search experiments on the ES MSD db
     """
 
+    def _run_task(self, run_chunk, task, params, checkpoint=None, chunk_size=1000):
+        """
+        Run a task over the query songs
+
+        Inputs :
+                run_chunk : function (query_ids, query_titles) -> results dict
+                            {query_msd_id: {'id': [...], 'score': [...]}} of a list of query songs
+                task : name of the task
+                params : json serializable dict of the parameters of the task
+        Params :
+                checkpoint : {default : None} If set, path of a checkpoint directory (utilities/checkpoint.py).
+                    The query songs are processed by chunks of 'chunk_size' songs and the results of each chunk
+                    are written to the checkpoint, a run with the same task, params and profile skips the songs
+                    already in the checkpoint and resumes from there.
+                chunk_size : {default : 1000} number of query songs per chunk (only used with a 'checkpoint')
+        """
+        if not checkpoint:
+            return self._format_results(run_chunk(self.query_ids, self.query_titles))
+
+        config = {'task': task, 'params': params,
+                  'profile': {'shs_mode': self.shs_mode, 'filter_duplicates': self.filter_duplicates,
+                              'dzr_map': self.dzr_map},
+                  'n_queries': len(self.query_ids),
+                  'queries': self.hashlib.sha1('\n'.join(map(str, self.query_ids))).hexdigest()}
+        store = ResultCheckpoint(checkpoint, config)
+        pending = store.pending(self.query_ids)
+        LOGGER.info("\n Checkpoint %s : %s query songs done, %s pending" % (checkpoint, len(store), len(pending)))
+
+        for start in range(0, len(pending), chunk_size):
+            indexes = pending[start:start + chunk_size]
+            query_ids = [self.query_ids[index] for index in indexes]
+            results = run_chunk(query_ids, [self.query_titles[index] for index in indexes])
+            store.append(ResultStore.from_dict(results, query_ids=query_ids))
+            LOGGER.info("\n Checkpoint %s : %s/%s query songs done" % (checkpoint, len(store), len(store) +
+                                                                        len(pending) - start - len(indexes)))
+        results = store.load()
+        if self.results_format == 'store':
+            return results
+        return results.to_dataframe()
+
     @timeit
-    def run_song_title_match_task(self, size=100, verbose=True):
+    def run_song_title_match_task(self, size=100, verbose=True, batch_size=None, checkpoint=None, chunk_size=1000,
+                                  coalesce=True):
         """
         Simple experiment with simple text match
+
+        :param size: {default : 100} required size of the response for each query
+        :param verbose: {default : True}
+        :param batch_size: {default : None} If set, the queries are sent to es by batches of
+            'batch_size' requests using the multi-search endpoint instead of one request per query
+        :param checkpoint: {default : None} If set, the results are written by chunks of 'chunk_size' query songs
+            to this checkpoint directory and an interrupted run is resumed from it (check _run_task)
+        :param coalesce: {default : True} If set, the query songs with the same title share a single es request
+            (check SearchModule.coalesced_search)
         """
         start_time = self.time.time()
 
-        if self.shs_mode:
-            self.es.limit_post_json_to_shs()
-
-        if self.filter_duplicates:
-            self.es.add_remove_duplicates_filter()
-
-        if self.dzr_map:
-            self.es.limit_to_dzr_mapped_msd()
-
-        results = dict()
+        self._set_search_profile()
 
         LOGGER.info("\n=======Running song title-match task for %s query songs against top %s results of MSD... "
                     "with shs_mode %s, duplicate %s, dzr_map %s ========\n"
                     % (len(self.query_ids), size, str(self.shs_mode), str(self.filter_duplicates), str(self.dzr_map)))
 
-        for title in enumerate(self.query_titles):
-            if verbose:
-                print "------%s-------%s" % (title[0], title[1])
+        def run_chunk(query_ids, query_titles):
+            results = dict()
+            if batch_size or coalesce:
+                queries = [(unicode(title), query_ids[index], size) for index, title in enumerate(query_titles)]
+                responses = self.es.batch_search_by_exact_title(queries, out_mode='eval', batch_size=batch_size,
+                                                                coalesce=coalesce)
+                for msd_id, (res_ids, res_scores) in zip(query_ids, responses):
+                    results[msd_id] = {'id': res_ids, 'score': res_scores}
+            else:
+                for title in enumerate(query_titles):
+                    if verbose:
+                        print "------%s-------%s" % (title[0], title[1])
 
-            res_ids, res_scores = self.es.search_by_exact_title(
-                unicode(title[1]), track_id=self.query_ids[title[0]], out_mode='eval', size=size)
-            # aggregrate response_ids and scores into a dict by query_msd_id as key
-            results[self.query_ids[title[0]]] = {'id': res_ids, 'score': res_scores}
+                    res_ids, res_scores = self.es.search_by_exact_title(
+                        unicode(title[1]), track_id=query_ids[title[0]], out_mode='eval', size=size)
+                    # aggregrate response_ids and scores into a dict by query_msd_id as key
+                    results[query_ids[title[0]]] = {'id': res_ids, 'score': res_scores}
+            return results
 
+        results = self._run_task(run_chunk, 'msd_title', {'size': size}, checkpoint=checkpoint, chunk_size=chunk_size)
         LOGGER.info("\n Task runtime : %s" % (self.time.time() - start_time))
-        return self.pd.DataFrame.from_dict(results, orient='index')
+        return results
 
     @timeit
-    def run_cleaned_song_title_task(self, size=100, verbose=True):
-        """Run MSD pre-processed title task"""
+    def run_cleaned_song_title_task(self, size=100, verbose=True, batch_size=None, prefetch=True, checkpoint=None,
+                                    chunk_size=1000, coalesce=True):
+        """
+        Run MSD pre-processed title task
+
+        :param size: {default : 100} required size of the response for each query
+        :param verbose: {default : True}
+        :param batch_size: {default : None} If set, the queries are sent to es by batches of
+            'batch_size' requests using the multi-search endpoint instead of one request per query
+        :param prefetch: {default : True} If set, the cleaned titles of all the query songs
+            are fetched beforehand with multi-get requests
+        :param checkpoint: {default : None} If set, the results are written by chunks of 'chunk_size' query songs
+            to this checkpoint directory and an interrupted run is resumed from it (check _run_task)
+        :param coalesce: {default : True} If set, the query songs with the same cleaned title share a single
+            es request (check SearchModule.coalesced_search)
+        """
         start_time = self.time.time()
 
-        if self.shs_mode:
-            self.es.limit_post_json_to_shs()
-
-        if self.filter_duplicates:
-            self.es.add_remove_duplicates_filter()
-
-        if self.dzr_map:
-            self.es.limit_to_dzr_mapped_msd()
-
-        results = dict()
+        self._set_search_profile()
 
         LOGGER.info("\n=======Running cleaned title-match task for %s query songs against top %s results of MSD... "
                     "with shs_mode %s, duplicate %s, dzr_map %s ========\n"
                     % (len(self.query_ids), size, str(self.shs_mode), str(self.filter_duplicates), str(self.dzr_map)))
 
-        for ids in enumerate(self.query_ids):
-            if verbose:
-                print "----%s----%s" % (ids[0], ids[1])
-            res_ids, res_scores = self.es.search_with_cleaned_title(track_id=ids[1], out_mode='eval', size=size)
-            results[ids[1]] = {'id': res_ids, 'score': res_scores}
+        def run_chunk(query_ids, query_titles):
+            results = dict()
+            if prefetch:
+                self.es.prefetch_fields(query_ids, fields=['dzr_msd_title_clean'])
 
+            if batch_size or coalesce:
+                responses = self.es.batch_search_with_cleaned_title(query_ids, size=size, out_mode='eval',
+                                                                    batch_size=batch_size, coalesce=coalesce)
+                for msd_id, (res_ids, res_scores) in zip(query_ids, responses):
+                    results[msd_id] = {'id': res_ids, 'score': res_scores}
+            else:
+                for ids in enumerate(query_ids):
+                    if verbose:
+                        print "----%s----%s" % (ids[0], ids[1])
+                    res_ids, res_scores = self.es.search_with_cleaned_title(track_id=ids[1], out_mode='eval', size=size)
+                    results[ids[1]] = {'id': res_ids, 'score': res_scores}
+            return results
+
+        results = self._run_task(run_chunk, 'pre-msd_title', {'size': size}, checkpoint=checkpoint,
+                                 chunk_size=chunk_size)
         LOGGER.info("\n Task runtime : %s" % (self.time.time() - start_time))
-        return self.pd.DataFrame.from_dict(results, orient='index')
+        return results
 
     @timeit
-    def run_field_rerank_task(self, field='msd_artist_id', size=100, proximitiy=1, verbose=True):
+    def run_field_rerank_task(self, field='msd_artist_id', size=100, proximitiy=1, verbose=True, batch_size=None,
+                              checkpoint=None, chunk_size=1000, coalesce=True):
         """
         In this task, a msd song with same artist id with the query song will be ranked top of the list
+
+        :param batch_size: {default : None} If set, the title queries are sent to es by batches of
+            'batch_size' requests using the multi-search endpoint instead of one request per query
+        :param checkpoint: {default : None} If set, the results are written by chunks of 'chunk_size' query songs
+            to this checkpoint directory and an interrupted run is resumed from it (check _run_task)
+        :param coalesce: {default : True} If set, the query songs with the same title share a single es request
+            (check SearchModule.coalesced_search)
         """
-        results = dict()
         LOGGER.info("\n=======Running song title-matching task with reranking by '%s' for %s query "
                     "songs against top %s results of MSD... with shs_mode %s, duplicate %s, dzr_map %s ========\n"
                     % (field, len(self.query_ids), size, str(self.shs_mode),
                        str(self.filter_duplicates), str(self.dzr_map)))
 
-        if self.shs_mode:
-            self.es.limit_post_json_to_shs()
+        self._set_search_profile()
+
+        def run_chunk(query_ids, query_titles):
+            results = dict()
+            if coalesce:
+                responses = self.es.coalesced_search([(title, query_ids[index], size)
+                                                      for index, title in enumerate(query_titles)],
+                                                     batch_size=batch_size)
+            elif batch_size:
+                bodies = [self.es._format_query(title, query_ids[index], size=size)
+                          for index, title in enumerate(query_titles)]
+                responses = self.es.msearch_es(bodies, batch_size=batch_size)
+            else:
+                responses = [self.es.search_es(self.es._format_query(title, query_ids[index], size=size))
+                             for index, title in enumerate(query_titles)]
 
-        if self.filter_duplicates:
-            self.es.add_remove_duplicates_filter()
+            # the hits with the same field value as the query song are promoted for all the queries at once
+            table, [(ids, scores)] = rerank.encode_rankings(
+                [self.es._parse_response_for_eval(response) for response in responses])
+            _, [(fields, _), (query_fields, _)] = rerank.encode_rankings(
+                [([hit['_source'][field] for hit in response], []) for response in responses],
+                [([self.get_artist_id(msd_id)], []) for msd_id in query_ids])
+            ids, scores = rerank.promote_by_field(ids, scores, fields, query_fields[:, 0], proximity=proximitiy)
 
-        if self.dzr_map:
-            self.es.limit_to_dzr_mapped_msd()
+            for index, (res_ids, res_scores) in enumerate(rerank.decode(table, ids, scores)):
+                if verbose:
+                    print "------%s-------%s" % (index, query_titles[index])
+                results[query_ids[index]] = {'id': res_ids, 'score': res_scores}  # save it to dictionary
+            return results
 
-        for index,title in enumerate(self.query_titles):
-            if verbose:
-                print "------%s-------%s" % (index, title)
-            response = self.es.search_es(self.es._format_query(title, self.query_ids[index], size=size))
-            query_artist_id = self.get_artist_id(self.query_ids[index])
-            re_ranked = self.rerank_by_field(query_artist_id, response, field=field, proximitiy=proximitiy)
-            res_ids, res_scores = self.es._parse_response_for_eval(re_ranked)
-            results[self.query_ids[index]] = {'id': res_ids, 'score': res_scores}  # save it to dictionary
-        return self.pd.DataFrame.from_dict(results, orient='index')
+        return self._run_task(run_chunk, 'field_rerank', {'field': field, 'size': size, 'proximity': proximitiy},
+                              checkpoint=checkpoint, chunk_size=chunk_size)
 
 
     @timeit
-    def run_mxm_lyrics_search_task(self, post_json=presets.more_like_this, size=100, verbose=True):
+    def run_mxm_lyrics_search_task(self, post_json=presets.more_like_this, size=100, verbose=True, batch_size=None,
+                                   prefetch=True, checkpoint=None, chunk_size=1000, like_doc=False):
         """
         Lyrics search method using MXM lyrics
         (https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-mlt-query.html)
-        """
-        results = dict()
-
-        if self.shs_mode:
-            self.es.limit_post_json_to_shs()
 
-        if self.filter_duplicates:
-            self.es.add_remove_duplicates_filter()
-
-        if self.dzr_map:
-            self.es.limit_to_dzr_mapped_msd()
+        :param batch_size: {default : None} If set, the lyrics queries are sent to es by batches of
+            'batch_size' requests using the multi-search endpoint instead of one request per query
+        :param prefetch: {default : True} If set, the lyrics of all the query songs
+            are fetched beforehand with multi-get requests
+        :param checkpoint: {default : None} If set, the results are written by chunks of 'chunk_size' query songs
+            to this checkpoint directory and an interrupted run is resumed from it (check _run_task)
+        :param like_doc: {default : False} If set, the more_like_this queries reference the stored document of the
+            query songs instead of sending their lyrics (check SearchModule.search_by_lyrics_doc), ie. the lyrics
+            searches of run_rerank_title_with_mxm_lyrics_task. The lyrics are not fetched and the songs without
+            lyrics get an empty response instead of no response.
+        """
+        self._set_search_profile()
 
         LOGGER.info("\n=======Running musixmatch-msd lyrics search task for %s query songs against "
                     "top %s results of MSD... with shs_mode %s, duplicate %s, dzr_map %s ========\n"
                     % (len(self.query_ids), size, str(self.shs_mode), str(self.filter_duplicates), str(self.dzr_map)))
 
-        for index, ids in enumerate(self.query_ids):
-            if verbose:
-                print "----%s----%s" % (index, ids)
-            res_ids, res_scores = self.es.search_by_mxm_lyrics(post_json, msd_track_id=ids, out_mode='eval', size=size)
-            results[ids] = {'id': res_ids, 'score': res_scores}
+        def run_chunk(query_ids, query_titles):
+            results = dict()
+            if prefetch and not like_doc:
+                self.es.prefetch_fields(query_ids, fields=['mxm_lyrics'])
+
+            if like_doc and batch_size:
+                responses = self.es.batch_search_by_lyrics_doc(post_json, query_ids, out_mode='eval', size=size,
+                                                               batch_size=batch_size)
+            elif batch_size:
+                responses = self.es.batch_search_by_mxm_lyrics(post_json, query_ids, out_mode='eval', size=size,
+                                                               batch_size=batch_size)
+            else:
+                def search_chain(query):
+                    """fetch the lyrics of the query song and search with them (or search 'like' its document)"""
+                    index, ids = query
+                    if verbose:
+                        print "----%s----%s" % (index, ids)
+                    if like_doc:
+                        return self.es.search_by_lyrics_doc(post_json, msd_track_id=ids, out_mode='eval', size=size)
+                    return self.es.search_by_mxm_lyrics(post_json, msd_track_id=ids, out_mode='eval', size=size)
+
+                # with a ConcurrentSearchModule the queries are processed concurrently
+                responses = self.es.map_queries(search_chain, enumerate(query_ids))
+            for msd_id, (res_ids, res_scores) in zip(query_ids, responses):
+                results[msd_id] = {'id': res_ids, 'score': res_scores}
+            return results
+
+        params = {'post_json': post_json, 'size': size}
+        if like_doc:
+            params['like_doc'] = like_doc
+        return self._run_task(run_chunk, 'mxm_lyrics', params, checkpoint=checkpoint, chunk_size=chunk_size)
+
+    def _search_title_and_lyrics(self, query_ids, query_titles, lyrics_field, size=100, with_cleaned=False,
+                                 batch_size=None, prefetch=True):
+        """
+        Returns the list of ((title_ids, title_scores), (lyrics_ids, lyrics_scores)) responses of the query songs.
+        Both searches of a query song are sent in a single _msearch request and the lyrics search references
+        the stored document of the query song (check SearchModule.batch_search_title_and_lyrics)
+        """
+        if with_cleaned:
+            if prefetch:
+                self.es.prefetch_fields(query_ids, fields=['dzr_msd_title_clean'])
+            titles = [self.es.get_cleaned_title_from_id(msd_id) for msd_id in query_ids]
+            title_field = 'dzr_msd_title_clean'
+        else:
+            titles = query_titles
+            title_field = 'msd_title'
 
-        return self.pd.DataFrame.from_dict(results, orient='index')
+        if batch_size:
+            return self.es.batch_search_title_and_lyrics(zip(titles, query_ids), lyrics_field=lyrics_field,
+                                                         title_field=title_field, out_mode='eval', size=size,
+                                                         batch_size=batch_size)
 
-    @timeit
-    def run_rerank_title_with_dzr_lyrics_task(self, size=100, with_cleaned=False, verbose=True):
+        def search_chain(index):
+            """title and lyrics searches of a query song in a single round trip"""
+            return self.es.search_title_and_lyrics(titles[index], query_ids[index], lyrics_field=lyrics_field,
+                                                   title_field=title_field, out_mode='eval', size=size)
+
+        # with a ConcurrentSearchModule the queries are processed concurrently
+        return self.es.map_queries(search_chain, range(len(query_ids)))
+
+    def _rerank_title_by_lyrics_responses(self, query_ids, responses, threshold=0.5, verbose=True):
         """
-        Here you make two requests with song_title metadata and dzr_lyrics and merge the results with the top resutls
-        of lyrics to rerank song-title search response
+        Rerank the title response of each query song by its lyrics response (returns a results dict),
+        all the responses are reranked at once (check utilities/rerank.py -> promote_by_lyrics)
         """
+        table, [(title_ids, title_scores), (lyrics_ids, lyrics_scores)] = rerank.encode_rankings(
+            [title_res for title_res, _ in responses], [lyrics_res for _, lyrics_res in responses])
+        ids, scores = rerank.promote_by_lyrics(title_ids, title_scores, lyrics_ids, lyrics_scores,
+                                               proximity=threshold)
         results = dict()
+        for index, (res_ids, res_scores) in enumerate(rerank.decode(table, ids, scores)):
+            if verbose:
+                print "---%s---%s" % (index, query_ids[index])
+            results[query_ids[index]] = {'id': res_ids, 'score': res_scores}
+        return results
 
-        if self.shs_mode:
-            self.es.limit_post_json_to_shs()
-
-        if self.filter_duplicates:
-            self.es.add_remove_duplicates_filter()
-
-        if self.dzr_map:
-            self.es.limit_to_dzr_mapped_msd()
+    @timeit
+    def run_rerank_title_with_dzr_lyrics_task(self, size=100, with_cleaned=False, verbose=True, batch_size=None,
+                                              prefetch=True, checkpoint=None, chunk_size=1000):
+        """
+        Here you make two requests with song_title metadata and dzr_lyrics and merge the results with the top resutls
+        of lyrics to rerank song-title search response
 
-        post_json = self.es.post_json
+        :param batch_size: {default : None} If set, the queries are sent to es by batches of 'batch_size' query songs,
+            otherwise each query song makes its own _msearch request with its title and lyrics searches
+        :param prefetch: {default : True} If set, the cleaned titles of all the query songs are fetched beforehand
+            with multi-get requests (only used if 'with_cleaned')
+        :param checkpoint: {default : None} If set, the results are written by chunks of 'chunk_size' query songs
+            to this checkpoint directory and an interrupted run is resumed from it (check _run_task)
+        """
+        self._set_search_profile()
 
         LOGGER.info("\n=======Running rerank experiment of title search response with dzr_lyrics response for %s "
                     "query songs against top %s results of MSD... with shs_mode %s, duplicate %s, dzr_map %s ========\n"
                     % (len(self.query_ids), size, str(self.shs_mode), str(self.filter_duplicates), str(self.dzr_map)))
 
-        for index, title in enumerate(self.query_titles):
-            if verbose:
-                print "---%s---%s" % (index, self.query_ids[index])
-
-            self.es.post_json = post_json  # post-json template for title search
-
-            if with_cleaned:
-                text_df = self.es.search_with_cleaned_title(self.query_ids[index], out_mode='view', size=size)
-            else:
-                text_df = self.es.search_by_exact_title(title, self.query_ids[index], out_mode='view', size=size)
-
-            lyrics_df = self.es.search_by_dzr_lyrics(
-                presets.more_like_this, self.query_ids[index], out_mode='view', size=size)
-
-            if type(lyrics_df) != tuple:
-                if lyrics_df.empty:
-                    res_ids, res_scores = text_df.msd_id.values.tolist(), text_df.score.values.tolist()
-                else:
-                    res_ids, res_scores = self.rerank_title_results_by_lyrics(text_df, lyrics_df, mode='eval')
-            else:
-                res_ids, res_scores = text_df.msd_id.values.tolist(), text_df.score.values.tolist()
-            results[self.query_ids[index]] = {'id': res_ids, 'score': res_scores}
-        return self.pd.DataFrame.from_dict(results, orient='index')
+        def run_chunk(query_ids, query_titles):
+            responses = self._search_title_and_lyrics(query_ids, query_titles, 'dzr_lyrics.content', size=size,
+                                                      with_cleaned=with_cleaned, batch_size=batch_size,
+                                                      prefetch=prefetch)
+            return self._rerank_title_by_lyrics_responses(query_ids, responses, verbose=verbose)
 
+        return self._run_task(run_chunk, 'title_dzr_lyrics', {'size': size, 'with_cleaned': with_cleaned},
+                              checkpoint=checkpoint, chunk_size=chunk_size)
 
     @timeit
-    def run_rerank_title_with_mxm_lyrics_task(self, size=100, with_cleaned=False, verbose=True, threshold=0.5):
+    def run_rerank_title_with_mxm_lyrics_task(self, size=100, with_cleaned=False, verbose=True, threshold=0.5,
+                                              batch_size=None, prefetch=True, checkpoint=None, chunk_size=1000):
         """
         Experiment we rerank the es response of song_title search with top results of mxm_lyrics similarity results
 
@@ -393,50 +594,48 @@ class Experiments(object):
             text_search method to cleaned_processed title method
         :param verbose: {default : False}
         :param threshold:
+        :param batch_size: {default : None} If set, the queries are sent to es by batches of 'batch_size' query songs,
+            otherwise each query song makes its own _msearch request with its title and lyrics searches
+        :param prefetch: {default : True} If set, the cleaned titles of all the query songs are fetched beforehand
+            with multi-get requests (only used if 'with_cleaned')
+        :param checkpoint: {default : None} If set, the results are written by chunks of 'chunk_size' query songs
+            to this checkpoint directory and an interrupted run is resumed from it (check _run_task)
         :return: Aggregated results as pandas dataframe
         """
-        results = dict()
-
-        if self.shs_mode:
-            self.es.limit_post_json_to_shs()
-
-        if self.filter_duplicates:
-            self.es.add_remove_duplicates_filter()
-
-        if self.dzr_map:
-            self.es.limit_to_dzr_mapped_msd()
-
-        post_json = self.es.post_json
+        self._set_search_profile()
 
         LOGGER.info("\n=======Running rerank experiment of title search response with mxm_lyrics response for %s query "
                     "songs against top %s results of MSD... with shs_mode %s, duplicate %s, dzr_map %s ========\n"
                     % (len(self.query_ids), size, str(self.shs_mode), str(self.filter_duplicates), str(self.dzr_map)))
 
-        for index, title in enumerate(self.query_titles):
-            if verbose:
-                print "---%s---%s" % (index, self.query_ids[index])
-
-            self.es.post_json = post_json  # post-json template for title search
+        def run_chunk(query_ids, query_titles):
+            responses = self._search_title_and_lyrics(query_ids, query_titles, 'mxm_lyrics', size=size,
+                                                      with_cleaned=with_cleaned, batch_size=batch_size,
+                                                      prefetch=prefetch)
+            return self._rerank_title_by_lyrics_responses(query_ids, responses, threshold=threshold, verbose=verbose)
 
-            if with_cleaned:
-                text_df = self.es.search_with_cleaned_title(self.query_ids[index], out_mode='view', size=size)
-            else:
-                text_df = self.es.search_by_exact_title(title, self.query_ids[index], out_mode='view', size=size)
+        return self._run_task(run_chunk, 'title_mxm_lyrics',
+                              {'size': size, 'with_cleaned': with_cleaned, 'threshold': threshold},
+                              checkpoint=checkpoint, chunk_size=chunk_size)
 
-            lyrics_df = self.es.search_by_mxm_lyrics(
-                presets.more_like_this, msd_track_id=self.query_ids[index], out_mode='view', size=size)
+    def rerank_title_by_lyrics_results(self, title_results, lyrics_results, threshold=0.5):
+        """
+        [OFFLINE EXPERIMENT]
 
-            if type(lyrics_df) != tuple:
-                if lyrics_df.empty:
-                    res_ids, res_scores = text_df.msd_id.values.tolist(), text_df.score.values.tolist()
-                else:
-                    res_ids, res_scores = self.rerank_title_results_by_lyrics(
-                        text_df, lyrics_df, mode='eval', proximity=threshold)
-            else:
-                res_ids, res_scores = text_df.msd_id.values.tolist(), text_df.score.values.tolist()
-            results[self.query_ids[index]] = {'id': res_ids, 'score': res_scores}
-        return self.pd.DataFrame.from_dict(results, orient='index')
+        Rerank the results of a title task (run_song_title_match_task or run_cleaned_song_title_task) by the
+        results of the lyrics task (run_mxm_lyrics_search_task) of the same query songs without any es request.
+        With the lyrics results of run_mxm_lyrics_search_task(like_doc=True), the rankings are the ones of
+        run_rerank_title_with_mxm_lyrics_task with the same size and threshold, so that the title and lyrics
+        responses can be shared between several evaluation methods (check evaluations.py)
 
+        :param title_results: results (dataframe or ResultStore) of the title task
+        :param lyrics_results: results (dataframe or ResultStore) of the lyrics task
+        :param threshold: {default : 0.5} proximity of the promoted lyrics hits
+        """
+        responses = zip(self._dataset_responses(title_results, self.query_ids),
+                        self._dataset_responses(lyrics_results, self.query_ids))
+        return self._format_results(self._rerank_title_by_lyrics_responses(self.query_ids, responses,
+                                                                           threshold=threshold, verbose=False))
 
     @timeit
     def run_audio_rerank_task(self, text_results_json, audio_results_json, threshold=0.1):
@@ -448,83 +647,46 @@ class Experiments(object):
         audio_results_json : json file
         threshold : {default: 0.1}
 
+        The first n hits of the audio response of a query are promoted on top of its text response, n being the
+        number of audio hits with a score (distance) <= threshold, followed by the other ids of the text response
+        (check utilities/rerank.py -> promote_prefix). For an audio response sorted by increasing distance, these
+        are the hits under the threshold, otherwise the promoted prefix may contain hits above the threshold.
+        A query without audio hit under the threshold keeps its text response.
         """
         text_df = self.pd.read_json(text_results_json)
         audio_df = self.pd.read_json(audio_results_json)
-        results = dict()
-        cnt = 0
-        error_idxs = []
-
-        def get_low_score(scores, thres=threshold):
-
-            def list_duplicates_of(seq, item):
-                start_at = -1
-                locs = []
-                while True:
-                    try:
-                        loc = seq.index(item, start_at+1)
-                    except ValueError:
-                        break
-                    else:
-                        locs.append(loc)
-                        start_at = loc
-                return locs
-
-            # top_score = scores[0]
-            # top_list = [score for score in scores if self.np.abs(top_score-score)<=thres]
-            top_list = []
-            for score in scores:
-                # if self.np.abs(top_score-score)<=thres:
-                if score <= thres:
-                    top_list.append(score)
-            # idxs = [scores.index(x) for x in top_list]
-
-            dup_idxs = []
-            for s in top_list:
-                dup_idxs.extend(list_duplicates_of(top_list, s))
-
-            idxs = list(set(dup_idxs))
-            print "Score index :", idxs
-            return idxs
 
         LOGGER.info("Running audio reranking task on the metadata search experiments results "
                     "file with a threshold of %s" % threshold)
 
-        for idx in range(len(audio_df)):
-            print "Index :", idx
-            text_res_ids = text_df.iloc[idx].id
-            text_res_scores = text_df.iloc[idx].id
-            audio_res_ids = audio_df.iloc[idx].id
-            audio_res_scores = audio_df.iloc[idx].score
-
-            if not audio_res_scores or not audio_res_ids or len(audio_res_ids) == 0:
-                results[audio_df.index[idx]] = {'id': text_res_ids, 'score': text_res_scores}
-                cnt += 1
-                error_idxs.append(idx)
+        def response(ids, scores):
+            """(ids, scores) of a results row, (None, None) for the queries without response"""
+            if type(ids) == list and ids and type(scores) == list and scores:
+                return ids, scores
+            return None, None
+
+        # the text responses are aligned with the audio responses by query msd_id
+        text_df = text_df.reindex(audio_df.index)
+        audio_res = [response(ids, scores) for ids, scores in zip(audio_df['id'].values, audio_df['score'].values)]
+        table, [(text_ids, text_scores), (audio_ids, audio_scores)] = rerank.encode_rankings(
+            [response(ids, scores) for ids, scores in zip(text_df['id'].values, text_df['score'].values)], audio_res)
+        with self.np.errstate(invalid='ignore'):
+            n_head = ((audio_ids >= 0) & (audio_scores <= threshold)).sum(axis=1)
+        reranked = rerank.decode(table, *rerank.promote_prefix(text_ids, text_scores, audio_ids, audio_scores, n_head))
+
+        results = dict()
+        for index, query_id in enumerate(audio_df.index):
+            if n_head[index]:
+                res_ids, res_scores = reranked[index]
             else:
-                a_df = self.pd.DataFrame({'id': audio_res_ids, 'score': audio_res_scores})
-                # t_df = self.pd.DataFrame({'id': text_res_ids, 'score' : text_res_scores})
-
-                thres_idxs = get_low_score(a_df.score.values.tolist(), threshold)
-
-                if len(thres_idxs) != 0:
-                    a_df = a_df.iloc[thres_idxs]
-                    top_ids = a_df.id.values.tolist()
-                    top_scores = a_df.score.tolist()
-                    # common_ids = self.np.intersect1d(top_ids, t_df.id.values)
-                    bottom_ids = [x for x in text_df.iloc[idx].id if x not in top_ids]
-                    bottom_idx = [text_res_ids.index(x) for x in bottom_ids]
-                    text_res_scores = self.np.array(text_res_scores)
-                    bottom_scores = text_res_scores[bottom_idx]
-                    new_ranked_ids = top_ids + bottom_ids
-                    new_ranked_scores = top_scores + list(bottom_scores)
-                    results[audio_df.index[idx]] = {'id': new_ranked_ids, 'score': new_ranked_scores}
-                else:
-                    results[audio_df.index[idx]] = {'id': text_res_ids, 'score': text_res_scores}
+                # no audio hit below the threshold, the text response is unchanged
+                res_ids, res_scores = text_df['id'].values[index], text_df['score'].values[index]
+            results[query_id] = {'id': res_ids, 'score': res_scores}
 
-        LOGGER.debug("%s queries dont have proper audio reranked resposne" % cnt)
+        LOGGER.debug("%s queries dont have proper audio reranked resposne"
+                     % sum(ids is None for ids, _ in audio_res))
 
-        return self.pd.DataFrame.from_dict(results, orient='index')
+        return self._format_results(results)
 
     @timeit
     def maximum_achievable_metrics(self, results_df):
@@ -536,20 +698,18 @@ class Experiments(object):
         LOGGER.info("Computing maximum achievable mean average precison from the results dataframe")
         results_df = self._merge_df(results_df)
         results = dict()
-        for index, response in results_df.iterrows():
-            if type(response['id']) == list:
-                response_ids = response['id']
-                # result_songs = response['id']
-                clique_songs = results_df.msd_id[results_df.work_id == response['work_id']].values
+        for msd_id, response_ids in zip(results_df.msd_id.values, results_df['id'].values):
+            if type(response_ids) == list:
+                clique_songs = self.cliques.clique_songs(msd_id).tolist()
                 top_list = self.np.intersect1d(clique_songs, response_ids)
                 if len(top_list) > 0:
                     bottom_list = [x for x in response_ids if x not in top_list]
                     if bottom_list:
-                        results[response['msd_id']] = {'id': list(top_list) + bottom_list}
+                        results[msd_id] = {'id': list(top_list) + bottom_list}
                     else:
-                        results[response['msd_id']] = {'id': list(top_list)}
+                        results[msd_id] = {'id': list(top_list)}
                 else:
-                    results[response['msd_id']] = {'id': response_ids}
+                    results[msd_id] = {'id': response_ids}
         return self.pd.DataFrame.from_dict(results, orient='index')
 
     # ----------------------------------------EVALUATION METRICS----------------------------------------------------
@@ -565,9 +725,7 @@ class Experiments(object):
         """
         results_df = self._merge_df(results_df)
         response_ids = results_df[results_df.msd_id == query_msd_id].id.values.tolist()[0]
-        work_id = results_df.work_id[results_df.msd_id == query_msd_id].values[0]
-        clique_songs = results_df.msd_id[results_df.work_id == work_id].values
-        # print clique_songs, len(clique_songs)
+        clique_songs = self.cliques.clique_songs(query_msd_id).tolist()
         true_idx = [response_ids.index(x) for x in response_ids if x in clique_songs]
         ground_truth = self.np.zeros(len(response_ids))
         if len(true_idx) > 0:
@@ -587,29 +745,9 @@ class Experiments(object):
 
         Returns a list of average precision
         """
-        results_df = self._merge_df(results_df)
-        avg_precisions = list()
-        cnt = 0
-        for index, response in results_df.iterrows():
-            if type(response['id']) == list:
-                if size:
-                    response_ids = response['id'][:size]
-                else:
-                    response_ids = response['id']
-                clique_songs = results_df.msd_id[results_df.work_id == response['work_id']].values
-                true_idx = [response_ids.index(x) for x in response_ids if x in clique_songs]
-                ground_truth = self.np.zeros(len(response_ids))
-                if len(true_idx) > 0:
-                    ground_truth[true_idx] = 1
-                precision_at_k = self.np.cumsum(ground_truth) / self.np.arange(1., len(response_ids)+1)
-                precision_list = ground_truth * precision_at_k
-                avg_precision = sum(precision_list) / float(len(clique_songs) - 1)
-                avg_precisions.append(avg_precision)
-            else:
-                cnt += 1
-                avg_precisions.append(0)
-        LOGGER.debug("%s queries have no lyrics nor response out of %s queries" % (cnt, len(results_df)))
-        return avg_precisions
+        metrics, codes, valid, works = self._encode_results(results_df, size=size)
+        LOGGER.debug("%s queries have no lyrics nor response out of %s queries" % ((~valid).sum(), len(valid)))
+        return metrics.average_precision(codes, valid, works).tolist()
 
     @timeit
     def mean_average_precision(self, results_df, size=None):
@@ -618,67 +756,59 @@ class Experiments(object):
         """
         return self.np.mean(self.average_precision(results_df, size=size))
 
+    def _encode_results(self, results_df, size=None):
+        """
+        Encode the responses of the queries of the dataset for the evaluation metrics
+        from a results dataframe or a ResultStore (utilities/result_store.py)
+        Returns a tuple (metrics, codes, valid, works) (check utilities/metrics.py)
+        """
+        if isinstance(results_df, ResultStore):
+            codes, valid = self.metrics.encode_store(results_df, self.dataset.msd_id.values, size=size)
+            return self.metrics, codes, valid, self.metrics.row_works
+        # here you merge the results_df with the shs_dataset df we load in the init class
+        results_df = self._merge_df(results_df)
+        metrics = RankingMetrics(results_df.msd_id.values, results_df.work_id.values)
+        codes, valid = metrics.encode(results_df['id'].values.tolist(), size=size)
+        return metrics, codes, valid, metrics.row_works
+
+    def _encode_query_responses(self, results_df, size=None):
+        """
+        Encode the responses (pruned to 'size' if set) of the queries of a ResultStore or of a results dataframe,
+        either indexed by query msd_id with the columns 'id' and 'score' (results of the run_*_task methods)
+        or with one column per query msd_id (eg. loaded from json)
+        """
+        if isinstance(results_df, ResultStore):
+            query_ids = results_df.query_ids
+            codes, valid = self.metrics.encode_store(results_df, query_ids, size=size)
+        elif 'id' in results_df.columns:
+            query_ids = results_df.index.values
+            codes, valid = self.metrics.encode(results_df['id'].values.tolist(), size=size)
+        else:
+            query_ids = list(results_df.keys())
+            codes, valid = self.metrics.encode([results_df[query_id][0] for query_id in query_ids], size=size)
+        return codes, valid, self.metrics.query_works(query_ids)
+
     def average_rank(self, results_df):
         """
         Computes average position of relevant documents and measures where the relevant docs falls in a ranked list
         """
-        average_ranks = list()
-        for query_id in results_df.keys():
-            # response_ids = self.ast.literal_eval(results_df[query_id][0])
-            response_ids = results_df[query_id][0]
-            if type(response_ids) == list:
-                clique_id = self.dataset.work_id[self.dataset.msd_id == query_id].values[0]
-                clique_songs = self.dataset.msd_id[self.dataset.work_id == clique_id].values
-                # true_list = len(self.np.intersect1d(clique_songs, response_ids))
-                true_idx = [response_ids.index(x) for x in response_ids if x in clique_songs]
-                if len(true_idx) == 0:
-                    average_ranks.append(1000000)
-                    # pass
-                else:
-                    average_ranks.append(self.np.average(true_idx))
-        return self.np.average(average_ranks)
+        codes, valid, works = self._encode_query_responses(results_df)
+        return self.np.average(self.metrics.average_rank(codes, valid, works))
 
     def mean_rank_first_cover(self, results_df):
         """
         Mean rank of the first correctly identified cover
         """
-        mean_ranks = list()
-        for query_id in results_df.keys():
-            # response_ids = self.ast.literal_eval(results_df[query_id][0])
-            response_ids = results_df[query_id][0]
-            if type(response_ids) == list:
-                clique_id = self.dataset.work_id[self.dataset.msd_id == query_id].values[0]
-                clique_songs = self.dataset.msd_id[self.dataset.work_id == clique_id].values
-                # true_list = len(self.np.intersect1d(clique_songs, response_ids))
-                true_idx = [response_ids.index(x) for x in response_ids if x in clique_songs]
-                if len(true_idx) == 0:
-                    # mean_ranks.append(0)
-                    pass
-                else:
-                    mean_ranks.append(true_idx[0]+1)
-
-        return self.np.mean(mean_ranks)
+        codes, valid, works = self._encode_query_responses(results_df)
+        return self.np.mean(self.metrics.rank_first_cover(codes, valid, works))
 
     def covers_identified(self, results_df, size=None):
         """
         Total number of covers identified compared to the dataset
         """
-        total_covers = list()
-        percentage = list()
-        # here you merge the results_df with the shs_dataset df we load in the init class
-        results_df = self._merge_df(results_df)
-        for index, response in results_df.iterrows():
-            if type(response['id']) == list:
-                if size:
-                    response_ids = response['id'][:size]
-                else:
-                    response_ids = response['id']
-                clique_songs = results_df.msd_id[results_df.work_id == response['work_id']].values
-                # check intersection of two list for detected covers
-                detected_covers = self.np.intersect1d(clique_songs, response_ids)
-                total_covers.append(len(detected_covers))
-                percentage.append((len(detected_covers) / float(len(clique_songs)))*100)
-        return total_covers, percentage
+        metrics, codes, valid, works = self._encode_results(results_df, size=size)
+        total_covers, percentage = metrics.covers_identified(codes, valid, works)
+        return total_covers.tolist(), percentage.tolist()
 
     def total_covers_identified(self, results_df):
         """
@@ -693,3 +823,181 @@ class Experiments(object):
         """
         total_covers, percentage = self.covers_identified(results_df, size=size)
         return self.np.mean(percentage)
+
+    def prune_sweep(self, results_df, sizes):
+        """
+        Evaluation metrics of the results pruned to each prune size of 'sizes' in a single pass over the responses
+        (same values as mean_average_precision, mean_percentage_of_covers and mean_rank_first_cover
+        on the results pruned to each size)
+
+        :param results_df: results dataframe or ResultStore of a task run with a size >= max(sizes)
+        :param sizes: list of prune sizes
+        :return: pandas dataframe with the columns ['size', 'map', 'mper', 'mr1'] (one row per size)
+        """
+        sizes = sorted(set(int(size) for size in sizes))
+        metrics, codes, valid, works = self._encode_results(results_df, size=max(sizes))
+        mean_avg_precisions, mean_percentages = metrics.cutoff_metrics(codes, valid, works, sizes)
+
+        # the rank of the first cover is averaged over the queries of the results (same as mean_rank_first_cover)
+        codes, valid, works = self._encode_query_responses(results_df, size=max(sizes))
+        mean_ranks = self.metrics.cutoff_rank_first_cover(codes, valid, works, sizes)
+
+        return self.pd.DataFrame({'size': sizes, 'map': mean_avg_precisions, 'mper': mean_percentages,
+                                  'mr1': mean_ranks}, columns=['size', 'map', 'mper', 'mr1'])
+
+    def run_prune_sweep_task(self, sizes, task='run_song_title_match_task', **task_params):
+        """
+        Run a task once with the largest prune size and evaluate it for all the prune sizes (check prune_sweep)
+            eg. sweep = exp.run_prune_sweep_task(range(10, 1001, 10), task='run_mxm_lyrics_search_task')
+                plots.plot_optimal_topN_pruning(sweep)
+
+        [NOTE]: the response of a task at a prune size k is the top k of its response at a larger size
+        for the title and lyrics search tasks, but not for the rerank tasks which rerank the top k hits.
+        """
+        results = getattr(self, task)(size=max(sizes), **task_params)
+        return self.prune_sweep(results, sizes)
+
+    def _run_with_profile(self, task, profile, size, query_ids=None, **task_params):
+        """
+        Run a task with an experiment profile (and on the query songs 'query_ids' if set) and returns a ResultStore,
+        the profile, query songs and results format of the experiment are restored afterwards
+        """
+        state = (self.shs_mode, self.filter_duplicates, self.dzr_map, self.results_format, self.query_ids,
+                 self.query_titles)
+        self.shs_mode, self.filter_duplicates, self.dzr_map = (profile['shs_mode'], profile['filter_duplicates'],
+                                                               profile['dzr_map'])
+        self.results_format = 'store'
+        if query_ids is not None:
+            titles = dict(zip(self.query_ids, self.query_titles))
+            self.query_ids = list(query_ids)
+            self.query_titles = [titles[msd_id] for msd_id in self.query_ids]
+        try:
+            return getattr(self, task)(size=size, **task_params)
+        finally:
+            (self.shs_mode, self.filter_duplicates, self.dzr_map, self.results_format, self.query_ids,
+             self.query_titles) = state
+
+    def run_superset_task(self, profiles=None, task='run_song_title_match_task', size=100, overfetch=2.,
+                          flags=None, **task_params):
+        """
+        Run a search task once with the loosest of several experiment profiles at an over-fetched depth and derive
+        the results of each profile client-side (check utilities/profiles.py), instead of one run per profile.
+        The profile filters are non-scoring, so the derived responses are the ones of a run with the profile.
+        The query songs with an incomplete derived response (less than 'size' hits kept from a full superset
+        response) are searched again with the profile.
+            eg. results = exp.run_superset_task(task='run_song_title_match_task', size=100)
+
+        :param profiles: {default : None} dict {name: profile} of the experiment profiles
+            (all the profiles of templates.py if None)
+        :param task: {default : 'run_song_title_match_task'} Available tasks (['run_song_title_match_task',
+            'run_cleaned_song_title_task', 'run_mxm_lyrics_search_task'])
+        :param size: {default : 100} required size of the responses of each profile
+        :param overfetch: {default : 2.} depth of the superset responses as a multiple of 'size'
+        :param flags: {default : None} precomputed pandas dataframe indexed by msd_id with the columns
+            ['shs_id', 'msd_is_duplicate_of', 'dzr_song_title'] of the indexed songs
+            (eg. IndexSnapshot('./snapshots/msd').to_dataframe(FLAG_FIELDS)),
+            otherwise the flags are read from the '_source' of the hits of the superset responses
+        :param task_params: other parameters of the task (eg. batch_size=200)
+        :return: dict {name: results} with the results of each profile (check results_format)
+        """
+        if task not in ['run_song_title_match_task', 'run_cleaned_song_title_task', 'run_mxm_lyrics_search_task']:
+            raise Exception("\nInvalid 'task' parameter %s for a superset run" % task)
+        profiles = dict(profiles or presets.profiles)
+        depth = int(self.np.ceil(size * overfetch))
+        LOGGER.info("\nSuperset run of %s with a depth of %s for the profiles %s" % (task, depth, sorted(profiles)))
+
+        hit_fields = self.es.hit_fields
+        if flags is None:
+            self.es.collect_hit_fields(FLAG_FIELDS)
+        try:
+            store = self._run_with_profile(task, loosest_profile(profiles.values()), depth, **task_params)
+        finally:
+            self.es.collect_hit_fields(hit_fields)
+
+        table = store.id_table.tolist()
+        if flags is None:
+            missing = [msd_id for msd_id in table
+                       if any(msd_id not in self.es.field_cache.get(field, {}) for field in FLAG_FIELDS)]
+            if missing:
+                self.es.prefetch_fields(missing, FLAG_FIELDS)
+            id_flags = encode_flags([[self.es.get_field_info_from_id(msd_id, field) for field in FLAG_FIELDS]
+                                     for msd_id in table])
+        else:
+            id_flags = encode_flags(flags.reindex(table))
+        # a superset response shorter than the depth has all the matching hits of the loosest profile
+        full = store.lengths >= depth
+
+        results = dict()
+        for name, profile in profiles.items():
+            ids, scores, lengths = derive_profile(store.ids, store.scores, id_flags, profile, size)
+            derived = ResultStore(store.query_ids, store.id_table, ids, scores, store.valid)
+            rows = self.np.nonzero(store.valid & full & (lengths < size))[0]
+            LOGGER.info("\nProfile %s : %s query songs searched again" % (name, len(rows)))
+            if len(rows):
+                refill = self._run_with_profile(task, profile, size, query_ids=store.query_ids[rows].tolist(),
+                                                **task_params)
+                order = self.np.arange(len(derived))
+                order[rows] = len(derived) + refill.row_of(store.query_ids[rows])
+                derived = ResultStore.concat([derived, refill]).take(order)
+            results[name] = derived if self.results_format == 'store' else derived.to_dataframe()
+        return results
+
+    def _dataset_responses(self, results_df, query_ids=None):
+        """
+        List of the (ids, scores) responses of the dataset rows, or of the list 'query_ids' if set
+        ((None, None) for the missing queries)
+        """
+        if query_ids is None:
+            query_ids = self.dataset.msd_id.values
+        if isinstance(results_df, ResultStore):
+            return [results_df.response(row) if row >= 0 else (None, None)
+                    for row in results_df.row_of(query_ids)]
+        results_df = results_df.reindex(query_ids)
+        return [(ids, scores) if type(ids) == list else (None, None)
+                for ids, scores in zip(results_df['id'].values, results_df['score'].values)]
+
+    def rerank_sweep(self, results_df, strategy='lyrics', rerank_results=None, hit_fields=None,
+                     thresholds=(0.1, 0.25, 0.5, 0.75, 1.), sizes=None, n_jobs=-1):
+        """
+        [OFFLINE EXPERIMENT]
+
+        Evaluate a rerank strategy of the stored responses of a task for a grid of thresholds and prune sizes
+        without any es request (check utilities/sweep.py)
+            eg. sweep = exp.rerank_sweep(title_res, 'lyrics', rerank_results=lyrics_res, sizes=[10, 100])
+
+        :param results_df: results (dataframe or ResultStore) of the title task
+            (run_song_title_match_task or run_cleaned_song_title_task) with the largest prune size
+        :param strategy: {default : 'lyrics'} Available strategies (['lyrics', 'field', 'audio'])
+            'lyrics' - promotion of the hits in the head of the lyrics responses (rerank_results)
+            'field' - promotion of the hits of the same artist as the query song (hit_fields)
+            'audio' - promotion of the audio hits (rerank_results) with a distance below the threshold
+        :param rerank_results: results (dataframe or ResultStore) of the lyrics or audio task
+        :param hit_fields: pandas series of the artist ids ('msd_artist_id') of the response msd_ids
+            (eg. IndexSnapshot('./snapshots/msd').to_dataframe(['msd_artist_id']).msd_artist_id)
+        :param thresholds: list of the thresholds (proximity) of the strategy
+        :param sizes: {default : None} list of prune sizes (the size of the results if None)
+        :param n_jobs: {default : -1} number of parallel jobs (-1 for one per cpu core)
+        :return: pandas dataframe with the columns ['threshold', 'size', 'map', 'mper']
+        """
+        from utilities.sweep import rerank_sweep
+
+        title_res = self._dataset_responses(results_df)
+        if strategy == 'field':
+            if hit_fields is None:
+                raise Exception("\nThe 'field' strategy requires the 'hit_fields' of the responses")
+            table, [base] = rerank.encode_rankings(title_res)
+            _, [(fields, _), (query_fields, _)] = rerank.encode_rankings(
+                [(hit_fields.reindex(ids).values.tolist() if ids else None, None) for ids, _ in title_res],
+                [([self.get_artist_id(msd_id)], None) for msd_id in self.dataset.msd_id.values])
+            other = (fields, query_fields[:, 0])
+        else:
+            if rerank_results is None:
+                raise Exception("\nThe '%s' strategy requires the 'rerank_results' of the responses" % strategy)
+            table, [base, other] = rerank.encode_rankings(title_res, self._dataset_responses(rerank_results))
+
+        valid = self.np.array([ids is not None for ids, _ in title_res], dtype=bool)
+        sizes = sizes or [base[0].shape[1]]
+        LOGGER.info("\nRerank sweep of the '%s' strategy over %s thresholds and %s prune sizes"
+                    % (strategy, len(thresholds), len(sizes)))
+        return rerank_sweep(self.metrics, self.metrics.row_works, valid, table, base, other, strategy,
+                            list(thresholds), list(sizes), n_jobs=n_jobs)
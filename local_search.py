@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory stand-in of the es_search.py -> SearchModule class.
+
+LocalSearchModule answers the query DSL built by the SearchModule methods over a snapshot of the index fields
+loaded in memory, without any es cluster. Titles are matched with the BM25 similarity and lyrics with an
+approximation of the es more_like_this query, so that the experiments, benchmarks and CI can run on a laptop
+and the es overhead can be separated from the client-side overhead.
+
+Supported query DSL : bool (must, must_not, filter), simple_query_string, query_string (terms only),
+more_like_this (text or indexed documents), exists, ids, match_all. The analyzer is an approximation
+of the es standard analyzer (lowercased unicode word tokens).
+
+Usage:
+    docs = pd.read_csv('./msd_fields.csv', index_col='msd_id')
+    es = LocalSearchModule(docs)
+    exp = Experiments(es, './data/train_shs.csv', presets.shs_shs)
+    results = exp.run_song_title_match_task(size=100)
+"""
+from es_search import SearchModule
+from utilities.instrumentation import query_template_name
+from utilities.snapshot import IndexSnapshot
+import templates as presets
+import pandas as pd
+import numpy as np
+import time
+import re
+
+
+TOKEN_REGEX = re.compile(r"\w+", re.UNICODE)
+
+
+def analyze(text):
+    """Split a text into lowercased unicode word tokens (approximation of the es standard analyzer)"""
+    if text is None or type(text) == float:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+    return TOKEN_REGEX.findall(text.lower())
+
+
+class FieldIndex(object):
+    """
+    Inverted index of a text field with numpy postings for BM25 scoring
+    """
+
+    def __init__(self, texts, k1=1.2, b=0.75):
+        """
+        Init params:
+                    texts : list of the field texts of all the documents (None for missing values)
+                    k1, b : BM25 parameters (es defaults)
+        """
+        self.k1 = k1
+        self.b = b
+        self.n_docs = len(texts)
+        postings = dict()
+        doc_lengths = np.zeros(self.n_docs, dtype=np.float32)
+        for doc_idx, text in enumerate(texts):
+            tokens = analyze(text)
+            doc_lengths[doc_idx] = len(tokens)
+            counts = dict()
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.iteritems():
+                postings.setdefault(token, []).append((doc_idx, count))
+        self.postings = dict()
+        for token, docs in postings.iteritems():
+            docs = np.array(docs, dtype=np.int64)
+            self.postings[token] = (docs[:, 0], docs[:, 1].astype(np.float32))
+        self.doc_lengths = doc_lengths
+        self.avg_length = doc_lengths[doc_lengths > 0].mean() if (doc_lengths > 0).any() else 1.
+        return
+
+    def doc_freq(self, term):
+        return len(self.postings[term][0]) if term in self.postings else 0
+
+    def idf(self, term):
+        """BM25 idf of a term as computed by lucene"""
+        n = self.doc_freq(term)
+        return np.log(1. + (self.n_docs - n + 0.5) / (n + 0.5))
+
+    def score(self, terms):
+        """
+        Returns the BM25 scores of all the documents for a list of query terms (OR operator)
+        and the number of distinct query terms matched by each document
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float64)
+        matched = np.zeros(self.n_docs, dtype=np.int32)
+        for term in set(terms):
+            if term not in self.postings:
+                continue
+            doc_idxs, tfs = self.postings[term]
+            norm = self.k1 * (1. - self.b + self.b * self.doc_lengths[doc_idxs] / self.avg_length)
+            # a term repeated in the query is scored once per occurrence as in lucene boolean queries
+            scores[doc_idxs] += terms.count(term) * self.idf(term) * tfs * (self.k1 + 1.) / (tfs + norm)
+            matched[doc_idxs] += 1
+        return scores, matched
+
+
+class LocalSearchModule(SearchModule):
+    """
+    In-memory stand-in of SearchModule implementing the same methods over a snapshot of the index fields
+    """
+
+    def __init__(self, docs, uri_config=None, query_json=None, k1=1.2, b=0.75, cache=None):
+        """
+        Init params:
+                    docs : pandas dataframe of the index documents indexed by msd_id with one column per field
+                           (eg. 'msd_title', 'dzr_msd_title_clean', 'msd_artist_id', 'shs_id',
+                           'msd_is_duplicate_of', 'mxm_lyrics', 'dzr_song_title')
+                    uri_config : {default : None} only the 'index' name of the uri_config is used
+                    query_json : {default : None} title query template (same as SearchModule)
+                    k1, b : BM25 parameters (es defaults)
+                    cache : {default : None} ResponseCache instance (utilities/response_cache.py)
+        """
+        if uri_config is None:
+            uri_config = dict(presets.uri_config, index=presets.uri_config['index'] or 'local')
+        SearchModule.__init__(self, uri_config, query_json=query_json, cache=cache)
+        if 'msd_id' in docs.columns:
+            docs = docs.set_index('msd_id')
+        self.docs = docs
+        self.doc_ids = docs.index.values
+        self.k1 = k1
+        self.b = b
+        self._id_index = pd.Index(self.doc_ids)
+        self._field_indexes = dict()
+        self._exists = dict()
+        return
+
+    @classmethod
+    def from_file(cls, docs_file, **kwargs):
+        """
+        Load the documents from a csv file or a json lines file (one json document with a 'msd_id' key per line)
+        """
+        if docs_file.endswith('.csv'):
+            docs = pd.read_csv(docs_file)
+        else:
+            docs = pd.read_json(docs_file, lines=True)
+        return cls(docs, **kwargs)
+
+    @classmethod
+    def from_snapshot(cls, snapshot_path, fields=None, **kwargs):
+        """
+        Load the documents from a columnar snapshot of the index (check SearchModule.export_snapshot)
+        """
+        return cls(IndexSnapshot(snapshot_path).to_dataframe(fields), **kwargs)
+
+    @property
+    def handler(self):
+        raise Exception("\nLocalSearchModule doesn't have any es handler")
+
+    def _field_index(self, field):
+        """Inverted index of a field built on the first query on the field"""
+        if field not in self._field_indexes:
+            if field not in self.docs.columns:
+                raise Exception("\nField '%s' is not in the local snapshot" % field)
+            self._field_indexes[field] = FieldIndex(self.docs[field].values.tolist(), k1=self.k1, b=self.b)
+        return self._field_indexes[field]
+
+    def _exists_mask(self, field):
+        """Boolean mask of the documents with a non-empty value for a field"""
+        if field not in self._exists:
+            if field not in self.docs.columns:
+                self._exists[field] = np.zeros(len(self.docs), dtype=bool)
+            else:
+                values = self.docs[field]
+                self._exists[field] = (values.notnull() & (values != '')).values
+        return self._exists[field]
+
+    def _rows_of_ids(self, msd_ids):
+        rows = self._id_index.get_indexer(list(msd_ids))
+        return rows[rows >= 0]
+
+    def _text_query(self, fields, text):
+        """BM25 scores of a text query on several fields (best field for each doc)"""
+        terms = analyze(text)
+        scores = np.zeros(len(self.docs), dtype=np.float64)
+        matched = np.zeros(len(self.docs), dtype=bool)
+        for field in fields:
+            field_scores, field_matched = self._field_index(field).score(terms)
+            scores = np.maximum(scores, field_scores)
+            matched |= field_matched > 0
+        return scores, matched
+
+    def _more_like_this(self, params):
+        """
+        Approximation of the es more_like_this query: the 'max_query_terms' terms of the liked texts
+        with the highest tf-idf are searched with BM25 and a minimum_should_match of 30%
+        """
+        fields = params.get('fields', ['_all'])
+        likes = params['like'] if isinstance(params['like'], list) else [params['like']]
+        min_term_freq = params.get('min_term_freq', 2)
+        min_doc_freq = params.get('min_doc_freq', 5)
+        max_query_terms = params.get('max_query_terms', 25)
+
+        scores = np.zeros(len(self.docs), dtype=np.float64)
+        matched = np.zeros(len(self.docs), dtype=bool)
+        liked_rows = list()
+        for field in fields:
+            index = self._field_index(field)
+            term_freqs = dict()
+            for like in likes:
+                if isinstance(like, dict):
+                    # indexed document reference {'_index': ..., '_id': ...}
+                    rows = self._rows_of_ids([like['_id']])
+                    liked_rows.extend(rows)
+                    text = self.docs[field].values[rows[0]] if len(rows) else None
+                else:
+                    text = like
+                for term in analyze(text):
+                    term_freqs[term] = term_freqs.get(term, 0) + 1
+
+            candidates = list()
+            for term, tf in term_freqs.iteritems():
+                doc_freq = index.doc_freq(term)
+                if tf < min_term_freq or doc_freq < min_doc_freq or doc_freq == 0:
+                    continue
+                # lucene classic idf used by the MoreLikeThis term selection
+                candidates.append((tf * (1. + np.log(index.n_docs / (doc_freq + 1.))), term))
+            terms = [term for _, term in sorted(candidates, reverse=True)[:max_query_terms]]
+            if not terms:
+                continue
+            field_scores, field_matched = index.score(terms)
+            minimum_should_match = max(1, int(len(terms) * 0.3))
+            scores = np.maximum(scores, field_scores)
+            matched |= field_matched >= minimum_should_match
+
+        # the liked documents are excluded from the response as in es
+        matched[np.array(liked_rows, dtype=np.int64)] = False
+        return scores, matched
+
+    def _clause(self, clause):
+        """Returns the (scores, matched) arrays of a query DSL clause"""
+        query_type, params = clause.items()[0]
+        n_docs = len(self.docs)
+        if query_type == 'simple_query_string':
+            return self._text_query(params.get('fields', ['_all']), params['query'])
+        if query_type == 'query_string':
+            return self._text_query([params.get('default_field', '_all')], params['query'])
+        if query_type == 'more_like_this':
+            return self._more_like_this(params)
+        if query_type == 'exists':
+            return np.zeros(n_docs), self._exists_mask(params['field']).copy()
+        if query_type == 'ids':
+            matched = np.zeros(n_docs, dtype=bool)
+            matched[self._rows_of_ids(params['values'])] = True
+            return np.zeros(n_docs), matched
+        if query_type == 'match_all':
+            return np.ones(n_docs), np.ones(n_docs, dtype=bool)
+        if query_type == 'bool':
+            return self._bool(params)
+        raise Exception("\nQuery type '%s' is not supported by LocalSearchModule" % query_type)
+
+    def _bool(self, bool_query):
+        n_docs = len(self.docs)
+        scores = np.zeros(n_docs, dtype=np.float64)
+        matched = np.ones(n_docs, dtype=bool)
+        for clause in bool_query.get('must', []):
+            clause_scores, clause_matched = self._clause(clause)
+            scores += clause_scores
+            matched &= clause_matched
+        for clause in bool_query.get('filter', []):
+            matched &= self._clause(clause)[1]
+        for clause in bool_query.get('must_not', []):
+            matched &= ~self._clause(clause)[1]
+        return scores, matched
+
+    def _hit(self, row, score, source_fields):
+        source = dict()
+        for field in source_fields:
+            value = self.docs[field].values[row]
+            source[field] = None if type(value) == float and np.isnan(value) else value
+        return {'_index': self.config['index'], '_id': self.doc_ids[row], '_score': float(score), '_source': source}
+
+    def search_es(self, body):
+        """
+        Search the local snapshot with a query DSL post json (same interface as SearchModule.search_es)
+        """
+        if self.cache is not None:
+            hits = self.cache.get_search(self.config["index"], body)
+            if hits is not None:
+                return self._collect_hits(hits)
+        start = time.time()
+        scores, matched = self._clause(body.get('query', {'match_all': {}}))
+        rows = np.nonzero(matched)[0]
+        # sort by descending score, ties are broken by the order of the docs in the snapshot
+        order = np.lexsort((rows, -scores[rows]))
+        offset = body.get('from', 0)
+        rows = rows[order[offset:offset + body.get('size', 10)]]
+
+        source_fields = body.get('_source', [c for c in self.docs.columns if 'lyrics' not in c])
+        if source_fields is False:
+            source_fields = []
+        hits = [self._hit(row, scores[row], source_fields) for row in rows]
+        self.recorder.record('search', (time.time() - start) * 1000, hits=len(hits), template=query_template_name(body))
+        if self.cache is not None:
+            self.cache.put_search(self.config["index"], body, hits)
+        return self._collect_hits(hits)
+
+    def msearch_es(self, bodies, batch_size=100):
+        """Same interface as SearchModule.msearch_es"""
+        return [self.search_es(body) for body in bodies]
+
+    def get_field_info_from_id(self, msd_id, field):
+        """Retrieve the value of a field of a document from the local snapshot"""
+        if msd_id in self.field_cache.get(field, {}):
+            return self.field_cache[field][msd_id]
+        rows = self._rows_of_ids([msd_id])
+        if not len(rows) or field not in self.docs.columns:
+            return None
+        value = self.docs[field].values[rows[0]]
+        if (type(value) == float and np.isnan(value)) or not value:
+            return None
+        return value
+
+    def prefetch_fields(self, msd_ids, fields, chunk_size=1000):
+        """The fields are already in memory, nothing to prefetch"""
+        return
@@ -12,16 +12,13 @@ R&D Intern
 
 import os
 
-assert os.environ["MSDES_HOST"]
-assert os.environ["MSDES_PORT"]
-assert os.environ["MSDES_INDEX"]
-assert os.environ["MSDES_TYPE"]
-
+# es db credentials. They are only required when a request is made to the es db, so that the templates
+# can be used without a live es cluster (eg. with the in-memory LocalSearchModule of local_search.py)
 SCHEME = "http"
-URI = os.environ["MSDES_HOST"]
-PORT = os.environ["MSDES_PORT"]
-ES_INDEX = os.environ["MSDES_INDEX"]
-ES_TYPE = os.environ["MSDES_TYPE"]
+URI = os.environ.get("MSDES_HOST")
+PORT = os.environ.get("MSDES_PORT")
+ES_INDEX = os.environ.get("MSDES_INDEX")
+ES_TYPE = os.environ.get("MSDES_TYPE")
 
 
 uri_config = {
@@ -170,6 +167,15 @@ shs_shs_no_dup = {
     'shs_mode': True
 }
 
+# all the experiment profiles by name (eg. to register the stored search templates of each profile)
+profiles = {
+    'shs_msd': shs_msd,
+    'shs_msd_no_dup': shs_msd_no_dup,
+    'shs_dzr_msd': shs_dzr_msd,
+    'shs_shs': shs_shs,
+    'shs_shs_no_dup': shs_shs_no_dup
+}
+
 output_evaluations = {
     'size': 100,
     'map': 0,
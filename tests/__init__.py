@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the experiments which run without any es cluster (on LocalSearchModule or on the stub server)
+
+Usage (from the root of the repository):
+    $ python -m unittest discover -s tests -t .
+"""
+import os
+
+# the modules of the experiments log to the ./logs folder
+if not os.path.isdir('./logs'):
+    os.makedirs('./logs')
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+The coalesced title searches (es_search.py -> SearchModule.coalesced_search) return the same responses
+as one request per query song
+"""
+from local_search import LocalSearchModule
+import pandas as pd
+import unittest
+
+
+DOCS = pd.DataFrame({'msd_id': ['TR%02d' % index for index in range(8)],
+                     'msd_title': ['My Sweet Lord', 'My Sweet  Lord', 'None Of Your Business', 'None',
+                                   'Sweet Home', 'Lord Of The Dance', 'Home', 'my sweet lord'],
+                     'dzr_msd_title_clean': ['my sweet lord', 'my sweet lord', 'none of your business', None,
+                                             'sweet home', 'lord of the dance', None, 'my sweet lord']})
+
+
+class CoalescedSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.es = LocalSearchModule(DOCS)
+
+    def check_same_responses(self, queries, field='msd_title'):
+        for batch_size in [None, 3]:
+            coalesced = self.es.batch_search_by_exact_title(queries, field=field, batch_size=batch_size,
+                                                            coalesce=True)
+            single = self.es.batch_search_by_exact_title(queries, field=field, batch_size=batch_size or 100,
+                                                         coalesce=False)
+            self.assertEqual(coalesced, single)
+
+    def test_same_titles(self):
+        self.check_same_responses([(title, msd_id, size) for msd_id, title, size in
+                                   zip(DOCS.msd_id, DOCS.msd_title, [5, 2, 5, 5, 1, 5, 5, 3])])
+
+    def test_missing_titles(self):
+        # a missing title is not a search for the word 'None'
+        queries = [(None, 'TR06', 5), (None, 'TR03', 5), ('', 'TR04', 5), ('None', 'TR01', 5),
+                   (float('nan'), 'TR05', 5)]
+        self.check_same_responses(queries)
+        self.assertEqual(self.es.coalesced_search(queries[:1])[0], [])
+
+    def test_missing_cleaned_titles(self):
+        self.assertEqual(self.es.batch_search_with_cleaned_title(DOCS.msd_id.tolist(), size=5, coalesce=True),
+                         self.es.batch_search_with_cleaned_title(DOCS.msd_id.tolist(), size=5, coalesce=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+The work queue of the distributed evaluation (utilities/work_queue.py) gives each shard a single committed
+result, and the results of the workers of distributed.py merged in the order of the shards are the ones of an
+unsharded run, on a synthetic index searched with a LocalSearchModule inherited by the worker processes
+"""
+from benchmarks.synthetic import make_dataset, make_index_docs, write_dataset
+from utilities.result_store import ResultStore
+from utilities.work_queue import WorkQueue
+from local_search import LocalSearchModule
+from experiments import Experiments
+import distributed
+import evaluations
+import templates as presets
+import multiprocessing
+import unittest
+import tempfile
+import shutil
+import time
+import os
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = WorkQueue(os.path.join(self.tmp_dir, 'queue', 'tasks.db'), max_attempts=2)
+        self.queue.enqueue([('shard_%s' % index, {'shard': index}) for index in range(2)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def expire():
+        """wait for the leases of 0 seconds to expire"""
+        time.sleep(0.01)
+
+    def test_enqueue_once(self):
+        self.assertEqual(self.queue.enqueue([('shard_1', {'shard': 1}), ('shard_2', {'shard': 2})]), 1)
+        self.assertEqual(self.queue.counts(), {'pending': 3, 'running': 0, 'done': 0, 'failed': 0})
+
+    def test_lease_expiry(self):
+        crashed = self.queue.claim('crashed', lease=0)
+        self.expire()
+        # the task of the crashed worker is claimed again before the other pending task
+        task = self.queue.claim('worker', lease=60)
+        self.assertEqual((task['id'], task['key'], task['attempts']), (crashed['id'], 'shard_0', 2))
+        self.assertFalse(self.queue.heartbeat(crashed['id'], 'crashed', lease=60))
+        self.assertTrue(self.queue.heartbeat(task['id'], 'worker', lease=60))
+        # the late commit of the worker which lost the lease is rejected
+        self.assertFalse(self.queue.complete(crashed['id'], 'crashed', result='crashed.npz'))
+        self.assertTrue(self.queue.complete(task['id'], 'worker', result='worker.npz'))
+        self.assertFalse(self.queue.complete(crashed['id'], 'crashed', result='crashed.npz'))
+        done = self.queue.tasks(status='done')
+        self.assertEqual([(done_task['key'], done_task['worker'], done_task['result']) for done_task in done],
+                         [('shard_0', 'worker', 'worker.npz')])
+        self.assertEqual(self.queue.claim('other', lease=60)['key'], 'shard_1')
+        self.assertIsNone(self.queue.claim('other', lease=60))
+        self.assertFalse(self.queue.is_finished())
+
+    def test_max_attempts(self):
+        # shard_0 : two expired leases, shard_1 : two errors
+        for worker in ['crashed_1', 'crashed_2']:
+            self.assertEqual(self.queue.claim(worker, lease=0)['key'], 'shard_0')
+            self.expire()
+        for worker in ['worker_1', 'worker_2']:
+            task = self.queue.claim(worker, lease=60)
+            self.assertEqual((task['key'], task['attempts']), ('shard_1', int(worker[-1])))
+            self.assertTrue(self.queue.fail(task['id'], worker, 'ValueError()'))
+        self.assertIsNone(self.queue.claim('worker_3', lease=60))
+        self.assertEqual(self.queue.counts(), {'pending': 0, 'running': 0, 'done': 0, 'failed': 2})
+        self.assertTrue(self.queue.is_finished())
+        self.assertEqual([(task['key'], task['error']) for task in self.queue.tasks(status='failed')],
+                         [('shard_0', 'lease expired'), ('shard_1', 'ValueError()')])
+
+
+class DistributedTest(unittest.TestCase):
+
+    methods = ['msd_title', 'mxm_lyrics', 'title_mxm_lyrics']
+    size = 10
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp()
+        dataset = make_dataset(150)
+        cls.shs_csv = write_dataset(dataset, os.path.join(cls.data_dir, 'dataset.csv'))
+        cls.es = LocalSearchModule(make_index_docs(dataset, n_noise=300))
+        # the worker processes are forked with the worker state searching the synthetic index
+        evaluations._worker_state.clear()
+        evaluations._worker_state['es'] = cls.es
+        cls.unsharded = dict()
+        for method in cls.methods:
+            exp = Experiments(cls.es, cls.shs_csv, presets.shs_msd, results_format='store')
+            task, task_params = evaluations.TASKS[method]
+            cls.unsharded[method] = getattr(exp, task)(size=cls.size, verbose=False, **task_params)
+
+    @classmethod
+    def tearDownClass(cls):
+        evaluations._worker_state.clear()
+        shutil.rmtree(cls.data_dir)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue_path = os.path.join(self.tmp_dir, 'queue.db')
+        self.results_dir = os.path.join(self.tmp_dir, 'results')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_merged(self, merged, output_dir):
+        exp = Experiments(self.es, self.shs_csv, presets.shs_msd, results_format='store')
+        self.assertEqual(sorted(merged.method), sorted(self.methods))
+        for row in merged.itertuples():
+            self.assertEqual((row.n_shards, row.shards_done), (4, 4))
+            unsharded = self.unsharded[row.method]
+            self.assertEqual(row.map, exp.mean_average_precision(unsharded))
+            self.assertEqual(row.mper, exp.mean_percentage_of_covers(unsharded))
+            experiment = '%s|shs_msd|%s|%s' % (self.shs_csv, row.method, self.size)
+            results = ResultStore.load(os.path.join(output_dir, distributed._file_name(experiment)))
+            self.assertEqual(results.query_ids.tolist(), unsharded.query_ids.tolist())
+            for index in range(len(unsharded.query_ids)):
+                self.assertEqual(results.response(index), unsharded.response(index))
+
+    def test_merge_shard_order(self):
+        # the shards are enqueued (and run) in the reverse order
+        tasks = distributed.build_tasks([self.shs_csv], self.methods, ['shs_msd'], [self.size], shard_size=40)
+        WorkQueue(self.queue_path).enqueue(tasks[::-1])
+        self.assertEqual(distributed.run_worker(self.queue_path, self.results_dir, poll=0, worker_id='worker'),
+                         len(tasks))
+        output_dir = os.path.join(self.tmp_dir, 'merged')
+        self.check_merged(distributed.merge_results(self.queue_path, output_dir=output_dir), output_dir)
+
+    def test_workers(self):
+        counts = distributed.run_coordinator(self.queue_path, datasets=[self.shs_csv], methods=self.methods,
+                                             profiles=['shs_msd'], sizes=[self.size], shard_size=40)
+        self.assertEqual(counts['pending'], 4 * len(self.methods))
+        queue = WorkQueue(self.queue_path)
+        # a worker crashing with a claimed shard
+        crashed = queue.claim('crashed', lease=0)
+
+        workers = [multiprocessing.Process(target=distributed.run_worker, args=(self.queue_path, self.results_dir),
+                                           kwargs={'lease': 60, 'poll': 0.05, 'worker_id': 'node_%s' % index})
+                   for index in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(300)
+        self.assertEqual([worker.exitcode for worker in workers], [0, 0])
+
+        self.assertFalse(queue.complete(crashed['id'], 'crashed', result='crashed.npz'))
+        self.assertEqual(queue.counts()['done'], 4 * len(self.methods))
+        for task in queue.tasks():
+            self.assertIn(task['worker'], ['node_0', 'node_1'])
+            self.assertEqual(os.path.dirname(task['result']), self.results_dir)
+            self.assertEqual(task['attempts'], 2 if task['id'] == crashed['id'] else 1)
+        output_dir = os.path.join(self.tmp_dir, 'merged')
+        self.check_merged(distributed.merge_results(self.queue_path, output_dir=output_dir), output_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+The vectorized ranking metrics (utilities/metrics.py) give the values of the original per-query loops
+of experiments.py on a hand-built dataset
+"""
+from experiments import Experiments
+from utilities.result_store import ResultStore
+import utils
+import pandas as pd
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import os
+
+
+# 3 cliques of 3, 2 and 4 songs, 2 songs without work_id
+DATASET = pd.DataFrame({'msd_id': ['A1', 'A2', 'A3', 'B1', 'B2', 'C1', 'C2', 'C3', 'C4', 'N1', 'N2'],
+                        'artist_id': ['AR%s' % index for index in range(11)],
+                        'title': ['t'] * 11,
+                        'work_id': [1, 1, 1, 2, 2, 3, 3, 3, 3, np.nan, np.nan]},
+                       columns=['msd_id', 'artist_id', 'title', 'work_id'])
+
+RESULTS = {
+    'A1': ['A2', 'X1', 'A3', 'B1'],
+    # duplicated ids count once, at their first position
+    'A2': ['X1', 'A1', 'A1', 'C1', 'A3', 'A3'],
+    'A3': ['X1', 'X2', 'X3'],
+    # empty response
+    'B1': [],
+    # no response (eg. no lyrics)
+    'B2': None,
+    'C1': ['C2', 'C3', 'C4'],
+    # the query itself in its response
+    'C2': ['C2', 'X1', 'C1', 'B2', 'C4', 'X2', 'X3', 'C3'],
+    'C3': ['B1', 'B2', 'X4', 'X5', 'X6', 'C1'],
+    'C4': ['C3'],
+    # queries without work_id
+    'N1': ['N2', 'A1'],
+    'N2': None
+}
+
+
+def baseline_average_precision(merged_df, size=None):
+    """Per-query loop of Experiments.average_precision before the vectorized metrics"""
+    avg_precisions = list()
+    for index, response in merged_df.iterrows():
+        if type(response['id']) == list:
+            response_ids = response['id'][:size] if size else response['id']
+            clique_songs = merged_df.msd_id[merged_df.work_id == response['work_id']].values
+            true_idx = [response_ids.index(x) for x in response_ids if x in clique_songs]
+            ground_truth = np.zeros(len(response_ids))
+            if len(true_idx) > 0:
+                ground_truth[true_idx] = 1
+            precision_at_k = np.cumsum(ground_truth) / np.arange(1., len(response_ids) + 1)
+            precision_list = ground_truth * precision_at_k
+            avg_precisions.append(sum(precision_list) / float(len(clique_songs) - 1))
+        else:
+            avg_precisions.append(0)
+    return avg_precisions
+
+
+def baseline_percentage_of_covers(merged_df, size=None):
+    """Per-query loop of Experiments.covers_identified before the vectorized metrics"""
+    percentage = list()
+    for index, response in merged_df.iterrows():
+        if type(response['id']) == list:
+            response_ids = response['id'][:size] if size else response['id']
+            clique_songs = merged_df.msd_id[merged_df.work_id == response['work_id']].values
+            detected_covers = np.intersect1d(clique_songs, response_ids)
+            # the loop raised a ZeroDivisionError for a query without work_id, the vectorized metric is NaN
+            percentage.append((len(detected_covers) / float(len(clique_songs))) * 100 if len(clique_songs)
+                              else np.nan)
+    return percentage
+
+
+def baseline_rank_first_cover(dataset, results_df):
+    """Per-query loop of Experiments.mean_rank_first_cover before the vectorized metrics"""
+    mean_ranks = list()
+    for query_id in results_df.keys():
+        response_ids = results_df[query_id][0]
+        if type(response_ids) == list:
+            clique_id = dataset.work_id[dataset.msd_id == query_id].values[0]
+            clique_songs = dataset.msd_id[dataset.work_id == clique_id].values
+            true_idx = [response_ids.index(x) for x in response_ids if x in clique_songs]
+            if len(true_idx) > 0:
+                mean_ranks.append(true_idx[0] + 1)
+    return np.mean(mean_ranks)
+
+
+class RankingMetricsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        csv_file = os.path.join(cls.tmp_dir, 'dataset.csv')
+        DATASET.to_csv(csv_file, index=False)
+        cls.exp = Experiments(None, csv_file)
+        cls.results = dict((query_id, {'id': ids, 'score': None if ids is None else range(len(ids), 0, -1)})
+                           for query_id, ids in RESULTS.items())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def results_df(self):
+        return pd.DataFrame.from_dict(self.results, orient='index')
+
+    def merged_df(self):
+        return self.exp._merge_df(self.results_df())
+
+    def assert_same(self, value, expected):
+        if np.isnan(expected):
+            self.assertTrue(np.isnan(value))
+        else:
+            self.assertEqual(value, expected)
+
+    def test_mean_average_precision(self):
+        for size in [None, 1, 2, 3, 5, 100]:
+            expected = np.mean(baseline_average_precision(self.merged_df(), size=size))
+            self.assertEqual(self.exp.mean_average_precision(self.results_df(), size=size), expected)
+            # padded store responses
+            self.assertEqual(self.exp.mean_average_precision(ResultStore.from_dict(self.results), size=size),
+                             expected)
+
+    def test_mean_percentage_of_covers(self):
+        for size in [None, 1, 3, 100]:
+            expected = baseline_percentage_of_covers(self.merged_df(), size=size)
+            _, percentage = self.exp.covers_identified(self.results_df(), size=size)
+            self.assertEqual(len(percentage), len(expected))
+            for value, expected_value in zip(percentage, expected):
+                self.assert_same(value, expected_value)
+            self.assert_same(self.exp.mean_percentage_of_covers(self.results_df(), size=size), np.mean(expected))
+            self.assert_same(self.exp.mean_percentage_of_covers(ResultStore.from_dict(self.results), size=size),
+                             np.mean(expected))
+
+    def test_mean_rank_first_cover(self):
+        # results loaded as a dataframe with one column per query msd_id
+        columns_df = pd.DataFrame(dict((query_id, [result['id'], result['score']])
+                                       for query_id, result in self.results.items()))
+        expected = baseline_rank_first_cover(DATASET, columns_df)
+        self.assertEqual(self.exp.mean_rank_first_cover(columns_df), expected)
+        self.assertEqual(self.exp.mean_rank_first_cover(ResultStore.from_dict(self.results)), expected)
+        self.assertEqual(self.exp.mean_rank_first_cover(self.results_df()), expected)
+
+    def test_prune_sweep(self):
+        # each row of the sweep is the metrics of the results pruned to its size
+        sizes = [1, 2, 3, 5, 8]
+        for results in [self.results_df(), ResultStore.from_dict(self.results)]:
+            sweep = self.exp.prune_sweep(results, sizes)
+            for size, row in zip(sizes, sweep.itertuples()):
+                pruned = utils.slice_results(self.results, size)
+                pruned_df = pd.DataFrame.from_dict(pruned, orient='index')
+                self.assertEqual(row.map, self.exp.mean_average_precision(pruned_df))
+                self.assert_same(row.mper, self.exp.mean_percentage_of_covers(pruned_df))
+                self.assert_same(row.mr1, self.exp.mean_rank_first_cover(pruned_df))
+                self.assert_same(row.mr1, self.exp.mean_rank_first_cover(ResultStore.from_dict(pruned)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+The batched rerank primitives (utilities/rerank.py) rank like the original per-query loops of experiments.py
+"""
+from experiments import Experiments
+from utilities import rerank
+import pandas as pd
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import random
+import os
+
+
+def baseline_audio_rerank(text_ids, audio_ids, audio_scores, threshold):
+    """Ranking of the per-query loop of Experiments.run_audio_rerank_task before the batched primitives"""
+    if not audio_scores or not audio_ids:
+        return text_ids
+    top_list = [score for score in audio_scores if score <= threshold]
+    if not top_list:
+        return text_ids
+    # the loop promoted the positions 0..len(top_list)-1 of the audio response
+    top_ids = audio_ids[:len(top_list)]
+    return top_ids + [x for x in text_ids if x not in top_ids]
+
+
+class AudioRerankTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        rng = random.Random(0)
+        query_ids = ['Q%03d' % index for index in range(300)]
+        pool = ['TR%03d' % index for index in range(40)]
+        dataset = pd.DataFrame({'msd_id': query_ids, 'artist_id': 'AR', 'title': 't',
+                                'work_id': [index % 50 for index in range(len(query_ids))]})
+        dataset.to_csv(os.path.join(cls.tmp_dir, 'dataset.csv'), index=False)
+        cls.exp = Experiments(None, os.path.join(cls.tmp_dir, 'dataset.csv'))
+        cls.text, cls.audio = dict(), dict()
+        for index, query_id in enumerate(query_ids):
+            # text responses with duplicated ids, audio responses sorted or not by distance, empty or missing
+            text_ids = [rng.choice(pool) for _ in range(rng.randint(1, 15))]
+            cls.text[query_id] = {'id': text_ids, 'score': sorted([rng.uniform(0, 10) for _ in text_ids],
+                                                                   reverse=True)}
+            audio_ids = rng.sample(pool, rng.randint(0, 10))
+            audio_scores = [rng.uniform(0, 0.3) for _ in audio_ids]
+            if index % 2:
+                audio_scores.sort()
+            cls.audio[query_id] = {'id': audio_ids if index % 25 else None,
+                                   'score': audio_scores if index % 25 else None}
+        for name, results in [('text', cls.text), ('audio', cls.audio)]:
+            pd.DataFrame.from_dict(results, orient='index').to_json(os.path.join(cls.tmp_dir, name + '.json'))
+            # the scores as rounded in the json files
+            for query_id, result in pd.read_json(os.path.join(cls.tmp_dir, name + '.json')).iterrows():
+                results[query_id] = {'id': result['id'], 'score': result['score']}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_audio_rerank(self):
+        for threshold in [0., 0.1, 0.2, 1.]:
+            results = self.exp.run_audio_rerank_task(os.path.join(self.tmp_dir, 'text.json'),
+                                                     os.path.join(self.tmp_dir, 'audio.json'), threshold=threshold)
+            for query_id, audio in self.audio.items():
+                text = self.text[query_id]
+                expected = baseline_audio_rerank(text['id'], audio['id'], audio['score'], threshold)
+                self.assertEqual(list(results.loc[query_id, 'id']), expected)
+                # the promoted hits keep their audio score, the others their text score (first occurrence)
+                if expected is not text['id']:
+                    n_head = sum(score <= threshold for score in audio['score'])
+                    scores = audio['score'][:n_head] + [text['score'][text['id'].index(x)]
+                                                        for x in text['id'] if x not in audio['id'][:n_head]]
+                    self.assertEqual(list(results.loc[query_id, 'score']), scores)
+
+    def test_promote_prefix(self):
+        ids = np.array([[0, 1, 2, 1, -1], [3, 4, 5, 6, 7], [8, 9, -1, -1, -1]])
+        scores = np.array([[5., 4, 3, 2, np.nan], [9, 8, 7, 6, 5], [2, 1, np.nan, np.nan, np.nan]])
+        head_ids = np.array([[2, 7, 0], [3, 8, -1], [1, 2, 3]])
+        head_scores = np.array([[.1, .2, .3], [.05, .5, np.nan], [.1, .1, .1]])
+        new_ids, new_scores = rerank.promote_prefix(ids, scores, head_ids, head_scores, np.array([2, 1, 0]))
+        # the duplicated ids of the response are kept (as in the per-query loop)
+        self.assertEqual(new_ids[0][new_ids[0] >= 0].tolist(), [2, 7, 0, 1, 1])
+        self.assertEqual(new_scores[0][new_ids[0] >= 0].tolist(), [.1, .2, 5., 4., 4.])
+        self.assertEqual(new_ids[1][new_ids[1] >= 0].tolist(), [3, 4, 5, 6, 7])
+        self.assertEqual(new_scores[1][new_ids[1] >= 0].tolist(), [.05, 8, 7, 6, 5])
+        # no promoted hit, the response is unchanged
+        self.assertEqual(new_ids[2][new_ids[2] >= 0].tolist(), [8, 9])
+        self.assertEqual(new_scores[2][new_ids[2] >= 0].tolist(), [2., 1.])
+
+
+if __name__ == '__main__':
+    unittest.main()
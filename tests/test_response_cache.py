@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Several ResponseCache instances (eg. the joblib or distributed workers) share a cache file
+(utilities/response_cache.py): a reader doesn't lock the writers out and the size limit holds for all of them
+"""
+from utilities.response_cache import ResponseCache
+import unittest
+import tempfile
+import shutil
+import os
+
+
+def search_body(index):
+    return {'query': {'match': {'msd_title': 'title %s' % index}}, 'size': 10}
+
+
+def search_hits(index):
+    return [{'_id': 'TR%05d%02d' % (index, rank), '_score': 10. - rank} for rank in range(10)]
+
+
+class SharedResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'responses.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reader_releases_the_lock(self):
+        reader = ResponseCache(self.db_file, timeout=1)
+        writer = ResponseCache(self.db_file, timeout=1)
+        reader.put_searches('msd', [(search_body(index), search_hits(index)) for index in range(1200)])
+        # the hits of more than 1000 responses flush the buffered access times of the reader
+        for index in range(1200):
+            self.assertEqual(reader.get_search('msd', search_body(index)), search_hits(index))
+        writer.put_search('msd', search_body(1200), search_hits(1200))
+        self.assertEqual(reader.get_search('msd', search_body(1200)), search_hits(1200))
+        reader.close()
+        writer.close()
+
+    def test_shared_size_limit(self):
+        # each response takes about 100 bytes
+        caches = [ResponseCache(self.db_file, max_bytes=2000, timeout=1) for _ in range(2)]
+        for index in range(60):
+            caches[index % 2].put_search('msd', search_body(index), search_hits(index))
+            total = caches[0].connection.execute("""SELECT SUM(nbytes) FROM responses""").fetchone()[0]
+            self.assertLessEqual(total, 2000)
+        # the least recently used responses are evicted
+        self.assertIsNone(caches[0].get_search('msd', search_body(0)))
+        self.assertEqual(caches[0].get_search('msd', search_body(59)), search_hits(59))
+        for cache in caches:
+            cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+The task graph of the evaluation methods (evaluations.py -> run_task_graph) gives the MAP of each method run
+alone with its own task, on a synthetic index searched with a LocalSearchModule
+"""
+from benchmarks.synthetic import make_dataset, make_index_docs, write_dataset
+from local_search import LocalSearchModule
+from experiments import Experiments
+import evaluations
+import templates as presets
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import os
+
+
+METHODS = ["msd_title", "pre-msd_title", "mxm_lyrics", "title_mxm_lyrics", "pre-title_mxm_lyrics"]
+
+
+class TaskGraphTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        dataset = make_dataset(120)
+        cls.shs_csv = write_dataset(dataset, os.path.join(cls.tmp_dir, 'dataset.csv'))
+        cls.es = LocalSearchModule(make_index_docs(dataset, n_noise=240))
+        # the worker state of the current process searches the synthetic index
+        evaluations._worker_state.clear()
+        evaluations._worker_state['es'] = cls.es
+
+    @classmethod
+    def tearDownClass(cls):
+        evaluations._worker_state.clear()
+        shutil.rmtree(cls.tmp_dir)
+
+    def method_maps(self, size):
+        maps = dict()
+        for method in METHODS:
+            exp = Experiments(self.es, self.shs_csv, presets.shs_msd, results_format='store')
+            task, task_params = evaluations.TASKS[method]
+            maps[method] = exp.mean_average_precision(getattr(exp, task)(size=size, verbose=False, **task_params))
+        return maps
+
+    def test_lyrics_stages(self):
+        # the rerank methods and the mxm_lyrics method do not share their lyrics searches
+        graph = evaluations.build_task_graph(METHODS)
+        self.assertEqual(graph[('rerank', 'title_mxm_lyrics')], [('retrieval', 'title'),
+                                                                  ('retrieval', 'mxm_lyrics_doc')])
+        self.assertEqual(graph[('metrics', 'mxm_lyrics')], [('retrieval', 'mxm_lyrics')])
+        self.assertEqual(len([node for node in graph if node[0] == 'retrieval']), 4)
+
+    def test_same_maps(self):
+        for size in [5, 20]:
+            maps = self.method_maps(size)
+            # the synthetic cliques are found by each method
+            self.assertTrue(all(value > 0.1 for value in maps.values()), maps)
+            self.assertEqual(evaluations.run_task_graph(self.shs_csv, presets.shs_msd, METHODS, size, n_jobs=1),
+                             maps)
+
+    def test_like_doc_responses(self):
+        exp = Experiments(self.es, self.shs_csv, presets.shs_msd, results_format='store')
+        single = exp.run_mxm_lyrics_search_task(size=10, verbose=False, like_doc=True)
+        batched = exp.run_mxm_lyrics_search_task(size=10, verbose=False, like_doc=True, batch_size=7)
+        for index, query_id in enumerate(exp.query_ids):
+            self.assertEqual(single.response(index), batched.response(index))
+            # the lyrics response of the title and lyrics searches of the rerank tasks
+            _, (res_ids, res_scores) = self.es.search_title_and_lyrics(None, query_id, out_mode='eval', size=10)
+            self.assertEqual(single.response(index)[0], res_ids)
+            np.testing.assert_allclose(single.response(index)[1], res_scores, rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
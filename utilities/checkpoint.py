@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only on-disk checkpoint of the results of an experiment (experiments.py -> run_*_task methods).
+
+The results of a run are written by chunks of query songs, each chunk being a ResultStore
+(utilities/result_store.py) saved as a directory of numpy files. The manifest.json of the checkpoint
+lists the config of the run and the completed chunks, it is atomically replaced after each chunk is written,
+so that a run interrupted at any time can be resumed from its last completed chunk.
+
+Usage:
+    checkpoint = ResultCheckpoint('./results/title_mxm_lyrics', config={'task': 'title_mxm_lyrics', 'size': 100})
+    pending = [msd_id for msd_id in query_ids if msd_id not in checkpoint.done_ids()]
+    checkpoint.append(results_dict)
+    store = checkpoint.load()
+"""
+from utilities.result_store import ResultStore
+import json
+import os
+
+
+class ResultCheckpoint(object):
+    """
+    Chunked append-only store of the results of a run with a manifest of the completed queries
+    """
+
+    def __init__(self, path, config=None):
+        """
+        Init params:
+                    path : directory of the checkpoint (created if it doesn't exist)
+                    config : {default : None} json serializable dict of the parameters of the run
+                             (eg. task name, size, profile), a checkpoint can only be resumed with the same config
+        """
+        self.path = path
+        self.config = json.loads(json.dumps(config or {}))
+        self.manifest_file = os.path.join(path, 'manifest.json')
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+            if self.manifest['config'] != self.config:
+                raise Exception("\nThe checkpoint %s was written with the config %s, it can't be resumed with the "
+                                "config %s" % (path, self.manifest['config'], self.config))
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.manifest = {'config': self.config, 'chunks': list(), 'n_queries': 0}
+            self._write_manifest()
+        self._done_ids = None
+        return
+
+    def __len__(self):
+        return self.manifest['n_queries']
+
+    def _write_manifest(self):
+        """Atomically replace the manifest file"""
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.rename(tmp_file, self.manifest_file)
+        return
+
+    def chunks(self):
+        """Iterate over the (memory-mapped) ResultStore of each completed chunk"""
+        for chunk in self.manifest['chunks']:
+            yield ResultStore.load(os.path.join(self.path, chunk['name']))
+
+    def done_ids(self):
+        """Set of the query msd_ids (utf-8 bytes) of the completed chunks"""
+        if self._done_ids is None:
+            self._done_ids = set()
+            for store in self.chunks():
+                self._done_ids.update(store.query_ids.tolist())
+        return self._done_ids
+
+    def pending(self, query_ids):
+        """Indexes of the query msd_ids not in the checkpoint yet (first occurrence of the duplicated msd_ids)"""
+        done = self.done_ids()
+        seen = set()
+        indexes = list()
+        for index, query_id in enumerate(ResultStore._encode(query_ids).tolist()):
+            if query_id not in done and query_id not in seen:
+                seen.add(query_id)
+                indexes.append(index)
+        return indexes
+
+    def append(self, results):
+        """
+        Write the results of a chunk of queries and add it to the manifest
+
+        Inputs :
+                results : dict {query_msd_id: {'id': [msd_ids], 'score': [scores]}} or ResultStore
+        """
+        store = results if isinstance(results, ResultStore) else ResultStore.from_dict(results)
+        if not len(store):
+            return
+        # a chunk left by an interrupted write is not in the manifest and is overwritten
+        name = 'chunk_%05d' % len(self.manifest['chunks'])
+        store.save(os.path.join(self.path, name))
+        self.manifest['chunks'].append({'name': name, 'n_queries': len(store)})
+        self.manifest['n_queries'] += len(store)
+        self._write_manifest()
+        if self._done_ids is not None:
+            self._done_ids.update(store.query_ids.tolist())
+        return
+
+    def load(self):
+        """All the results of the checkpoint as a single ResultStore"""
+        return ResultStore.concat(list(self.chunks()))
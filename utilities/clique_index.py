@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled index of a SHS dataset csv file (check the ./datasets folder) with interned integer ids.
+
+Each song of the dataset is a row. The index holds the msd_id -> row and dzr_id -> row hash maps,
+the row -> artist and row -> clique integer codes and the members of each clique as CSR arrays
+(clique_offsets, clique_members), so that the per-query lookups of the experiments are O(1).
+The index can be saved to a directory of numpy files which are memory-mapped on load.
+
+Usage:
+    cliques = CliqueIndex.cached('./datasets/train_shs.csv')
+    cliques.clique_songs('TRPYNNL12903CAF506')
+    cliques.artist_id('TRPYNNL12903CAF506')
+"""
+import pandas as pd
+import numpy as np
+import tempfile
+import shutil
+import json
+import os
+
+
+class CliqueIndex(object):
+    """
+    msd_id, artist, clique (work_id) and dzr_id lookups of a SHS dataset
+    """
+    arrays = ['msd_ids', 'artist_codes', 'artist_table', 'clique_codes', 'clique_table', 'clique_offsets',
+              'clique_members', 'dzr_ids', 'titles']
+
+    def __init__(self, msd_ids, artist_codes, artist_table, clique_codes, clique_table, clique_offsets,
+                 clique_members, dzr_ids, titles):
+        """
+        Init params: arrays of the index (check from_dataframe to build an index from a dataset)
+        """
+        self.msd_ids = msd_ids
+        self.artist_codes = artist_codes
+        self.artist_table = artist_table
+        self.clique_codes = clique_codes
+        self.clique_table = clique_table
+        self.clique_offsets = clique_offsets
+        self.clique_members = clique_members
+        self.dzr_ids = dzr_ids
+        self.titles = titles
+        self._rows = None
+        self._dzr_rows = None
+        return
+
+    def __len__(self):
+        return len(self.msd_ids)
+
+    @property
+    def n_cliques(self):
+        return len(self.clique_table)
+
+    @staticmethod
+    def _encode(values):
+        """utf-8 encoded bytes array of a list of values"""
+        return np.array([value.encode('utf-8') if isinstance(value, unicode) else str(value) for value in values])
+
+    @classmethod
+    def from_dataframe(cls, dataset):
+        """
+        Build the index of a SHS dataset dataframe with the columns 'msd_id', 'artist_id', 'work_id',
+        'title' and optionally 'dzr_id'
+        """
+        artist_codes, artist_table = pd.factorize(dataset.artist_id.values)
+        clique_codes, clique_table = pd.factorize(dataset.work_id.values)
+        # CSR arrays of the members of each clique (rows in the dataset order)
+        members = np.argsort(clique_codes, kind='mergesort')
+        members = members[clique_codes[members] >= 0]
+        offsets = np.zeros(len(clique_table) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(clique_codes[clique_codes >= 0], minlength=len(clique_table)), out=offsets[1:])
+        if 'dzr_id' in dataset.columns:
+            dzr_ids = dataset.dzr_id.fillna(-1).values.astype(np.int64)
+        else:
+            dzr_ids = np.full(len(dataset), -1, dtype=np.int64)
+        return cls(msd_ids=cls._encode(dataset.msd_id.values),
+                   artist_codes=artist_codes.astype(np.int32),
+                   artist_table=cls._encode(artist_table),
+                   clique_codes=clique_codes.astype(np.int32),
+                   clique_table=cls._encode(clique_table),
+                   clique_offsets=offsets,
+                   clique_members=members.astype(np.int32),
+                   dzr_ids=dzr_ids,
+                   titles=cls._encode(dataset.title.fillna('').values))
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        """Build the index of a SHS dataset csv file"""
+        return cls.from_dataframe(pd.read_csv(csv_file))
+
+    @staticmethod
+    def _is_fresh(cache_path, csv_file):
+        """True if the cache directory holds a complete index at least as recent as the csv file"""
+        manifest = os.path.join(cache_path, 'manifest.json')
+        return os.path.exists(manifest) and os.path.getmtime(manifest) >= os.path.getmtime(csv_file)
+
+    @classmethod
+    def cached(cls, csv_file, cache_path=None):
+        """
+        Load the index of a SHS dataset csv file from its cache directory (default : '<csv_file>.index'),
+        the index is built and saved if the cache doesn't exist or is older than the csv file
+
+        [NOTE]: Several processes (eg. joblib or distributed workers) can build the same cache at the same time,
+        so the index is saved to a temporary directory renamed in place once complete. A process never sees a
+        partially written cache : if another process renamed its cache first, that cache is loaded instead.
+        """
+        cache_path = os.path.abspath(cache_path or csv_file + '.index')
+        if cls._is_fresh(cache_path, csv_file):
+            return cls.load(cache_path)
+        index = cls.from_csv(csv_file)
+        try:
+            build_path = tempfile.mkdtemp(prefix='.build.', dir=os.path.dirname(cache_path))
+        except (IOError, OSError):
+            # read-only dataset directory, the index is rebuilt next time
+            return index
+        try:
+            index.save(build_path)
+            try:
+                os.rename(build_path, cache_path)
+            except OSError:
+                if cls._is_fresh(cache_path, csv_file):
+                    # built by another process in the meantime
+                    return cls.load(cache_path)
+                # stale cache : moved aside, the processes which memory-mapped it keep reading its files
+                stale_path = tempfile.mkdtemp(prefix='.stale.', dir=os.path.dirname(cache_path))
+                os.rename(cache_path, os.path.join(stale_path, 'index'))
+                os.rename(build_path, cache_path)
+                shutil.rmtree(stale_path, ignore_errors=True)
+        except (IOError, OSError):
+            pass
+        finally:
+            shutil.rmtree(build_path, ignore_errors=True)
+        return index
+
+    def save(self, path):
+        """Save the arrays of the index as numpy files in the directory 'path'"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self.arrays:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        # the manifest is written last, an interrupted save is not loaded by 'cached'
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump({'n_songs': len(self), 'n_cliques': self.n_cliques, 'arrays': self.arrays}, f, indent=2)
+        return
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load an index saved with 'save', the arrays are memory-mapped by default"""
+        return cls(**dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+                          for name in cls.arrays))
+
+    def row(self, msd_id):
+        """Row of a msd_id in the dataset (None if it is not in the dataset)"""
+        if self._rows is None:
+            # first row of the msd_ids appearing several times
+            self._rows = dict((msd_id, row) for row, msd_id in reversed(list(enumerate(self.msd_ids.tolist()))))
+        return self._rows.get(msd_id)
+
+    def row_of_dzr_id(self, dzr_id):
+        """Row of a deezer song id in the dataset (None if it is not in the dataset)"""
+        if self._dzr_rows is None:
+            self._dzr_rows = dict((dzr_id, row) for row, dzr_id in reversed(list(enumerate(self.dzr_ids.tolist())))
+                                  if dzr_id >= 0)
+        return self._dzr_rows.get(int(dzr_id))
+
+    def _row(self, msd_id):
+        row = self.row(msd_id)
+        if row is None:
+            raise Exception("\nmsd_id %s is not in the dataset" % msd_id)
+        return row
+
+    def artist_id(self, msd_id):
+        """msd artist_id of a msd_id"""
+        return self.artist_table[self.artist_codes[self._row(msd_id)]]
+
+    def clique(self, msd_id):
+        """Integer code of the clique of a msd_id (-1 if it has no work_id)"""
+        return int(self.clique_codes[self._row(msd_id)])
+
+    def clique_id(self, msd_id):
+        """work_id of a msd_id (None if it has no work_id)"""
+        code = self.clique(msd_id)
+        return self.clique_table[code] if code >= 0 else None
+
+    def members(self, clique):
+        """Rows of the songs of a clique code"""
+        if clique < 0:
+            return np.zeros(0, dtype=np.int32)
+        return self.clique_members[self.clique_offsets[clique]:self.clique_offsets[clique + 1]]
+
+    def clique_size(self, clique):
+        """Number of songs of a clique code"""
+        return int(self.clique_offsets[clique + 1] - self.clique_offsets[clique]) if clique >= 0 else 0
+
+    def clique_songs(self, msd_id):
+        """msd_ids of the songs of the clique of a msd_id (the msd_id itself included)"""
+        return self.msd_ids[self.members(self.clique(msd_id))]
+
+    def title(self, row):
+        """Title of the song of a row"""
+        return self.titles[row].decode('utf-8')
+
+    def dzr_id(self, msd_id):
+        """Deezer song id of a msd_id (None if it has no deezer mapping)"""
+        dzr_id = self.dzr_ids[self._row(msd_id)]
+        return int(dzr_id) if dzr_id >= 0 else None
+
+    def msd_id_of_dzr_id(self, dzr_id):
+        """msd_id of a deezer song id (None if it is not in the dataset)"""
+        row = self.row_of_dzr_id(dzr_id)
+        return self.msd_ids[row] if row is not None else None
@@ -8,18 +8,17 @@ R&D Intern
 """
 from itertools import combinations
 from Levenshtein import ratio
+from utilities.clique_index import CliqueIndex
 import numpy as np
-import pandas as pd
 import random
 
 
 def get_clique_similarity_same_set(dataset_csv):
     """Compute Levenshtein similarity of song titles in same cliques in SHS"""
-    dataset = pd.read_csv(dataset_csv)
-    clique_ids = dataset.work_id.unique().tolist()
+    cliques = CliqueIndex.cached(dataset_csv)
     clique_sims = list()
-    for work_id in clique_ids:
-        song_titles = dataset.title[dataset.work_id == work_id].values.tolist()
+    for clique in range(cliques.n_cliques):
+        song_titles = [cliques.title(row) for row in cliques.members(clique)]
         distances = list()
         for (title1, title2) in combinations(song_titles, 2):
             measure = ratio(title1, title2)
@@ -31,15 +30,14 @@ def get_clique_similarity_same_set(dataset_csv):
 def get_clique_similarity_dif_set(dataset_csv):
     """Compute Levenshtein similarity of song titles in different cliques in SHS"""
     distances = list()
-    dataset = pd.read_csv(dataset_csv)
-    clique_ids = dataset.work_id.unique().tolist()
-    all_titles = dataset.title.values.tolist()
-
-    for i in range(len(clique_ids)):
-        ref_title = random.choice(all_titles)
-        clique_id = dataset.work_id[dataset.title == ref_title].values[0]
-        ref_titles = dataset.title[dataset.work_id != clique_id].values.tolist()
-        com_title = random.choice(ref_titles)
+    cliques = CliqueIndex.cached(dataset_csv)
+    rows = range(len(cliques))
+
+    for i in range(cliques.n_cliques):
+        ref_row = random.choice(rows)
+        ref_title = cliques.title(ref_row)
+        ref_rows = np.nonzero(cliques.clique_codes != cliques.clique_codes[ref_row])[0]
+        com_title = cliques.title(random.choice(ref_rows))
         distance = ratio(ref_title, com_title)
         distances.append(distance)
 
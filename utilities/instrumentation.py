@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request metrics of the SearchModule (es_search.py) requests.
+
+Each request records the client wall time, the http time (time spent in the http round trip, the rest of the
+wall time being json decoding and client overhead), the es reported 'took' time, the response size in bytes,
+the number of hits and the query template used. The metrics are aggregated per method into percentiles
+and can be dumped as json or scraped with hooks.
+
+Usage:
+    es = SearchModule(presets.uri_config)
+    ...
+    print es.recorder.summary()['search']['wall_time']['p95']
+    es.recorder.dump_json('./logs/request_stats.json')
+    es.recorder.add_hook(lambda record: statsd.timing(record['method'], record['wall_time']))
+"""
+import numpy as np
+import threading
+import json
+
+
+METRICS = ['wall_time', 'http_time', 'took', 'bytes', 'hits']
+
+
+def query_template_name(body):
+    """
+    Short name of the query template of a query DSL post json
+        eg. 'simple_query_string:msd_title|filter:shs_id|must_not:msd_is_duplicate_of'
+    """
+    if 'id' in body and 'params' in body:
+        # stored search template request
+        return body['id']
+    try:
+        bool_query = body['query']['bool']
+        match_type, params = bool_query['must'][0].items()[0]
+    except (KeyError, IndexError, AttributeError, TypeError):
+        return 'custom'
+    fields = params.get('fields', [params.get('default_field', '')])
+    name = '%s:%s' % (match_type, ','.join(fields))
+    filters = [clause['exists']['field'] for clause in bool_query.get('filter', []) if 'exists' in clause]
+    if filters:
+        name += '|filter:' + ','.join(filters)
+    excluded = [clause['exists']['field'] for clause in bool_query.get('must_not', []) if 'exists' in clause]
+    if excluded:
+        name += '|must_not:' + ','.join(excluded)
+    return name
+
+
+class RequestRecorder(object):
+    """
+    Thread-safe recorder of per-request metrics aggregated by method
+    """
+
+    def __init__(self, enabled=True):
+        """
+        Init params:
+                    enabled : {default : True} if False, nothing is recorded
+        """
+        self.enabled = enabled
+        self.hooks = list()
+        self._lock = threading.Lock()
+        self.reset()
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Remove all the recorded metrics"""
+        self._metrics = dict()
+        self._templates = dict()
+        return
+
+    def add_hook(self, hook):
+        """Add a callable called with the record dict of each request (eg. to push metrics to a monitoring system)"""
+        self.hooks.append(hook)
+        return
+
+    def record(self, method, wall_time, http_time=None, took=None, nbytes=None, hits=None, template=None):
+        """
+        Record the metrics of a request
+
+        Inputs :
+                method : name of the request method (eg. 'search', 'msearch', 'mget', 'get')
+                wall_time : client wall time of the request in ms
+        Params :
+                http_time : time of the http round trip in ms
+                took : es reported query time in ms
+                nbytes : size of the response in bytes
+                hits : number of hits in the response
+                template : name of the query template (check query_template_name)
+        """
+        if not self.enabled:
+            return
+        record = {'method': method, 'wall_time': wall_time, 'http_time': http_time, 'took': took,
+                  'bytes': nbytes, 'hits': hits, 'template': template}
+        with self._lock:
+            metrics = self._metrics.setdefault(method, dict((metric, list()) for metric in METRICS))
+            for metric in METRICS:
+                if record[metric] is not None:
+                    metrics[metric].append(record[metric])
+            if template is not None:
+                templates = self._templates.setdefault(method, dict())
+                templates[template] = templates.get(template, 0) + 1
+        for hook in self.hooks:
+            hook(record)
+        return
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """
+        Aggregated metrics per method
+            eg. {'search': {'count': 12960, 'wall_time': {'p50': 4.1, 'p95': 9.3, 'p99': 15.2,
+                 'mean': 4.8, 'total': 62208.}, ... , 'templates': {'simple_query_string:msd_title': 12960}}}
+        """
+        summary = dict()
+        with self._lock:
+            for method, metrics in self._metrics.iteritems():
+                summary[method] = {'count': len(metrics['wall_time']),
+                                   'templates': dict(self._templates.get(method, {}))}
+                for metric in METRICS:
+                    values = np.array(metrics[metric], dtype=np.float64)
+                    if not len(values):
+                        continue
+                    stats = dict(('p%s' % p, float(v)) for p, v in zip(percentiles, np.percentile(values, percentiles)))
+                    stats['mean'] = float(values.mean())
+                    stats['total'] = float(values.sum())
+                    summary[method][metric] = stats
+        return summary
+
+    def dump_json(self, jsonfile):
+        """Dump the aggregated metrics to a json file"""
+        with open(jsonfile, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+        return
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized ranking metrics of the cover song detection experiments (experiments.py -> Experiments).
+
+The msd_ids and work_ids (cliques) of the query set are integer encoded once and the responses of the queries
+are represented as a dense (n_queries x k) int array of msd_id codes, so that the metrics of all the queries
+are computed in a few numpy passes instead of one dataframe scan per query.
+
+The outputs are numerically identical to the original per-query implementations (the float sums are
+accumulated in the same order) :
+    * a response id is relevant if it belongs to the clique of the query (the query itself included)
+    * the duplicated ids of a response only count at their first position for the average precision
+    * a query without work_id has an empty clique
+
+Usage:
+    metrics = RankingMetrics(dataset.msd_id.values, dataset.work_id.values)
+    codes, valid = metrics.encode(responses, size=100)
+    avg_precisions = metrics.average_precision(codes, valid, metrics.row_works)
+"""
+import pandas as pd
+import numpy as np
+import itertools
+
+
+# code of the padding positions of the responses shorter than the width of the response array
+PADDING = -2
+
+
+class RankingMetrics(object):
+    """
+    Ranking metrics of a query set computed on integer encoded responses
+    """
+
+    def __init__(self, msd_ids, work_ids):
+        """
+        Init params:
+                    msd_ids : array of the msd_ids of the query set
+                    work_ids : array of the work_ids (clique ids) of the msd_ids (NaN if unknown)
+        """
+        self.row_ids, uniques = pd.factorize(np.asarray(msd_ids, dtype=object))
+        self.id_index = pd.Index(uniques)
+        self.row_works, work_uniques = pd.factorize(np.asarray(work_ids))
+        self.n_works = len(work_uniques)
+        # number of songs of each clique (rows of the query set)
+        self.clique_sizes = np.bincount(self.row_works[self.row_works >= 0], minlength=self.n_works)
+        # sorted (msd_id, work_id) pair keys of the songs of the cliques
+        has_work = self.row_works >= 0
+        self._pairs = np.unique(self.row_ids[has_work].astype(np.int64) * self.n_works + self.row_works[has_work])
+        # first row of each msd_id in the query set
+        _, self._first_rows = np.unique(self.row_ids, return_index=True)
+        return
+
+    def query_works(self, query_ids):
+        """Work codes of a list of query msd_ids (the work of their first row in the query set)"""
+        codes = self.id_index.get_indexer(np.asarray(query_ids, dtype=object))
+        if (codes < 0).any():
+            raise Exception("\n%s query ids are not in the query set" % (codes < 0).sum())
+        return self.row_works[self._first_rows[codes]]
+
+    def encode(self, responses, size=None):
+        """
+        Encode a list of responses as a dense array of msd_id codes
+
+        Inputs :
+                responses : list of ranked lists of msd_ids (any other value for a query without response)
+        Params :
+                size : {default : None} prune the responses to their top 'size' ids
+
+        Outputs : tuple (codes, valid)
+                codes : (n_queries x k) int array of the codes of the response ids in the query set
+                    (-1 for the ids out of the query set, -2 after the end of a response)
+                valid : boolean array, False for the queries without response
+        """
+        valid = np.array([type(response) == list for response in responses], dtype=bool)
+        lists = [response[:size] if size else response for response, is_list in zip(responses, valid) if is_list]
+        lengths = np.array([len(response) for response in lists], dtype=np.int64)
+        width = lengths.max() if len(lengths) else 0
+        flat = self.id_index.get_indexer(np.array(list(itertools.chain.from_iterable(lists)), dtype=object)) \
+            if width else np.zeros(0, dtype=np.int64)
+
+        block = np.full((len(lists), width), PADDING, dtype=np.int32)
+        block[np.arange(width) < lengths[:, None]] = flat
+        codes = np.full((len(responses), width), PADDING, dtype=np.int32)
+        codes[valid] = block
+        return codes, valid
+
+    def encode_store(self, store, query_ids, size=None):
+        """
+        Encode the responses of a ResultStore (utilities/result_store.py) for a list of query msd_ids
+        without decoding the response ids (same outputs as encode, the queries missing from the store are invalid)
+        """
+        rows = store.row_of(query_ids)
+        # the padding code -1 of the store maps to the last item of the lookup table
+        lookup = np.append(self.id_index.get_indexer(np.asarray(store.id_table, dtype=object)), PADDING)
+        ids = store.ids[np.maximum(rows, 0)]
+        if size:
+            ids = ids[:, :size]
+        codes = lookup[ids].astype(np.int32)
+        valid = (rows >= 0) & store.valid[np.maximum(rows, 0)]
+        codes[~valid] = PADDING
+        return codes, valid
+
+    def relevance(self, codes, works):
+        """
+        Returns a tuple (member, first_pos) of (n_queries x k) arrays
+            member : True if the response id belongs to the clique of the query
+            first_pos : position of the first occurrence of the response id in the response
+        """
+        n_queries, width = codes.shape
+        if not width:
+            return np.zeros(codes.shape, dtype=bool), np.zeros(codes.shape, dtype=np.int64)
+        works = np.asarray(works)[:, None]
+        keys = codes.astype(np.int64) * self.n_works + works
+        member = (codes >= 0) & (works >= 0)
+        pos = np.searchsorted(self._pairs, keys[member])
+        found = pos < len(self._pairs)
+        found[found] = self._pairs[pos[found]] == keys[member][found]
+        member[member] = found
+
+        # stable sort of each response to find the first occurrence of the ids
+        rows = np.arange(n_queries)[:, None]
+        order = np.argsort(codes, axis=1, kind='mergesort')
+        sorted_codes = codes[rows, order]
+        starts = np.ones(codes.shape, dtype=bool)
+        starts[:, 1:] = sorted_codes[:, 1:] != sorted_codes[:, :-1]
+        group_start = np.maximum.accumulate(np.where(starts, np.arange(width), 0), axis=1)
+        first_pos = np.empty(codes.shape, dtype=np.int64)
+        first_pos[rows, order] = order[rows, group_start]
+        return member, first_pos
+
+    def _relevant(self, codes, works):
+        """Relevant response ids counted once (at their first position)"""
+        member, first_pos = self.relevance(codes, works)
+        return member & (first_pos == np.arange(codes.shape[1]))
+
+    def average_precision(self, codes, valid, works):
+        """
+        Average precision of each query (0 for the queries without response)
+
+        Inputs :
+                codes, valid : encoded responses (check encode)
+                works : work codes of the queries (eg. self.row_works)
+        """
+        ground_truth = self._relevant(codes, works).astype(np.float64)
+        precision_at_k = np.cumsum(ground_truth, axis=1) / np.arange(1., codes.shape[1] + 1)
+        # sequential sum of the precisions, as the python sum of the per-query implementation
+        if codes.shape[1]:
+            precision_sum = np.cumsum(ground_truth * precision_at_k, axis=1)[:, -1]
+        else:
+            precision_sum = np.zeros(len(codes))
+        n_covers = np.where(works >= 0, self.clique_sizes[np.maximum(works, 0)], 0) - 1.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg_precisions = precision_sum / n_covers
+        return np.where(valid, avg_precisions, 0.)
+
+    def covers_identified(self, codes, valid, works):
+        """
+        Returns a tuple (total_covers, percentage) of arrays for the queries with a response
+            total_covers : number of distinct songs of the clique of the query in the response
+            percentage : percentage of the songs of the clique in the response
+        """
+        total_covers = self._relevant(codes, works)[valid].sum(axis=1)
+        works = works[valid]
+        clique_sizes = np.where(works >= 0, self.clique_sizes[np.maximum(works, 0)], 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentage = (total_covers / clique_sizes.astype(np.float64)) * 100
+        return total_covers, percentage
+
+    def average_rank(self, codes, valid, works, missing_rank=1000000):
+        """
+        Average position (starting at 0) of the songs of the clique in the response of each query with a response
+        ('missing_rank' if there is none). The duplicated ids count at the position of their first occurrence.
+        """
+        member, first_pos = self.relevance(codes[valid], works[valid])
+        counts = member.sum(axis=1)
+        sums = np.where(member, first_pos, 0).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, sums / counts.astype(np.float64), missing_rank)
+
+    def rank_first_cover(self, codes, valid, works):
+        """Rank (starting at 1) of the first song of the clique in the response of each query with a cover found"""
+        member, _ = self.relevance(codes[valid], works[valid])
+        found = member.any(axis=1)
+        return np.argmax(member[found], axis=1) + 1
+
+    def cutoff_metrics(self, codes, valid, works, sizes):
+        """
+        Mean average precision and mean percentage of covers of the responses pruned to each size of 'sizes',
+        computed in a single cumulative pass over the responses (same values as average_precision and
+        covers_identified on the pruned responses)
+
+        Returns a tuple (map, mper) of arrays with one value per size
+        """
+        n_queries, width = codes.shape
+        columns = np.minimum(np.asarray(sizes, dtype=np.int64), width)
+        relevant = self._relevant(codes, works)
+        ground_truth = relevant.astype(np.float64)
+        precision_at_k = np.cumsum(ground_truth, axis=1) / np.arange(1., width + 1)
+        # cumulative sums with a leading zero column for the empty prefix
+        precision_sums = np.zeros((n_queries, width + 1))
+        precision_sums[:, 1:] = np.cumsum(ground_truth * precision_at_k, axis=1)
+        n_covers = np.where(works >= 0, self.clique_sizes[np.maximum(works, 0)], 0) - 1.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg_precisions = precision_sums[:, columns] / n_covers[:, None]
+        avg_precisions = np.where(valid[:, None], avg_precisions, 0.)
+
+        total_covers = np.zeros((valid.sum(), width + 1), dtype=np.int64)
+        total_covers[:, 1:] = np.cumsum(relevant[valid], axis=1)
+        valid_works = works[valid]
+        clique_sizes = np.where(valid_works >= 0, self.clique_sizes[np.maximum(valid_works, 0)], 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentages = (total_covers[:, columns] / clique_sizes.astype(np.float64)[:, None]) * 100
+        # means of contiguous copies of the columns, summed in the same order as the means of the 1d arrays
+        return (np.array([np.mean(np.ascontiguousarray(avg_precisions[:, i])) for i in range(len(columns))]),
+                np.array([np.mean(np.ascontiguousarray(percentages[:, i])) for i in range(len(columns))]))
+
+    def cutoff_rank_first_cover(self, codes, valid, works, sizes):
+        """
+        Mean rank of the first cover of the responses pruned to each size of 'sizes' : the mean of rank_first_cover
+        over the queries with a cover in their top 'size' hits (NaN if there is none)
+        """
+        ranks = self.rank_first_cover(codes, valid, works)
+        return np.array([np.mean(ranks[ranks <= size]) if (ranks <= size).any() else np.nan for size in sizes])
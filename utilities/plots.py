@@ -30,11 +30,20 @@ def parse_results(jsonfile, method):
     return {"map": mp, "mper": mper, "size": sizes}
 
 
-def plot_optimal_topN_pruning(results_json):
-    with open(results_json) as f:
-        data = json.load(f)
-    results = [(int(key), value['map']) for key, value in data.iteritems()]
-    results = sorted(results, key=lambda r: int(r[0]))
+def plot_optimal_topN_pruning(results_json, metric='map'):
+    """
+    results_json : path to a json file {size: {'map': ...}} or the dataframe returned by
+        experiments.py -> Experiments.prune_sweep (columns ['size', 'map', 'mper', 'mr1'])
+    metric : {default : 'map'} metric plotted against the prune sizes
+    """
+    labels = {'map': "Mean Average Precision", 'mper': "Mean Percentage of covers", 'mr1': "Mean Rank of first cover"}
+    if isinstance(results_json, pd.DataFrame):
+        results = sorted(zip(results_json['size'].values, results_json[metric].values))
+    else:
+        with open(results_json) as f:
+            data = json.load(f)
+        results = [(int(key), value[metric]) for key, value in data.iteritems()]
+        results = sorted(results, key=lambda r: int(r[0]))
     sizes = [x[0] for x in results]
     metrics = [x[1] for x in results]
 
@@ -42,7 +51,7 @@ def plot_optimal_topN_pruning(results_json):
     # on the SHS train against the MSD for various prune sizes")
     plt.plot(sizes, metrics)
     plt.xlabel("Prune size (k)")
-    plt.ylabel("Mean Average Precision")
+    plt.ylabel(labels.get(metric, metric))
     plt.show()
     return
 
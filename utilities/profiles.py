@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side derivation of the responses of the experiment profiles (templates.py) from a single superset run
+(experiments.py -> Experiments.run_superset_task).
+
+The profiles only differ by non-scoring 'exists' filters on the hits (shs_id for 'shs_mode', msd_is_duplicate_of
+for 'filter_duplicates' and dzr_song_title for 'dzr_map'), so the response of a stricter profile is the response
+of the loosest profile without the filtered hits, with the same scores and in the same order. The hits of the
+responses are flagged once with a (n_ids x 3) boolean table of these fields and every profile is derived with
+a single vectorized pass over the encoded responses.
+
+A derived response is incomplete when the loose response was full (it reached the over-fetched depth) and less
+than 'size' of its hits pass the filters, the query songs of these responses are searched again with the profile.
+
+Usage:
+    flags = encode_flags([[shs_id, duplicate_of, dzr_title] for each response id])
+    ids, scores, lengths = derive_profile(store.ids, store.scores, flags, presets.shs_msd_no_dup, size=100)
+"""
+import numpy as np
+
+
+# fields of the profile filters, in the order of the columns of the flag tables
+FLAG_FIELDS = ['shs_id', 'msd_is_duplicate_of', 'dzr_song_title']
+
+
+def loosest_profile(profiles):
+    """Profile with the filters shared by all the 'profiles', its responses contain the responses of the profiles"""
+    profiles = list(profiles)
+    return {'shs_mode': all(profile['shs_mode'] for profile in profiles),
+            'filter_duplicates': all(profile['filter_duplicates'] for profile in profiles),
+            'dzr_map': all(profile['dzr_map'] for profile in profiles)}
+
+
+def encode_flags(values):
+    """
+    (n_ids x 3) boolean flag table of the field values of a list of ids
+
+    Inputs :
+            values : list of [shs_id, msd_is_duplicate_of, dzr_song_title] values of each id (check FLAG_FIELDS),
+                     or a pandas dataframe with these columns. An empty value (None, NaN or '') is not set.
+    """
+    if hasattr(values, 'columns'):
+        values = values[FLAG_FIELDS].values.tolist()
+    flags = np.zeros((len(values), len(FLAG_FIELDS)), dtype=bool)
+    for row, fields in enumerate(values):
+        for column, value in enumerate(fields):
+            flags[row, column] = not (value is None or value == '' or (type(value) == float and np.isnan(value)))
+    return flags
+
+
+def profile_mask(flags, profile):
+    """Boolean mask of the ids of a flag table kept by the filters of a profile"""
+    keep = np.ones(len(flags), dtype=bool)
+    if profile['shs_mode']:
+        keep &= flags[:, 0]
+    if profile['filter_duplicates']:
+        keep &= ~flags[:, 1]
+    if profile['dzr_map']:
+        keep &= flags[:, 2]
+    return keep
+
+
+def derive_profile(ids, scores, flags, profile, size):
+    """
+    Responses of a profile derived from the responses of a looser profile
+
+    Inputs :
+            ids : (n_queries x depth) int array of the codes of the response ids (-1 for padding)
+            scores : (n_queries x depth) float array of the response scores (NaN for padding)
+            flags : (n_ids x 3) flag table of the ids of the codes (check encode_flags)
+            profile : experiment profile (check templates.py)
+            size : size of the derived responses
+    Outputs : tuple (ids, scores, lengths)
+            ids, scores : (n_queries x size) arrays of the derived responses
+            lengths : number of hits of each response kept by the profile (before the truncation to 'size')
+    """
+    # the padding code -1 maps to the last item of the mask
+    keep = np.append(profile_mask(flags, profile), False)[ids]
+    # stable sort moving the kept hits in front of each response in their order
+    order = np.argsort(~keep, axis=1, kind='mergesort')[:, :size]
+    rows = np.arange(len(ids))[:, None]
+    kept = keep[rows, order]
+    derived_ids = np.where(kept, ids[rows, order], -1).astype(ids.dtype)
+    derived_scores = np.where(kept, scores[rows, order], np.nan).astype(scores.dtype)
+    return derived_ids, derived_scores, keep.sum(axis=1)
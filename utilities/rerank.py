@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Batched rerank and fusion of the responses of the cover song detection experiments (experiments.py).
+
+The responses of a set of queries are represented as a (n_queries x k) int array of id codes (-1 after the end
+of a response) and a (n_queries x k) float array of scores (NaN after the end of a response). The codes of the
+responses combined by a rerank refer to the same id table (check encode_rankings), so that the strategies of the
+experiments are computed in a few numpy passes over all the queries instead of per-query python loops.
+
+The promotions reproduce the rankings of the original per-query implementations :
+    * promote_by_lyrics : Experiments.rerank_title_results_by_lyrics
+    * promote_by_field : Experiments.rerank_by_field
+    * promote_prefix : Experiments.run_audio_rerank_task
+
+Usage:
+    table, [(title_ids, title_scores), (lyrics_ids, lyrics_scores)] = encode_rankings(title_res, lyrics_res)
+    ids, scores = promote_by_lyrics(title_ids, title_scores, lyrics_ids, lyrics_scores, proximity=0.5)
+    fused_ids, fused_scores = reciprocal_rank_fusion([title_ids, lyrics_ids])
+    responses = decode(table, ids, scores)
+"""
+import pandas as pd
+import numpy as np
+import itertools
+import warnings
+
+
+def _pad(lists, width, fill, dtype):
+    """Dense (len(lists) x width) array of a list of lists padded with 'fill'"""
+    lengths = np.array([len(values) for values in lists], dtype=np.int64)
+    array = np.full((len(lists), width), fill, dtype=dtype)
+    array[np.arange(width) < lengths[:, None]] = np.array(list(itertools.chain.from_iterable(lists)), dtype=dtype)
+    return array
+
+
+def encode_rankings(*rankings):
+    """
+    Encode several sets of responses of the same queries with a common id table
+
+    Inputs :
+            rankings : lists of (response_ids, response_scores) tuples, one tuple per query
+                       (None or an empty list for the queries without response)
+    Outputs : tuple (table, arrays)
+            table : array of the response ids (the codes index this table)
+            arrays : list of (ids, scores) arrays of each ranking
+    """
+    rankings = [[(list(ids or []), list(scores or [])) for ids, scores in ranking] for ranking in rankings]
+    all_ids = [ids for ranking in rankings for ids, _ in ranking]
+    codes, table = pd.factorize(np.array(list(itertools.chain.from_iterable(all_ids)), dtype=object))
+    arrays = list()
+    offset = 0
+    for ranking in rankings:
+        lengths = [len(ids) for ids, _ in ranking]
+        width = max(lengths) if lengths else 0
+        code_lists = list()
+        for length in lengths:
+            code_lists.append(codes[offset:offset + length])
+            offset += length
+        arrays.append((_pad(code_lists, width, -1, np.int64), _pad([scores for _, scores in ranking], width,
+                                                                      np.nan, np.float64)))
+    return table, arrays
+
+
+def decode(table, ids, scores):
+    """List of (response_ids, response_scores) tuples of an encoded ranking"""
+    responses = list()
+    for row_ids, row_scores in zip(ids, scores):
+        valid = row_ids >= 0
+        responses.append((table[row_ids[valid]].tolist(), row_scores[valid].tolist()))
+    return responses
+
+
+def first_positions(ids):
+    """Position of the first occurrence of each id in its response ((n_queries x k) array)"""
+    n_queries, width = ids.shape
+    if not width:
+        return np.zeros(ids.shape, dtype=np.int64)
+    rows = np.arange(n_queries)[:, None]
+    order = np.argsort(ids, axis=1, kind='mergesort')
+    sorted_ids = ids[rows, order]
+    starts = np.ones(ids.shape, dtype=bool)
+    starts[:, 1:] = sorted_ids[:, 1:] != sorted_ids[:, :-1]
+    group_start = np.maximum.accumulate(np.where(starts, np.arange(width), 0), axis=1)
+    first_pos = np.empty(ids.shape, dtype=np.int64)
+    first_pos[rows, order] = order[rows, group_start]
+    return first_pos
+
+
+def _lookup(ids, lookup_ids, lookup_mask):
+    """
+    Position of the first occurrence of each id of 'ids' among the masked ids of 'lookup_ids' of the same row
+    (-1 if it is not found)
+    """
+    n_queries = len(ids)
+    n_codes = max(ids.max() if ids.size else 0, lookup_ids.max() if lookup_ids.size else 0) + 2
+    rows = np.arange(n_queries, dtype=np.int64)[:, None]
+    keys = (rows * n_codes + lookup_ids)[lookup_mask]
+    positions = np.broadcast_to(np.arange(lookup_ids.shape[1]), lookup_ids.shape)[lookup_mask]
+    # stable sort, the first occurrence of a key comes first
+    order = np.argsort(keys, kind='mergesort')
+    keys, positions = keys[order], positions[order]
+    queries = rows * n_codes + ids
+    found = np.searchsorted(keys, queries)
+    found = np.minimum(found, max(len(keys) - 1, 0))
+    if not len(keys):
+        return np.full(ids.shape, -1, dtype=np.int64)
+    return np.where((keys[found] == queries) & (ids >= 0), positions[found], -1)
+
+
+def _gather(ids, scores, keys):
+    """Sort each response by 'keys' (stable) and drop the positions with an infinite key"""
+    order = np.argsort(keys, axis=1, kind='mergesort')
+    rows = np.arange(len(ids))[:, None]
+    kept = np.isfinite(keys[rows, order])
+    new_ids = np.where(kept, ids[rows, order], -1)
+    new_scores = np.where(kept, scores[rows, order], np.nan)
+    width = kept.sum(axis=1).max() if len(kept) else 0
+    return new_ids[:, :width], new_scores[:, :width]
+
+
+def promote_by_lyrics(title_ids, title_scores, lyrics_ids, lyrics_scores, proximity=0.5):
+    """
+    Promote on top of the title responses the ids which are also in the head of the lyrics responses
+    (the lyrics hits whose score is within 'proximity' of the top lyrics score), in the order of the lyrics response.
+    The other ids of the title responses follow in their order. The responses without promoted id are unchanged.
+
+    Outputs : tuple (ids, scores) of the reranked responses with their title scores
+    """
+    width = title_ids.shape[1]
+    valid_lyrics = lyrics_ids >= 0
+    with np.errstate(invalid='ignore'):
+        n_top = (valid_lyrics & (lyrics_scores[:, :1] - lyrics_scores <= proximity)).sum(axis=1)
+    head = valid_lyrics & (np.arange(lyrics_ids.shape[1]) < n_top[:, None])
+    lyrics_pos = _lookup(title_ids, lyrics_ids, head)
+    common = lyrics_pos >= 0
+    promoted = common.any(axis=1)
+    if not promoted.any():
+        return title_ids, title_scores
+
+    first_pos = first_positions(title_ids)
+    rows = np.arange(len(title_ids))[:, None]
+    columns = np.arange(width)
+    # promoted ids (once) ranked by their lyrics position, then the other ids of the title response
+    keys = np.where(common, np.where(first_pos == columns, lyrics_pos, np.inf), lyrics_ids.shape[1] + columns)
+    keys = np.where(title_ids >= 0, keys, np.inf)
+    # the ids of a promoted response keep the title score of their first occurrence
+    first_scores = title_scores[rows, first_pos]
+    new_ids, new_scores = _gather(title_ids, first_scores, keys.astype(np.float64))
+
+    ids = np.full(title_ids.shape, -1, dtype=title_ids.dtype)
+    scores = np.full(title_scores.shape, np.nan)
+    ids[promoted, :new_ids.shape[1]] = new_ids[promoted]
+    scores[promoted, :new_ids.shape[1]] = new_scores[promoted]
+    ids[~promoted] = title_ids[~promoted]
+    scores[~promoted] = title_scores[~promoted]
+    return ids, scores
+
+
+def promote_by_field(ids, scores, fields, query_fields, proximity=1.):
+    """
+    Promote on top of the responses the hits with the same field value as their query (eg. the same artist)
+    and a score within 'proximity' of the top score, the order of the hits is kept within both groups
+
+    Inputs :
+            ids, scores : encoded responses
+            fields : (n_queries x k) array of the codes of the field values of the hits
+            query_fields : array of the codes of the field values of the queries
+    """
+    valid = ids >= 0
+    with np.errstate(invalid='ignore'):
+        promoted = valid & (fields == np.asarray(query_fields)[:, None]) & (scores[:, :1] - scores <= proximity)
+    keys = np.where(promoted, 0., np.where(valid, 1., np.inf))
+    return _gather(ids, scores, keys)
+
+
+def promote_prefix(ids, scores, head_ids, head_scores, n_head):
+    """
+    Put the first 'n_head' hits of another ranking (eg. the audio similarity response) on top of the responses,
+    followed by the ids of the responses which are not among them. The responses with 'n_head' = 0 are unchanged.
+
+    Outputs : tuple (ids, scores), the promoted hits keep their scores in the other ranking
+    """
+    n_head = np.asarray(n_head)
+    head = (head_ids >= 0) & (np.arange(head_ids.shape[1]) < n_head[:, None])
+    in_head = _lookup(ids, head_ids, head) >= 0
+    rows = np.arange(len(ids))[:, None]
+    first_scores = scores[rows, first_positions(ids)]
+
+    head_keys = np.where(head, np.arange(head_ids.shape[1]), np.inf)
+    keys = np.where((ids >= 0) & ~in_head, head_ids.shape[1] + np.arange(ids.shape[1]), np.inf)
+    new_ids, new_scores = _gather(np.hstack([head_ids, ids]), np.hstack([head_scores, first_scores]),
+                                  np.hstack([head_keys, keys]))
+
+    promoted = n_head > 0
+    width = max(new_ids.shape[1], ids.shape[1])
+    out_ids = np.full((len(ids), width), -1, dtype=ids.dtype)
+    out_scores = np.full((len(ids), width), np.nan)
+    out_ids[promoted, :new_ids.shape[1]] = new_ids[promoted]
+    out_scores[promoted, :new_ids.shape[1]] = new_scores[promoted]
+    out_ids[~promoted, :ids.shape[1]] = ids[~promoted]
+    out_scores[~promoted, :ids.shape[1]] = scores[~promoted]
+    return out_ids, out_scores
+
+
+def _fuse(rankings, contributions):
+    """
+    Sum the contributions of the ids of several rankings by query
+    and rank them by decreasing fused score (ties by their first position in the rankings)
+    """
+    n_queries = len(rankings[0])
+    n_codes = max(ranking.max() if ranking.size else 0 for ranking in rankings) + 1
+    rows, codes, values, firsts = list(), list(), list(), list()
+    for index, (ranking, contribution) in enumerate(zip(rankings, contributions)):
+        # an id counts once per ranking, at its first position
+        valid = (ranking >= 0) & (first_positions(ranking) == np.arange(ranking.shape[1]))
+        rows.append(np.nonzero(valid)[0])
+        codes.append(ranking[valid])
+        values.append(contribution[valid])
+        firsts.append(np.nonzero(valid)[1] * len(rankings) + index)
+    keys = np.concatenate(rows).astype(np.int64) * n_codes + np.concatenate(codes)
+    firsts = np.concatenate(firsts).astype(np.int64)
+    # group the (query, id) pairs, the first position of a pair comes first in its group
+    order = np.lexsort((firsts, keys))
+    keys, firsts = keys[order], firsts[order]
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    group_starts = np.nonzero(starts)[0]
+    uniques, first = keys[group_starts], firsts[group_starts]
+    fused = np.add.reduceat(np.concatenate(values)[order], group_starts) if len(keys) else np.zeros(0)
+
+    query_rows, ids = uniques // n_codes, uniques % n_codes
+    order = np.lexsort((first, -fused, query_rows))
+    query_rows, ids, fused = query_rows[order], ids[order], fused[order]
+    counts = np.bincount(query_rows, minlength=n_queries)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    positions = np.arange(len(ids)) - starts[query_rows]
+    width = counts.max() if n_queries else 0
+    fused_ids = np.full((n_queries, width), -1, dtype=np.int64)
+    fused_scores = np.full((n_queries, width), np.nan)
+    fused_ids[query_rows, positions] = ids
+    fused_scores[query_rows, positions] = fused
+    return fused_ids, fused_scores
+
+
+def reciprocal_rank_fusion(rankings, k=60, weights=None):
+    """
+    Reciprocal rank fusion of several encoded rankings of the same queries : the fused score of an id is
+    the sum over the rankings of weight / (k + rank) where rank starts at 1
+
+    Inputs :
+            rankings : list of (n_queries x k_i) arrays of id codes
+    Params :
+            k : {default : 60} rank offset
+            weights : {default : None} weight of each ranking (1 if None)
+    """
+    weights = weights or [1.] * len(rankings)
+    contributions = [np.broadcast_to(weight / (k + np.arange(1., ranking.shape[1] + 1)), ranking.shape)
+                     for ranking, weight in zip(rankings, weights)]
+    return _fuse(rankings, contributions)
+
+
+def weighted_score_fusion(rankings, weights=None, normalize=True):
+    """
+    Weighted sum of the scores of several encoded rankings of the same queries (an id missing from a ranking
+    contributes 0). If 'normalize', the scores of each response are min-max normalized to [0, 1] beforehand.
+
+    Inputs :
+            rankings : list of (ids, scores) tuples of arrays
+    Params :
+            weights : {default : None} weight of each ranking (1 if None)
+            normalize : {default : True}
+    """
+    weights = weights or [1.] * len(rankings)
+    contributions = list()
+    for (ids, scores), weight in zip(rankings, weights):
+        scores = np.where(ids >= 0, scores, np.nan)
+        if normalize and scores.shape[1]:
+            with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+                # the responses without hits have NaN bounds
+                warnings.simplefilter('ignore', RuntimeWarning)
+                low, high = np.nanmin(scores, axis=1)[:, None], np.nanmax(scores, axis=1)[:, None]
+                scores = np.where(high > low, (scores - low) / (high - low), 1.)
+        contributions.append(weight * np.nan_to_num(scores))
+    return _fuse([ids for ids, _ in rankings], contributions)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of elasticsearch responses for the SearchModule (es_search.py).
+
+The search responses are stored in a sqlite file, keyed by a canonical hash of the query DSL,
+the index name and an index version tag, with a size-based LRU eviction.
+A response to a top-k' search is used to answer any top-k search of the same query with k <= k'.
+
+Usage:
+    cache = ResponseCache('./cache/responses.db', index_version='msd_v1')
+    es = SearchModule(presets.uri_config, cache=cache)
+
+    # record every response of an experiment run and replay it offline later
+    cache = ResponseCache('./cache/train_run.db', mode='record')
+    cache = ResponseCache('./cache/train_run.db', mode='replay')
+"""
+import threading
+import hashlib
+import sqlite3
+import json
+import zlib
+import time
+import os
+
+
+class CacheMiss(Exception):
+    """Raised in 'replay' mode when a request was not recorded in the cache"""
+    pass
+
+
+class ResponseCache(object):
+    """
+    sqlite backed cache of es search responses and document field values
+    """
+    modes = ['readwrite', 'record', 'replay', 'off']
+
+    def __init__(self, db_file, index_version='', max_bytes=2 * 1024 ** 3, mode='readwrite', timeout=60):
+        """
+        Init params:
+                    db_file : path to the sqlite cache file (created if it doesn't exist)
+                    index_version : {default : ''} version tag of the es index.
+                        Change it when the index is re-ingested, so that the old responses are not used anymore.
+                    max_bytes : {default : 2GB} maximum size of the stored responses,
+                        the least recently used responses are evicted above this size
+                    mode : {default : 'readwrite'} Available modes (['readwrite', 'record', 'replay', 'off'])
+                        'readwrite' - use the cached responses and store the new ones
+                        'record' - always request es and store (overwrite) the responses
+                        'replay' - only use the cached responses, raise CacheMiss if a request is not cached
+                        'off' - bypass the cache
+                    timeout : {default : 60} seconds waited for the write lock of the file held by another process
+        """
+        if mode not in self.modes:
+            raise Exception("\nInvalid cache 'mode' parameter %s, choose from %s" % (mode, self.modes))
+        self.db_file = db_file
+        self.index_version = index_version
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._con = None
+        self._pid = None
+        self._accessed = dict()
+        self._total_bytes = None
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_con'] = None
+        state['_pid'] = None
+        state['_accessed'] = dict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        """sqlite connection owned by the current process"""
+        if self._con is None or self._pid != os.getpid():
+            db_dir = os.path.dirname(self.db_file)
+            if db_dir and not os.path.isdir(db_dir):
+                os.makedirs(db_dir)
+            self._con = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False)
+            self._con.execute("""CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, size INTEGER,
+                                 data BLOB, nbytes INTEGER, last_access REAL)""")
+            self._con.execute("""CREATE INDEX IF NOT EXISTS responses_access ON responses (last_access)""")
+            self._con.commit()
+            self._pid = os.getpid()
+        return self._con
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def _hash(self, *parts):
+        return hashlib.sha1(json.dumps([self.index_version] + list(parts), sort_keys=True,
+                                       separators=(',', ':'))).hexdigest()
+
+    def search_key(self, index, body):
+        """
+        Canonical key of a search request. The 'size' of the request is not part of the key,
+        so that a top-k' response can answer the top-k requests of the same query.
+        """
+        body = dict(body)
+        body.pop('size', None)
+        if 'params' in body:
+            # stored search template request
+            body['params'] = dict(body['params'])
+            body['params'].pop('size', None)
+        return self._hash('search', index, body)
+
+    @staticmethod
+    def _size(body):
+        """'size' of a search request (query DSL or stored search template request)"""
+        return body.get('params', body).get('size', 10)
+
+    def field_key(self, index, msd_id, field):
+        """Key of the value of a document field"""
+        return self._hash('field', index, msd_id, field)
+
+    def _get(self, key):
+        with self._lock:
+            row = self.connection.execute("""SELECT size, data FROM responses WHERE key=?""", (key,)).fetchone()
+            if row is not None:
+                self._accessed[key] = time.time()
+                if len(self._accessed) >= 1000:
+                    # the update opens a write transaction, it is committed right away so that a read-mostly
+                    # process doesn't hold the write lock of the file shared with other processes
+                    self._flush_access()
+                    self.connection.commit()
+        if row is None:
+            return None, None
+        return row[0], json.loads(zlib.decompress(row[1]))
+
+    def _put(self, rows):
+        """Store a list of (key, size, value) rows in a single transaction"""
+        with self._lock:
+            con = self.connection
+            for key, size, value in rows:
+                data = zlib.compress(json.dumps(value, separators=(',', ':')))
+                con.execute("""INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)""",
+                            (key, size, sqlite3.Binary(data), len(data), time.time()))
+            self._flush_access()
+            # the file may be shared with other processes, the size is the one of all their responses
+            self._total_bytes = con.execute("""SELECT SUM(nbytes) FROM responses""").fetchone()[0] or 0
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            con.commit()
+        return
+
+    def _flush_access(self):
+        """Write the buffered access times of the cached responses used for the LRU eviction"""
+        if self._accessed:
+            self.connection.executemany("""UPDATE responses SET last_access=? WHERE key=?""",
+                                        [(t, key) for key, t in self._accessed.items()])
+            self._accessed = dict()
+        return
+
+    def _evict(self):
+        """Remove the least recently used responses until the cache fits in 'max_bytes'"""
+        con = self.connection
+        target = self.max_bytes * 0.9
+        rows = con.execute("""SELECT key, nbytes FROM responses ORDER BY last_access""").fetchall()
+        to_remove = list()
+        for key, nbytes in rows:
+            if self._total_bytes <= target:
+                break
+            to_remove.append((key,))
+            self._total_bytes -= nbytes
+        con.executemany("""DELETE FROM responses WHERE key=?""", to_remove)
+        return
+
+    def get_search(self, index, body):
+        """
+        Returns the cached hits of a search request or None if the request is not in the cache.
+        Raises CacheMiss in 'replay' mode.
+        """
+        if self.mode in ['off', 'record']:
+            return None
+        size = self._size(body)
+        cached_size, hits = self._get(self.search_key(index, body))
+        # a top-k' response answers a top-k request if k' >= k or if it already holds all the matching docs
+        if hits is not None and (cached_size >= size or len(hits) < cached_size):
+            self.hits += 1
+            return hits[:size]
+        self.misses += 1
+        if self.mode == 'replay':
+            raise CacheMiss("\nSearch request not found in the cache %s : %s" % (self.db_file, json.dumps(body)))
+        return None
+
+    def put_search(self, index, body, hits):
+        """Store the hits of a search request"""
+        self.put_searches(index, [(body, hits)])
+        return
+
+    def put_searches(self, index, responses):
+        """Store a list of (body, hits) search responses"""
+        if self.mode in ['off', 'replay']:
+            return
+        rows = list()
+        for body, hits in responses:
+            key = self.search_key(index, body)
+            size = self._size(body)
+            if self.mode == 'readwrite':
+                cached_size, cached_hits = self._get(key)
+                if cached_hits is not None and cached_size > size:
+                    # keep the deepest response
+                    continue
+            rows.append((key, size, hits))
+        self._put(rows)
+        return
+
+    def get_field(self, index, msd_id, field):
+        """
+        Returns a tuple (found, value) for the value of a document field.
+        Raises CacheMiss in 'replay' mode.
+        """
+        if self.mode in ['off', 'record']:
+            return False, None
+        _, value = self._get(self.field_key(index, msd_id, field))
+        if value is not None:
+            self.hits += 1
+            return True, value['value']
+        self.misses += 1
+        if self.mode == 'replay':
+            raise CacheMiss("\nField %s of %s not found in the cache %s" % (field, msd_id, self.db_file))
+        return False, None
+
+    def put_field(self, index, msd_id, field, value):
+        """Store the value of a document field"""
+        self.put_fields(index, [(msd_id, field, value)])
+        return
+
+    def put_fields(self, index, values):
+        """Store a list of (msd_id, field, value) document field values"""
+        if self.mode in ['off', 'replay']:
+            return
+        self._put([(self.field_key(index, msd_id, field), 0, {'value': value}) for msd_id, field, value in values])
+        return
+
+    def close(self):
+        if self._con is not None and self._pid == os.getpid():
+            with self._lock:
+                self._flush_access()
+                self._con.commit()
+                self._con.close()
+        self._con = None
+        return
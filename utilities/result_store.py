@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Compact array-backed container of the results of an experiment (experiments.py -> run_*_task methods).
+
+The responses of the queries are stored as a (n_queries x k) int32 matrix of codes in an interned table
+of response msd_ids (-1 after the end of a response), a float32 matrix of scores and a validity mask
+(False for the queries without response, eg. songs without lyrics).
+A store is saved to a directory of numpy files memory-mapped on load, or to a single compressed
+.npz file whose arrays are only decompressed when they are accessed.
+
+Usage:
+    store = ResultStore.from_dataframe(results_df)
+    store.save('./results/title_task')
+    store = ResultStore.load('./results/title_task')
+    results_df = store.to_dataframe()
+    store.to_json('./results/title_task.json')
+"""
+import pandas as pd
+import numpy as np
+import itertools
+import json
+import os
+
+
+class ResultStore(object):
+    """
+    Responses (msd_ids and scores) of a set of queries
+    """
+    arrays = ['query_ids', 'id_table', 'ids', 'scores', 'valid']
+
+    def __init__(self, query_ids, id_table, ids, scores, valid):
+        """
+        Init params:
+                    query_ids : array of the query msd_ids
+                    id_table : array of the interned response msd_ids
+                    ids : (n_queries x k) int32 array of the codes of the response ids in id_table (-1 for padding)
+                    scores : (n_queries x k) float32 array of the response scores (NaN for padding)
+                    valid : boolean array, False for the queries without response
+        """
+        self._arrays = {'query_ids': query_ids, 'id_table': id_table, 'ids': ids, 'scores': scores,
+                        'valid': valid}
+        self._query_index = None
+        return
+
+    def _array(self, name):
+        return self._arrays[name]
+
+    query_ids = property(lambda self: self._array('query_ids'))
+    id_table = property(lambda self: self._array('id_table'))
+    ids = property(lambda self: self._array('ids'))
+    scores = property(lambda self: self._array('scores'))
+    valid = property(lambda self: self._array('valid'))
+
+    def __len__(self):
+        return len(self.query_ids)
+
+    @property
+    def lengths(self):
+        """Number of ids of each response"""
+        return (self.ids >= 0).sum(axis=1)
+
+    @staticmethod
+    def _encode(values):
+        """utf-8 encoded bytes array of a list of ids"""
+        return np.array([value.encode('utf-8') if isinstance(value, unicode) else str(value) for value in values])
+
+    @classmethod
+    def from_responses(cls, query_ids, responses, scores):
+        """
+        Build a store from lists of responses
+
+        Inputs :
+                query_ids : list of query msd_ids
+                responses : list of ranked lists of response msd_ids (None for the queries without response)
+                scores : list of lists of response scores (None for the queries without response)
+        """
+        valid = np.array([type(response) == list for response in responses], dtype=bool)
+        lists = [response for response, is_list in zip(responses, valid) if is_list]
+        score_lists = [score if type(score) == list else [np.nan] * len(response)
+                       for response, score, is_list in zip(responses, scores, valid) if is_list]
+        lengths = np.array([len(response) for response in lists], dtype=np.int64)
+        width = lengths.max() if len(lengths) else 0
+        codes, id_table = pd.factorize(np.array(list(itertools.chain.from_iterable(lists)), dtype=object))
+
+        mask = np.arange(width) < lengths[:, None]
+        ids = np.full((len(responses), width), -1, dtype=np.int32)
+        block = np.full((len(lists), width), -1, dtype=np.int32)
+        block[mask] = codes
+        ids[valid] = block
+        score_matrix = np.full((len(responses), width), np.nan, dtype=np.float32)
+        block = np.full((len(lists), width), np.nan, dtype=np.float32)
+        block[mask] = np.array(list(itertools.chain.from_iterable(score_lists)), dtype=np.float32)
+        score_matrix[valid] = block
+        return cls(cls._encode(query_ids), cls._encode(id_table), ids, score_matrix, valid)
+
+    @classmethod
+    def from_dict(cls, results, query_ids=None):
+        """
+        Build a store from a dict {query_msd_id: {'id': [msd_ids], 'score': [scores]}}
+        with the queries in the order of the list 'query_ids' if set (the queries missing from 'results' are skipped)
+        """
+        if query_ids is None:
+            query_ids = list(results.keys())
+        else:
+            query_ids = [query_id for query_id in pd.unique(np.asarray(query_ids, dtype=object))
+                         if query_id in results]
+        return cls.from_responses(query_ids, [results[query_id]['id'] for query_id in query_ids],
+                                  [results[query_id]['score'] for query_id in query_ids])
+
+    @classmethod
+    def from_dataframe(cls, results_df):
+        """Build a store from a results dataframe indexed by query msd_id with the columns 'id' and 'score'"""
+        return cls.from_responses(results_df.index.values.tolist(), results_df['id'].values.tolist(),
+                                  results_df['score'].values.tolist())
+
+    @classmethod
+    def from_json(cls, jsonfile):
+        """Build a store from a results json file {query_msd_id: {'id': [msd_ids], 'score': [scores]}}"""
+        with open(jsonfile) as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def concat(cls, stores):
+        """Concatenate a list of stores (eg. the chunks of a checkpointed run) into a single store"""
+        if not stores:
+            return cls.from_responses([], [], [])
+        # re-intern the response ids of all the stores in a single table
+        table_codes, id_table = pd.factorize(np.concatenate([store.id_table for store in stores]).astype(object))
+        width = max(store.ids.shape[1] for store in stores)
+        ids, scores = list(), list()
+        offset = 0
+        for store in stores:
+            # the padding code -1 maps to the last item of the lookup table
+            lookup = np.append(table_codes[offset:offset + len(store.id_table)], -1).astype(np.int32)
+            offset += len(store.id_table)
+            pad = width - store.ids.shape[1]
+            ids.append(np.pad(lookup[store.ids], ((0, 0), (0, pad)), 'constant', constant_values=-1))
+            scores.append(np.pad(np.asarray(store.scores), ((0, 0), (0, pad)), 'constant', constant_values=np.nan))
+        return cls(np.concatenate([store.query_ids for store in stores]), cls._encode(id_table),
+                   np.concatenate(ids), np.concatenate(scores), np.concatenate([store.valid for store in stores]))
+
+    def response(self, index):
+        """Returns the tuple (response msd_ids, scores) of the query at 'index' ((None, None) if invalid)"""
+        if not self.valid[index]:
+            return None, None
+        codes = self.ids[index]
+        length = (codes >= 0).sum()
+        return self.id_table[codes[:length]].tolist(), self.scores[index, :length].astype(np.float64).tolist()
+
+    def row_of(self, query_ids):
+        """Rows of a list of query msd_ids in the store (-1 for the queries not in the store)"""
+        if self._query_index is None:
+            self._query_index = pd.Index(self.query_ids)
+        return self._query_index.get_indexer(self._encode(query_ids))
+
+    def take(self, rows):
+        """Returns a new store with the queries at the indexes 'rows' in this order"""
+        return ResultStore(self.query_ids[rows], self.id_table, self.ids[rows], self.scores[rows], self.valid[rows])
+
+    def prune(self, size):
+        """Returns a new store with the top 'size' ids of each response"""
+        return ResultStore(self.query_ids, self.id_table, self.ids[:, :size], self.scores[:, :size], self.valid)
+
+    def to_dict(self):
+        """Results as a dict {query_msd_id: {'id': [msd_ids], 'score': [scores]}} (None for invalid responses)"""
+        results = dict()
+        for index, query_id in enumerate(self.query_ids.tolist()):
+            res_ids, res_scores = self.response(index)
+            results[query_id] = {'id': res_ids, 'score': res_scores}
+        return results
+
+    def to_dataframe(self):
+        """Results as the dataframe returned by the run_*_task methods of the Experiments class"""
+        return pd.DataFrame.from_dict(self.to_dict(), orient='index')
+
+    def to_json(self, jsonfile):
+        """Save the results as a json file {query_msd_id: {'id': [msd_ids], 'score': [scores]}}"""
+        with open(jsonfile, 'w') as f:
+            json.dump(self.to_dict(), f)
+        return
+
+    def save(self, path, compress=False):
+        """
+        Save the store to a directory of numpy files (memory-mapped on load)
+        or to a single compressed .npz file if 'compress'
+        """
+        if compress:
+            np.savez_compressed(path, **dict((name, self._array(name)) for name in self.arrays))
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self.arrays:
+            np.save(os.path.join(path, name + '.npy'), self._array(name))
+        return
+
+    @classmethod
+    def load(cls, path):
+        """Load a store saved with 'save' (a directory or a .npz file)"""
+        if os.path.isdir(path):
+            return cls(**dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+                              for name in cls.arrays))
+        if not path.endswith('.npz'):
+            path += '.npz'
+        npz = np.load(path)
+        store = cls(**dict((name, None) for name in cls.arrays))
+        store._arrays = _LazyNpz(npz)
+        return store
+
+
+class _LazyNpz(dict):
+    """dict of the arrays of a .npz file decompressed on first access"""
+
+    def __init__(self, npz):
+        dict.__init__(self)
+        self.npz = npz
+
+    def __missing__(self, name):
+        self[name] = self.npz[name]
+        return self[name]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar snapshot of the fields of the es index documents which can be memory-mapped back.
+
+A snapshot is a directory with a 'manifest.json' file and a set of numpy files per field :
+    * 'text' fields : <field>.offsets.npy (int64 offsets of each value in the blob),
+                      <field>.blob (utf-8 encoded values) and <field>.valid.npy (False for missing values)
+    * 'dict' fields (low cardinality fields like msd_artist_id) : <field>.codes.npy (int32 code of each value
+                      in the string table, -1 for missing values) and the string table as a 'text' field
+The msd_ids of the documents are stored as the '_id' text field.
+
+Usage:
+    es.export_snapshot('./snapshots/msd', fields=['msd_title', 'msd_artist_id', 'mxm_lyrics'])
+    snapshot = IndexSnapshot('./snapshots/msd')
+    titles = snapshot.column('msd_title')
+    df = snapshot.to_dataframe(['msd_title', 'shs_id'])
+"""
+import numpy as np
+import pandas as pd
+import json
+import os
+
+
+class IndexSnapshot(object):
+    """
+    Memory-mapped reader (and writer) of columnar snapshots of the index fields
+    """
+
+    def __init__(self, path):
+        """
+        Init params:
+                    path : path to the snapshot directory
+        """
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.fields = [field for field in self.manifest['fields'] if field != '_id']
+        self.n_docs = self.manifest['n_docs']
+        self._ids = None
+        self._id_index = None
+        return
+
+    def __len__(self):
+        return self.n_docs
+
+    @staticmethod
+    def _encode(value):
+        if value is None or (type(value) == float and np.isnan(value)):
+            return None
+        if not isinstance(value, basestring):
+            value = unicode(value)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return value
+
+    @classmethod
+    def _write_text(cls, path, name, values):
+        encoded = [cls._encode(value) for value in values]
+        valid = np.array([value is not None for value in encoded], dtype=bool)
+        lengths = np.array([len(value) if value is not None else 0 for value in encoded], dtype=np.int64)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(path, name + '.offsets.npy'), offsets)
+        np.save(os.path.join(path, name + '.valid.npy'), valid)
+        with open(os.path.join(path, name + '.blob'), 'wb') as f:
+            for value in encoded:
+                if value is not None:
+                    f.write(value)
+        return
+
+    @classmethod
+    def write(cls, path, ids, columns, dict_ratio=0.5, meta=None):
+        """
+        Write a snapshot
+
+        Inputs :
+                path : path to the snapshot directory (created if it doesn't exist)
+                ids : list of the msd_ids of the documents
+                columns : dict {field : list of the field values of the documents (None for missing values)}
+        Params :
+                dict_ratio : {default : 0.5} fields with less distinct values than dict_ratio * n_docs
+                    are dictionary encoded
+                meta : {default : None} dict of extra information stored in the manifest
+                    (eg. the index name)
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        manifest = {'n_docs': len(ids), 'fields': {'_id': 'text'}, 'meta': meta or dict()}
+        cls._write_text(path, '_id', ids)
+        for field, values in columns.iteritems():
+            if len(values) != len(ids):
+                raise Exception("\nField %s has %s values for %s documents" % (field, len(values), len(ids)))
+            codes, table = pd.factorize(pd.Series([cls._encode(value) for value in values], dtype=object))
+            if len(table) < dict_ratio * len(ids):
+                np.save(os.path.join(path, field + '.codes.npy'), codes.astype(np.int32))
+                cls._write_text(path, field + '.table', table.tolist())
+                manifest['fields'][field] = 'dict'
+            else:
+                cls._write_text(path, field, values)
+                manifest['fields'][field] = 'text'
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return cls(path)
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name), mmap_mode='r')
+
+    def _read_text(self, name, rows=None):
+        """Decode the values of a text field (for all the docs or a list of rows) as an object array"""
+        offsets = self._load(name + '.offsets.npy')
+        valid = self._load(name + '.valid.npy')
+        blob = np.memmap(os.path.join(self.path, name + '.blob'), dtype=np.uint8, mode='r') \
+            if offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        if rows is None:
+            rows = np.arange(len(valid))
+        values = np.empty(len(rows), dtype=object)
+        for i, row in enumerate(rows):
+            if valid[row]:
+                values[i] = blob[offsets[row]:offsets[row + 1]].tostring().decode('utf-8')
+        return values
+
+    @property
+    def ids(self):
+        """msd_ids of the documents"""
+        if self._ids is None:
+            self._ids = self._read_text('_id')
+        return self._ids
+
+    def row_of(self, msd_id):
+        """Row of a msd_id in the snapshot (-1 if it is not in the snapshot)"""
+        if self._id_index is None:
+            self._id_index = pd.Index(self.ids)
+        return self._id_index.get_indexer([msd_id])[0]
+
+    def codes(self, field):
+        """Memory-mapped int32 codes of a dictionary encoded field and its string table"""
+        if self.manifest['fields'][field] != 'dict':
+            raise Exception("\nField %s is not dictionary encoded" % field)
+        return self._load(field + '.codes.npy'), self._read_text(field + '.table')
+
+    def column(self, field, rows=None):
+        """Values of a field as an object array (None for missing values) for all the docs or a list of rows"""
+        if field not in self.manifest['fields']:
+            raise Exception("\nField %s is not in the snapshot %s" % (field, self.path))
+        if self.manifest['fields'][field] == 'text':
+            return self._read_text(field, rows)
+        codes, table = self.codes(field)
+        codes = np.asarray(codes if rows is None else codes[rows])
+        values = np.empty(len(codes), dtype=object)
+        values[codes >= 0] = table[codes[codes >= 0]]
+        return values
+
+    def get(self, msd_id, field):
+        """Value of a field for a msd_id (None if missing)"""
+        row = self.row_of(msd_id)
+        if row < 0:
+            return None
+        return self.column(field, rows=[row])[0]
+
+    def to_dataframe(self, fields=None):
+        """Load the snapshot (or some of its fields) as a pandas dataframe indexed by msd_id"""
+        fields = fields or self.fields
+        return pd.DataFrame(dict((field, self.column(field)) for field in fields),
+                            index=pd.Index(self.ids, name='msd_id'), columns=fields)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Local stub of the elasticsearch REST endpoints used by the es_search.py -> SearchModule class, to measure the
+overhead of the search client (benchmarks) or to load test it without any es cluster.
+
+The stub answers the _search, _search/template, _msearch, _msearch/template, _mget and document GET requests
+with deterministic hits of synthetic msd_ids (the size of a response is the 'size' of the query). A simulated
+service time, error rate and number of concurrent requests served can be set to mimic a loaded cluster.
+
+Usage:
+    server = StubServer(latency=0.002).start()
+    es = SearchModule(server.uri_config)
+    es.search_by_exact_title('My Sweet Lord', 'TRPYNNL12903CAF506', out_mode='eval')
+    server.stop()
+
+    $ python -m utilities.stub_server -p 9200 -l 0.005
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import multiprocessing
+import threading
+import argparse
+import random
+import json
+import time
+import zlib
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class StubServer(object):
+    """
+    Threaded http server answering the es requests of a SearchModule with synthetic responses
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, index='msd', doc_type='song', latency=0., jitter=0.,
+                 error_rate=0., max_concurrency=None, n_docs=1000000, seed=0):
+        """
+        Init params:
+                    host, port : {default : ('127.0.0.1', 0)} address of the server (0 for a free port)
+                    index, doc_type : es index and type of the uri_config of the server
+                    latency : {default : 0.} service time of a search in seconds (per search of a _msearch)
+                    jitter : {default : 0.} maximum random time added to the service time in seconds
+                    error_rate : {default : 0.} fraction of the requests answered with a 503 error
+                    max_concurrency : {default : None} number of requests served at the same time,
+                        the other requests wait for a free slot (None for no limit)
+                    n_docs : {default : 1000000} number of synthetic documents of the index
+                    seed : {default : 0} seed of the random errors and jitter
+        """
+        self.index = index
+        self.doc_type = doc_type
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.n_docs = n_docs
+        self._random = random.Random(seed)
+        self._slots = threading.Semaphore(max_concurrency) if max_concurrency else None
+        self._lock = threading.Lock()
+        self.n_requests = 0
+        self.n_errors = 0
+        self._server = _ThreadingHTTPServer((host, port), _make_handler(self))
+        self._thread = None
+        self._process = None
+        return
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def uri_config(self):
+        """uri_config of the server for a SearchModule (check templates.py)"""
+        return {'host': self._server.server_address[0], 'port': self.port, 'scheme': 'http', 'index': self.index,
+                'type': self.doc_type}
+
+    def start(self, process=False):
+        """
+        Serve the requests in a background thread and returns the server
+
+        :param process: {default : False} If True, serve them in a child process instead, so that the server doesn't
+            share the GIL with the client measured (the n_requests and n_errors counters are then not updated)
+        """
+        if process:
+            self._process = multiprocessing.Process(target=self._server.serve_forever)
+            self._process.daemon = True
+            self._process.start()
+        else:
+            self._thread = threading.Thread(target=self._server.serve_forever)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the server and close its socket"""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+        else:
+            self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def _msd_id(self, code):
+        return 'TR%016X' % code
+
+    def _source(self, code):
+        return {'msd_title': 'title %s' % (code % 5000), 'msd_artist_id': 'AR%016X' % (code % 50000),
+                'shs_id': str(code % 7) if code % 3 == 0 else None,
+                'msd_is_duplicate_of': self._msd_id(code - 1) if code % 11 == 0 else None,
+                'dzr_song_title': 'title %s' % (code % 5000) if code % 2 == 0 else None}
+
+    def _search(self, body):
+        """Response of a search body (or of a stored template request)"""
+        params = body.get('params', body)
+        size = int(params.get('size', 10))
+        seed = zlib.crc32(json.dumps(body, sort_keys=True)) & 0xffffffff
+        hits = [{'_index': self.index, '_type': self.doc_type, '_id': self._msd_id((seed + 7919 * rank) % self.n_docs),
+                 '_score': 20. / (rank + 1), '_source': self._source((seed + 7919 * rank) % self.n_docs)}
+                for rank in range(size)]
+        return {'took': int(self.latency * 1000), 'timed_out': False,
+                'hits': {'total': size, 'max_score': hits[0]['_score'] if hits else None, 'hits': hits}}
+
+    def _document(self, msd_id):
+        return {'_index': self.index, '_type': self.doc_type, '_id': msd_id, 'found': True,
+                '_source': self._source(int(msd_id[2:], 16) if msd_id.startswith('TR') else 0)}
+
+    def _wait(self, n_searches=1):
+        """Simulated service time of a request"""
+        delay = n_searches * self.latency + (self._random.random() * self.jitter if self.jitter else 0.)
+        if delay:
+            time.sleep(delay)
+        return
+
+    def respond(self, method, path, body):
+        """Returns the (status, response dict) of a request"""
+        with self._lock:
+            self.n_requests += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.n_errors += 1
+                return 503, {'error': 'stub server unavailable', 'status': 503}
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            path = path.split('?')[0].rstrip('/')
+            if path.endswith('/_msearch') or path.endswith('/_msearch/template'):
+                lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+                searches = lines[1::2]
+                self._wait(len(searches))
+                return 200, {'responses': [self._search(search) for search in searches]}
+            if path.endswith('/_search') or path.endswith('/_search/template'):
+                self._wait()
+                return 200, self._search(json.loads(body) if body else {})
+            if path.endswith('/_mget'):
+                self._wait()
+                return 200, {'docs': [self._document(msd_id) for msd_id in json.loads(body)['ids']]}
+            if method == 'PUT' and '/_search/template/' in path:
+                return 200, {'acknowledged': True}
+            parts = path.strip('/').split('/')
+            if method == 'GET' and len(parts) == 3:
+                self._wait()
+                return 200, self._document(parts[2])
+            return 200, {'name': 'stub', 'version': {'number': '2.3.0'}}
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+
+def _make_handler(server):
+    """Request handler class of a StubServer"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # a single write per response, without the delayed ack of small writes
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def _handle(self):
+            length = int(self.headers.getheader('content-length') or 0)
+            body = self.rfile.read(length) if length else ''
+            status, response = server.respond(self.command, self.path, body)
+            data = json.dumps(response)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = _handle
+
+        def log_message(self, *args):
+            return
+
+    return Handler
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Local stub of the es endpoints used by the SearchModule class",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-p", action="store", default=9200, help="port of the server")
+    parser.add_argument("-l", action="store", default=0., help="service time of a search in seconds")
+    parser.add_argument("-j", action="store", default=0., help="maximum random time added to the service time")
+    parser.add_argument("-e", action="store", default=0., help="fraction of the requests answered with an error")
+    parser.add_argument("-c", action="store", default=0, help="number of requests served at the same time (0 for "
+                                                              "no limit)")
+    args = parser.parse_args()
+
+    stub = StubServer(port=int(args.p), latency=float(args.l), jitter=float(args.j), error_rate=float(args.e),
+                      max_concurrency=int(args.c) or None)
+    print "Stub es server on port %s (index '%s', type '%s')" % (stub.port, stub.index, stub.doc_type)
+    stub._server.serve_forever()
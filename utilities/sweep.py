@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Offline sweep of the threshold (proximity) and prune size parameters of the rerank experiments
+(experiments.py -> Experiments.rerank_sweep) over stored responses.
+
+The title, lyrics and audio responses of the query set are encoded once (check utilities/rerank.py)
+and each point of the (threshold x size) grid is a batched rerank of all the queries followed by the
+evaluation of the reranked responses, the grid points being evaluated in parallel by a joblib pool.
+
+The strategies reproduce the rerank tasks of the Experiments class :
+    * 'lyrics' : run_rerank_title_with_mxm_lyrics_task (and dzr lyrics), the threshold is the lyrics proximity
+    * 'field' : run_field_rerank_task, the threshold is the score proximity of the promoted hits
+    * 'audio' : run_audio_rerank_task, the threshold is the maximum audio distance of the promoted hits
+
+Usage:
+    sweep = rerank_sweep(metrics, works, valid, table, (title_ids, title_scores), (lyrics_ids, lyrics_scores),
+                         'lyrics', thresholds=[0.1, 0.5, 1.], sizes=[10, 100])
+"""
+from joblib import Parallel, delayed
+from utilities.metrics import PADDING
+from utilities import rerank
+import pandas as pd
+import numpy as np
+
+
+STRATEGIES = ['lyrics', 'field', 'audio']
+
+
+def _evaluate(metrics, lookup, works, valid, base, other, strategy, threshold, size):
+    """Rerank the responses pruned to 'size' with a threshold and returns their (MAP, MPER)"""
+    ids, scores = base[0][:, :size], base[1][:, :size]
+    if strategy == 'lyrics':
+        ids, scores = rerank.promote_by_lyrics(ids, scores, other[0][:, :size], other[1][:, :size],
+                                               proximity=threshold)
+    elif strategy == 'field':
+        ids, scores = rerank.promote_by_field(ids, scores, other[0][:, :size], other[1], proximity=threshold)
+    else:
+        with np.errstate(invalid='ignore'):
+            n_head = ((other[0] >= 0) & (other[1] <= threshold)).sum(axis=1)
+        ids, scores = rerank.promote_prefix(ids, scores, other[0], other[1], n_head)
+    codes = lookup[ids].astype(np.int32)
+    codes[~valid] = PADDING
+    mean_avg_precisions, mean_percentages = metrics.cutoff_metrics(codes, valid, works, [codes.shape[1]])
+    return mean_avg_precisions[0], mean_percentages[0]
+
+
+def rerank_sweep(metrics, works, valid, table, base, other, strategy, thresholds, sizes, n_jobs=-1):
+    """
+    Evaluate a rerank strategy for each (threshold, size) point of a grid
+
+    Inputs :
+            metrics : RankingMetrics instance of the query set (utilities/metrics.py)
+            works, valid : work codes of the queries and False for the queries without response
+            table : id table of the encoded responses (check rerank.encode_rankings)
+            base : (ids, scores) arrays of the reranked responses (eg. title responses)
+            other : arrays of the rerank signal of the strategy
+                'lyrics' : (ids, scores) of the lyrics responses
+                'field' : (fields, query_fields) codes of the field values of the hits and of the queries
+                'audio' : (ids, scores) of the audio responses
+            strategy : one of ['lyrics', 'field', 'audio']
+            thresholds : list of thresholds
+            sizes : list of prune sizes of the responses
+    Params :
+            n_jobs : {default : -1} number of parallel jobs (-1 for one per cpu core)
+
+    Output : pandas dataframe with the columns ['threshold', 'size', 'map', 'mper'] (one row per grid point)
+    """
+    if strategy not in STRATEGIES:
+        raise Exception("\nInvalid rerank strategy %s, available strategies are %s" % (strategy, STRATEGIES))
+    # codes of the response ids in the query set, the padding code -1 maps to the last item
+    lookup = np.append(metrics.id_index.get_indexer(np.asarray(table, dtype=object)), PADDING)
+    grid = [(threshold, size) for threshold in thresholds for size in sizes]
+    scores = Parallel(n_jobs=n_jobs)(delayed(_evaluate)(metrics, lookup, works, valid, base, other, strategy,
+                                                        threshold, size) for threshold, size in grid)
+    return pd.DataFrame({'threshold': [threshold for threshold, _ in grid], 'size': [size for _, size in grid],
+                         'map': [score[0] for score in scores], 'mper': [score[1] for score in scores]},
+                        columns=['threshold', 'size', 'map', 'mper'])
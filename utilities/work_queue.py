@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Durable work queue of experiment shards stored in a SQLite file (distributed.py).
+
+A coordinator enqueues the tasks once, any number of worker processes (on any node which can open the file)
+claim a task with a lease, execute it and commit its result. A task whose lease expired without any heartbeat
+(eg. a crashed worker) can be claimed again by another worker, and the commit of a worker which lost its lease
+is rejected, so that each task has a single committed result. A task failing 'max_attempts' times is marked as
+'failed' and is not claimed anymore.
+
+[NOTE]: The claims rely on the file locks of SQLite, the queue file must be on a local disk or on a shared file
+system with working POSIX locks (eg. NFSv4, not NFSv3 without lockd).
+
+Usage:
+    queue = WorkQueue('./queue/sweep.db')
+    queue.enqueue([('title|shard_00000', {'start': 0, 'stop': 1000})])
+    task = queue.claim('worker-1', lease=300)
+    queue.complete(task['id'], 'worker-1', result='./results/title_shard_00000')
+"""
+import sqlite3
+import socket
+import json
+import time
+import os
+
+
+class WorkQueue(object):
+    """
+    Task queue with leases in a SQLite file
+    """
+    statuses = ['pending', 'running', 'done', 'failed']
+
+    def __init__(self, path, max_attempts=3, timeout=60):
+        """
+        Init params:
+                    path : path of the SQLite file of the queue (created if it doesn't exist)
+                    max_attempts : {default : 3} number of claims of a task before it is marked as 'failed'
+                    timeout : {default : 60} seconds waited for the lock of the file by a transaction
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, key TEXT UNIQUE, payload TEXT, "
+                       "status TEXT, worker TEXT, lease_expiry REAL, attempts INTEGER, result TEXT, error TEXT, "
+                       "updated REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expiry)")
+        return
+
+    def _transaction(self):
+        """Connection of a transaction, each call opens its own connection so that threads can share the queue"""
+        return _Transaction(sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None))
+
+    @staticmethod
+    def default_worker_id():
+        """Worker id of the current process (host:pid)"""
+        return '%s:%s' % (socket.gethostname(), os.getpid())
+
+    def enqueue(self, tasks):
+        """
+        Add a list of (key, payload) tasks to the queue, the tasks with a key already in the queue are skipped
+        (so that a coordinator can be restarted). The payloads are json serializable dicts.
+        Returns the number of tasks added.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            added = 0
+            for key, payload in tasks:
+                cursor = db.execute("INSERT OR IGNORE INTO tasks (key, payload, status, attempts, updated) "
+                                    "VALUES (?, ?, 'pending', 0, ?)", (key, json.dumps(payload), now))
+                added += cursor.rowcount
+        return added
+
+    def claim(self, worker_id, lease=300):
+        """
+        Claim a pending task (or a running task with an expired lease) for 'lease' seconds
+
+        Output : dict {'id', 'key', 'payload', 'attempts'} of the claimed task, None if there is no task to claim
+        """
+        now = time.time()
+        with self._transaction() as db:
+            # the tasks exceeding max_attempts with an expired lease are given up
+            db.execute("UPDATE tasks SET status = 'failed', error = 'lease expired', updated = ? "
+                       "WHERE status = 'running' AND lease_expiry < ? AND attempts >= ?",
+                       (now, now, self.max_attempts))
+            row = db.execute("SELECT id, key, payload, attempts FROM tasks WHERE status = 'pending' "
+                             "OR (status = 'running' AND lease_expiry < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE tasks SET status = 'running', worker = ?, lease_expiry = ?, attempts = attempts + 1, "
+                       "updated = ? WHERE id = ?", (worker_id, now + lease, now, row[0]))
+        return {'id': row[0], 'key': row[1], 'payload': json.loads(row[2]), 'attempts': row[3] + 1}
+
+    def heartbeat(self, task_id, worker_id, lease=300):
+        """Extend the lease of a task claimed by 'worker_id', returns False if the worker lost the lease"""
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE tasks SET lease_expiry = ?, updated = ? WHERE id = ? AND worker = ? "
+                                "AND status = 'running'", (now + lease, now, task_id, worker_id))
+        return cursor.rowcount == 1
+
+    def complete(self, task_id, worker_id, result=None):
+        """
+        Commit the result (json serializable, eg. the path of a saved ResultStore) of a task claimed by
+        'worker_id', returns False if the worker lost the lease (the result is then not committed)
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE tasks SET status = 'done', result = ?, updated = ? WHERE id = ? "
+                                "AND worker = ? AND status = 'running'",
+                                (json.dumps(result), time.time(), task_id, worker_id))
+        return cursor.rowcount == 1
+
+    def fail(self, task_id, worker_id, error):
+        """Release a task claimed by 'worker_id' after an error, it is 'failed' after max_attempts claims"""
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                "error = ?, worker = NULL, lease_expiry = NULL, updated = ? WHERE id = ? "
+                                "AND worker = ? AND status = 'running'",
+                                (self.max_attempts, str(error), time.time(), task_id, worker_id))
+        return cursor.rowcount == 1
+
+    def counts(self):
+        """Number of tasks by status"""
+        with self._transaction() as db:
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return dict((status, counts.get(status, 0)) for status in self.statuses)
+
+    def is_finished(self):
+        """True if all the tasks are done or failed"""
+        counts = self.counts()
+        return counts['pending'] + counts['running'] == 0
+
+    def tasks(self, status=None):
+        """List of the tasks (dicts) in the order of the queue, only the ones with 'status' if set"""
+        query = "SELECT id, key, payload, status, worker, attempts, result, error FROM tasks"
+        params = tuple()
+        if status:
+            query += " WHERE status = ?"
+            params = (status,)
+        with self._transaction() as db:
+            rows = db.execute(query + " ORDER BY id", params).fetchall()
+        return [{'id': row[0], 'key': row[1], 'payload': json.loads(row[2]), 'status': row[3], 'worker': row[4],
+                 'attempts': row[5], 'result': json.loads(row[6]) if row[6] else None, 'error': row[7]}
+                for row in rows]
+
+
+class _Transaction(object):
+    """Context manager of an immediate (write locked) transaction closing its connection"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.connection.close()
+        return False
@@ -44,15 +44,21 @@ def timeit(method):
 
 
 def slice_results(results_json, size):
-    """Slice the query response results to a specified size"""
-    with open(results_json) as f:
-        data = json.load(f)
+    """
+    Slice the query response results to a specified size
+    (results_json is the path to a results json file or the dict loaded from it)
+    """
+    if isinstance(results_json, dict):
+        data = results_json
+    else:
+        with open(results_json) as f:
+            data = json.load(f)
     sliced_dict = dict()
     for msd_id in data.keys():
         if type(data[msd_id]['id'])==list:
             sliced_dict[msd_id] = {
                                 'id': data[msd_id]['id'][:size], 
-                                'score': data[msd_id]['id'][:size]
+                                'score': data[msd_id]['score'][:size]
                                 }
         else:
             sliced_dict[msd_id] = {'id': None, 'score': None}